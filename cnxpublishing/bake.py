@@ -6,18 +6,39 @@
 # See LICENCE.txt for details.
 # ###
 """Provides a means of baking a binder and persisting it to the archive."""
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 import cnxepub
 import memcache
 from cnxepub.collation import collate as collate_models
 from cnxepub.formatters import exercise_callback_factory
+from psycopg2.extras import execute_values
+from pyramid.settings import asbool, aslist
 from pyramid.threadlocal import get_current_registry
 
-from .db import with_db_cursor
+from .db import lookup_module_ident, lookup_module_idents, with_db_cursor
 from .publish import (
     publish_collated_document,
+    publish_collated_documents,
     publish_collated_tree,
     publish_composite_model,
     )
+from .utils import split_ident_hash
+
+
+logger = logging.getLogger('cnxpublishing')
+
+
+# The settings that change the content embedded by the formatter
+# callbacks (see ``_formatter_callback_factory``).
+FORMATTER_SETTINGS = (
+    'embeddables.exercise.url_template',
+    'embeddables.exercise.match',
+    'mathmlcloud.url',
+    )
 
 
 def _formatter_callback_factory():  # pragma: no cover
@@ -50,6 +71,46 @@ def _formatter_callback_factory():  # pragma: no cover
     return includes
 
 
+def formatter_fingerprint():
+    """Returns a fingerprint (SHA1) of the settings that the baked content
+    is formatted with. This is the result of the baking task, so that
+    a later bake is able to tell whether the baked content can be reused
+    (see ``baking.incremental``).
+
+    """
+    settings = get_current_registry().settings or {}
+    values = [settings.get(name) or '' for name in FORMATTER_SETTINGS]
+    return hashlib.sha1('\n'.join(values)).hexdigest()
+
+
+def _baked_formatter_fingerprint(result_id):
+    """Returns the formatter fingerprint that the book was baked with,
+    given the id of the baking task's result, or ``None`` when
+    the result is not (or no longer) available.
+
+    The fingerprint is only kept in the celery result backend, so it is
+    lost when the result expires (see ``celery.result_expires``).
+
+    """
+    result = get_current_registry().celery_app.AsyncResult(str(result_id))
+    if result.state != 'SUCCESS' or not isinstance(result.result, dict):
+        return None
+    return result.result.get('formatter')
+
+
+def _pipeline_pool():
+    """Returns the pool of threads that render the baked content
+    or ``None`` when baking isn't pipelined (see ``baking.pipeline``).
+
+    """
+    settings = get_current_registry().settings or {}
+    if not asbool(settings.get('baking.pipeline')):
+        return None
+    threads = int(settings.get('baking.pipeline.threads', 0) or
+                  multiprocessing.cpu_count())
+    return ThreadPool(threads)
+
+
 def _get_recipe(recipe_id, cursor):
     """Returns recipe as a unicode string"""
 
@@ -58,16 +119,17 @@ def _get_recipe(recipe_id, cursor):
     return cursor.fetchone()[0]
 
 
-@with_db_cursor
-def bake(binder, recipe_id, publisher, message, cursor):
-    """Given a `Binder` as `binder`, bake the contents and
-    persist those changes alongside the published content.
+def _flatten(models, flatten_filter):
+    for model in models:
+        for x in cnxepub.flatten_to(model, flatten_filter):
+            yield x
 
-    """
-    recipe = _get_recipe(recipe_id, cursor)
-    includes = _formatter_callback_factory()
-    binder = collate_models(binder, ruleset=recipe, includes=includes)
 
+def _publish_baked(cursor, binder, nodes, publisher, message):
+    """Publish the composites and the collated content of the ``nodes``
+    of the collated ``binder``.
+
+    """
     def flatten_filter(model):
         return (isinstance(model, cnxepub.CompositeDocument) or
                 (isinstance(model, cnxepub.Binder) and
@@ -77,11 +139,248 @@ def bake(binder, recipe_id, publisher, message, cursor):
         return isinstance(model, cnxepub.Document) \
                and not isinstance(model, cnxepub.CompositeDocument)
 
-    for doc in cnxepub.flatten_to(binder, flatten_filter):
-        publish_composite_model(cursor, doc, binder, publisher, message)
+    pool = _pipeline_pool()
+    if pool is None:
+        for doc in _flatten(nodes, flatten_filter):
+            publish_composite_model(cursor, doc, binder, publisher, message)
+
+        for doc in _flatten(nodes, only_documents_filter):
+            publish_collated_document(cursor, doc, binder)
+    else:
+        # The composites are published first, so that the content
+        # can refer to them. Then all of the content is rendered
+        # concurrently and written at once.
+        documents = []
+        for doc in _flatten(nodes, flatten_filter):
+            publish_composite_model(cursor, doc, binder, publisher, message,
+                                    content=False)
+            if isinstance(doc, cnxepub.CompositeDocument):
+                documents.append(doc)
+        documents.extend(_flatten(nodes, only_documents_filter))
+        try:
+            publish_collated_documents(cursor, documents, binder, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _get_tree(cursor, ident_hash, as_collated=False):
+    """Returns the (raw or collated) tree of the book or ``None``."""
+    uuid, version = split_ident_hash(ident_hash)
+    cursor.execute("SELECT tree_to_json(%s, %s, %s)::json",
+                   (uuid, version, as_collated,))
+    return cursor.fetchone()[0]
+
+
+def _tree_keys(cursor, tree):
+    """Returns a key for each of the top-level nodes of the raw ``tree``,
+    made of the titles and the content hashes (SHA1) of the documents
+    within the node.
+
+    """
+    module_idents = lookup_module_idents(
+        cursor, cnxepub.flatten_tree_to_ident_hashes(tree))
+    cursor.execute("""\
+SELECT mf.module_ident, f.sha1
+FROM module_files AS mf JOIN files AS f USING (fileid)
+WHERE mf.module_ident = ANY (%s) AND mf.filename = 'index.cnxml.html'""",
+                   (list(set(module_idents.values())),))
+    hashes = dict(cursor.fetchall())
+
+    def key(node):
+        if 'contents' in node:
+            return (node['title'], tuple([key(x) for x in node['contents']]),)
+        return (node['title'], hashes.get(module_idents.get(node['id'])),)
 
-    for doc in cnxepub.flatten_to(binder, only_documents_filter):
-        publish_collated_document(cursor, doc, binder)
+    return [key(node) for node in tree['contents']]
+
+
+def _previous_bake(cursor, binder, recipe_id):
+    """Returns the ident-hash of the last baked version of the ``binder``
+    that was baked with the same recipe and formatter settings or ``None``
+    when there is no such version or the book isn't baked incrementally
+    (see ``baking.incremental``).
+
+    """
+    settings = get_current_registry().settings or {}
+    if not asbool(settings.get('baking.incremental')):
+        return None
+    # Only the print styles that collate each chapter on its own.
+    print_styles = aslist(settings.get('baking.incremental.print_styles', ''))
+    if not print_styles:
+        return None
+    cursor.execute("""\
+SELECT ident_hash(p.uuid, p.major_version, p.minor_version),
+       (SELECT a.result_id
+        FROM document_baking_result_associations AS a
+        WHERE a.module_ident = p.module_ident
+        ORDER BY a.created DESC
+        LIMIT 1)
+FROM modules AS m
+     JOIN modules AS p ON p.uuid = m.uuid
+     JOIN modulestates AS ms ON ms.stateid = p.stateid
+WHERE m.module_ident = %s
+      AND m.print_style = ANY (%s)
+      AND p.module_ident != m.module_ident
+      AND p.recipe = %s
+      AND ms.statename IN ('current', 'fallback')
+      AND EXISTS (SELECT 1 FROM trees AS t
+                  WHERE t.documentid = p.module_ident
+                        AND t.parent_id IS NULL
+                        AND t.is_collated)
+ORDER BY p.module_ident DESC
+LIMIT 1""", (lookup_module_ident(cursor, binder.ident_hash), print_styles,
+             recipe_id,))
+    row = cursor.fetchone()
+    if row is None or row[1] is None:
+        return None
+    previous, result_id = row
+    fingerprint = _baked_formatter_fingerprint(result_id)
+    if fingerprint is None:
+        logger.info('Baking {} in full, because the result ({}) of baking '
+                    '{} is no longer available from the celery result '
+                    'backend'.format(binder.ident_hash, result_id, previous))
+        return None
+    elif fingerprint != formatter_fingerprint():
+        logger.info('Baking {} in full, because the formatter settings '
+                    'changed since baking {}'
+                    .format(binder.ident_hash, previous))
+        return None
+    return previous
+
+
+def _remap_tree(tree, mapping):
+    """Returns a copy of the ``tree`` with its ids replaced
+    as given by the ``mapping``.
+
+    """
+    tree = dict(tree, id=mapping.get(tree['id'], tree['id']))
+    if 'contents' in tree:
+        tree['contents'] = [_remap_tree(x, mapping) for x in tree['contents']]
+    return tree
+
+
+def _reuse_collated_files(cursor, binder, previous, items):
+    """Associate the collated content of the ``items`` in the context of
+    the ``previous``ly baked book with the ``binder``. The ``items``
+    is a mapping of previous to current ident-hashes.
+
+    """
+    module_idents = lookup_module_idents(
+        cursor,
+        list(items.keys()) + list(items.values()) +
+        [binder.ident_hash, previous])
+    cursor.execute("""\
+SELECT item, fileid
+FROM collated_file_associations
+WHERE context = %s AND item = ANY (%s)""",
+                   (module_idents[previous],
+                    [module_idents[x] for x in items if x in module_idents],))
+    fileids = dict(cursor.fetchall())
+
+    context = module_idents[binder.ident_hash]
+    args = {}  # {<item>: <fileid>}
+    for previous_item, item in items.items():
+        fileid = fileids.get(module_idents.get(previous_item))
+        if fileid is not None:
+            args[module_idents[item]] = fileid
+    if not args:
+        return
+    # A document that also appears in a re-baked node already has
+    # its collated content.
+    execute_values(cursor, """\
+INSERT INTO collated_file_associations (context, item, fileid)
+VALUES %s
+ON CONFLICT DO NOTHING""", [(context, item, fileid,)
+                            for item, fileid in args.items()],
+                   page_size=len(args))
+
+
+def _bake_incrementally(cursor, binder, previous, recipe, includes,
+                        publisher, message):
+    """Bake the ``binder`` by reusing the baked content of the ``previous``
+    version for the top-level nodes (i.e. chapters or units) that are
+    unchanged and collating only the rest.
+
+    The unchanged nodes are collated as empty placeholders, so that
+    anything numbered by chapter is numbered as it would be in a full bake.
+    This relies on the recipe collating each of the top-level nodes
+    on its own (see ``baking.incremental.print_styles``).
+
+    Returns ``False`` when the book needs to be baked in full,
+    before anything has been published.
+
+    """
+    tree = _get_tree(cursor, binder.ident_hash)
+    previous_tree = _get_tree(cursor, previous)
+    previous_baked_tree = _get_tree(cursor, previous, as_collated=True)
+    if tree is None or previous_tree is None or previous_baked_tree is None \
+       or len(tree['contents']) != len(binder) \
+       or len(previous_baked_tree['contents']) != \
+       len(previous_tree['contents']):
+        return False
+
+    keys = _tree_keys(cursor, tree)
+    previous_keys = _tree_keys(cursor, previous_tree)
+    reused = set([
+        i for i, (node, key) in enumerate(zip(binder, keys))
+        if i < len(previous_keys) and key == previous_keys[i] and
+        isinstance(node, cnxepub.TranslucentBinder) and
+        not isinstance(node, cnxepub.Binder)])
+    if not reused:
+        return False
+
+    skeleton = cnxepub.Binder(
+        binder.id,
+        nodes=[cnxepub.TranslucentBinder(metadata=node.metadata)
+               if i in reused else node
+               for i, node in enumerate(binder)],
+        metadata=binder.metadata,
+        title_overrides=[binder.get_title_for_node(node) for node in binder],
+        resources=binder.resources)
+    baked = collate_models(skeleton, ruleset=recipe, includes=includes)
+    if len(baked) != len(binder):
+        # The recipe added to the book as a whole (e.g. an index).
+        return False
+
+    _publish_baked(cursor, baked,
+                   [node for i, node in enumerate(baked) if i not in reused],
+                   publisher, message)
+
+    baked_tree = cnxepub.model_to_tree(baked)
+    items = {}  # {<previous-ident-hash>: <ident-hash>}
+    for i in sorted(reused):
+        mapping = dict(zip(
+            cnxepub.flatten_tree_to_ident_hashes(previous_tree['contents'][i]),
+            cnxepub.flatten_tree_to_ident_hashes(tree['contents'][i])))
+        baked_node = previous_baked_tree['contents'][i]
+        baked_tree['contents'][i] = _remap_tree(baked_node, mapping)
+        for ident_hash in cnxepub.flatten_tree_to_ident_hashes(baked_node):
+            items[ident_hash] = mapping.get(ident_hash, ident_hash)
+    _reuse_collated_files(cursor, baked, previous, items)
+    publish_collated_tree(cursor, baked_tree)
+    return True
+
+
+@with_db_cursor
+def bake(binder, recipe_id, publisher, message, cursor):
+    """Given a `Binder` as `binder`, bake the contents and
+    persist those changes alongside the published content.
+
+    When ``baking.incremental`` is enabled, the baked content of the last
+    baked version of the book is reused where the book hasn't changed.
+
+    """
+    recipe = _get_recipe(recipe_id, cursor)
+    includes = _formatter_callback_factory()
+
+    previous = _previous_bake(cursor, binder, recipe_id)
+    if previous is not None and _bake_incrementally(
+            cursor, binder, previous, recipe, includes, publisher, message):
+        return []
+
+    binder = collate_models(binder, ruleset=recipe, includes=includes)
+    _publish_baked(cursor, binder, [binder], publisher, message)
 
     tree = cnxepub.model_to_tree(binder)
     publish_collated_tree(cursor, tree)
@@ -92,13 +391,13 @@ def bake(binder, recipe_id, publisher, message, cursor):
 @with_db_cursor
 def remove_baked(binder_ident_hash, cursor):
     """Given a binder's ident_hash, remove the baked results."""
+    module_ident = lookup_module_ident(cursor, binder_ident_hash)
     # Remove the baked tree.
     cursor.execute("""\
     WITH RECURSIVE t(node, path, is_collated) AS (
     SELECT nodeid, ARRAY[nodeid], is_collated
-    FROM trees AS tr, modules AS m
-    WHERE ident_hash(m.uuid, m.major_version, m.minor_version) = %s AND
-      tr.documentid = m.module_ident AND
+    FROM trees AS tr
+    WHERE tr.documentid = %s AND
       tr.parent_id IS NULL AND
       tr.is_collated = TRUE
 UNION ALL
@@ -107,21 +406,16 @@ UNION ALL
     WHERE not nodeid = any (t.path) AND t.is_collated = c1.is_collated
 )
 delete from trees where nodeid in (select node FROM t)
-    """, (binder_ident_hash,))
+    """, (module_ident,))
 
     # Remove the baked/collation associations and composite-modules entries.
     cursor.execute("""\
     DELETE FROM collated_file_associations AS cfa
-    USING modules AS m
-    WHERE
-      (ident_hash(m.uuid, m.major_version, m.minor_version) = %s
-       )
-      AND
-      cfa.context = m.module_ident
-    RETURNING item, fileid""", (binder_ident_hash,))
+    WHERE cfa.context = %s
+    RETURNING item, fileid""", (module_ident,))
     # FIXME (11-May-2016) This can create orphan `files` & `modules` entries,
     #       but since it's not intended to be used in production
     #       this is not a major concern.
 
 
-__all__ = ('bake', 'remove_baked',)
+__all__ = ('bake', 'formatter_fingerprint', 'remove_baked',)
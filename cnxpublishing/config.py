@@ -65,6 +65,7 @@ def configure(settings):
 
     # Create the configuration object
     config = Configurator(settings=settings, root_factory=RootFactory)
+    config.include('.pool')
     config.include('.views')
     config.include('.session')
     config.include('.cache')
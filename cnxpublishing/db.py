@@ -6,11 +6,14 @@
 # See LICENCE.txt for details.
 # ###
 from __future__ import print_function
+import binascii
 import os
 import sys
 import io
 import functools
 import json
+import uuid
+from multiprocessing.pool import ThreadPool
 
 import cnxepub
 import psycopg2
@@ -18,50 +21,87 @@ import jinja2
 from cnxarchive.utils import IdentHashSyntaxError, IdentHashShortId
 from cnxepub import ATTRIBUTED_ROLE_KEYS
 from openstax_accounts.interfaces import IOpenstaxAccounts
-from psycopg2.extras import register_uuid
+from psycopg2.extras import execute_values, register_uuid
 from pyramid.security import has_permission
+from pyramid.settings import asbool
 from pyramid.threadlocal import (
     get_current_request, get_current_registry,
     )
 
 from . import exceptions
+from .cache import cache_manager
 from .config import CONNECTION_STRING
 from .exceptions import (
     DocumentLookupError,
     ResourceFileExceededLimitError,
     UserFetchError,
     )
+from .pool import Connection
+from .statements import register_statement
 from .utils import (parse_archive_uri, parse_user_uri, join_ident_hash,
                     split_ident_hash)
 
 
 END_N_INTERIM_STATES = ('Publishing', 'Done/Success',
                         'Failed/Error', 'Rejected',)
+# Size of the chunks (in bytes) used to stream files to the database.
+COPY_CHUNK_SIZE = 64 * 1024
+# Reference data (licenses, subjects and role types) rarely changes.
+# Cache it for a day; see also ``invalidate_reference_data``.
+REFERENCE_DATA_EXPIRE = 60 * 60 * 24
+# Number of user profiles looked up in accounts at the same time.
+PROFILE_LOOKUP_THREADS = 8
 # FIXME psycopg2 UUID adaptation doesn't seem to be registering
 # itself. Temporarily call it directly.
 register_uuid()
 
+MODULE_IDENTS_LOOKUP = register_statement('module_idents_lookup', """\
+SELECT i.ident_hash, m.module_ident
+FROM unnest(%(ident_hashes)s::text[], %(uuids)s::uuid[],
+            %(major_versions)s::integer[], %(minor_versions)s::integer[])
+     AS i(ident_hash, uuid, major_version, minor_version)
+     JOIN modules AS m
+       ON m.uuid = i.uuid
+          AND m.major_version = i.major_version
+          AND m.minor_version IS NOT DISTINCT FROM i.minor_version""")
+
 
 def db_connect(connection_string=None):
-    """Function to supply a database connection object."""
+    """Function to supply a database connection object.
+    When no ``connection_string`` is given and the application has been
+    configured with a connection pool, the connection is borrowed from
+    the pool and given back when the ``with`` statement exits. Therefore,
+    always use the result of this function as a context manager.
+    """
     if connection_string is None:
-        connection_string = get_current_registry().settings[CONNECTION_STRING]
-    return psycopg2.connect(connection_string)
+        registry = get_current_registry()
+        pool = getattr(registry, 'db_pool', None)
+        if pool is not None:
+            return pool.connection()
+        connection_string = registry.settings[CONNECTION_STRING]
+    return psycopg2.connect(connection_string, connection_factory=Connection)
 
 
 def with_db_cursor(func):
     """Decorator that supplies a cursor to the function.
     This passes in a psycopg2 Cursor as the argument 'cursor'.
     It also accepts a cursor if one is given.
+    Within a web request the request's cursor (``request.db_cursor``)
+    is used, so that the function takes part in the request's transaction.
     """
 
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         if 'cursor' in kwargs or func.func_code.co_argcount == len(args):
             return func(*args, **kwargs)
-        registry = get_current_registry()
-        conn_str = registry.settings[CONNECTION_STRING]
-        with psycopg2.connect(conn_str) as db_connection:
+        request = get_current_request()
+        # Requests created by scripts and celery tasks (i.e. not routed)
+        # are never finished, so they cannot own a transaction.
+        if getattr(request, 'matched_route', None) is not None \
+           and hasattr(request, 'db_cursor'):
+            kwargs['cursor'] = request.db_cursor
+            return func(*args, **kwargs)
+        with db_connect() as db_connection:
             with db_connection.cursor() as cursor:
                 kwargs['cursor'] = cursor
                 return func(*args, **kwargs)
@@ -69,7 +109,6 @@ def with_db_cursor(func):
     return wrapped
 
 
-# FIXME Cache the database query in this function. Cache for forever.
 # TODO Move to cnx-archive.
 def acquire_subject_vocabulary(cursor):
     """Acquire a list of term and identifier values.
@@ -79,15 +118,21 @@ def acquire_subject_vocabulary(cursor):
     return cursor.fetchall()
 
 
-# FIXME Cache the database query in this function. Cache for forever.
-def _role_type_to_db_type(type_):
-    """Translates a role type (a value found in
-    ``cnxepub.ATTRIBUTED_ROLE_KEYS``) to a database compatible
-    value for ``role_types``.
+@cache_manager.cache(expire=REFERENCE_DATA_EXPIRE)
+def obtain_subjects():
+    """Obtain the subject vocabulary terms as a frozenset."""
+    with db_connect() as db_conn:
+        with db_conn.cursor() as cursor:
+            vocab = acquire_subject_vocabulary(cursor)
+    return frozenset([term for term, tagid in vocab])
+
+
+@cache_manager.cache(expire=REFERENCE_DATA_EXPIRE)
+def _obtain_role_types():
+    """Obtain a mapping of role types (values found in
+    ``cnxepub.ATTRIBUTED_ROLE_KEYS``) to ``role_types`` database values.
     """
-    registry = get_current_registry()
-    conn_str = registry.settings[CONNECTION_STRING]
-    with psycopg2.connect(conn_str) as db_conn:
+    with db_connect() as db_conn:
         with db_conn.cursor() as cursor:
             cursor.execute("""\
 WITH unnested_role_types AS (
@@ -95,7 +140,15 @@ WITH unnested_role_types AS (
   ORDER BY role_type ASC)
 SELECT array_agg(role_type)::text[] FROM unnested_role_types""")
             db_types = cursor.fetchone()[0]
-    return dict(zip(cnxepub.ATTRIBUTED_ROLE_KEYS, db_types))[type_]
+    return dict(zip(cnxepub.ATTRIBUTED_ROLE_KEYS, db_types))
+
+
+def _role_type_to_db_type(type_):
+    """Translates a role type (a value found in
+    ``cnxepub.ATTRIBUTED_ROLE_KEYS``) to a database compatible
+    value for ``role_types``.
+    """
+    return _obtain_role_types()[type_]
 
 
 def _dissect_roles(metadata):
@@ -111,97 +164,170 @@ def _dissect_roles(metadata):
     raise StopIteration()
 
 
-def upsert_pending_licensors(cursor, document_id):
-    """Update or insert records for pending license acceptors."""
+def _pending_acceptors(cursor, document_ids):
+    """Given the pending documents (at ``document_ids``),
+    iterate over the roles found in their metadata.
+    Return values are the document's uuid, the role identifier and
+    role type as a tuple.
+    """
     cursor.execute("""\
 SELECT "uuid", "metadata"
 FROM pending_documents
-WHERE id = %s""", (document_id,))
-    uuid_, metadata = cursor.fetchone()
-    acceptors = set([uid for uid, type_ in _dissect_roles(metadata)])
+WHERE id = ANY(%s)""", (list(document_ids),))
+    for uuid_, metadata in cursor.fetchall():
+        for uid, type_ in _dissect_roles(metadata):
+            yield uuid_, uid, type_
 
-    # Acquire a list of existing acceptors.
+
+def _update_pending_acceptance(cursor, document_ids,
+                               licenses=True, roles=True):
+    """Mark the pending documents (at ``document_ids``) that everyone
+    has accepted the license and/or roles of as accepted.
+    """
+    assignments = []
+    if licenses:
+        assignments.append("""\
+license_accepted = pd.license_accepted OR NOT EXISTS (
+  SELECT 1 FROM license_acceptances AS la
+  WHERE la.uuid = pd.uuid AND la.accepted IS NOT TRUE)""")
+    if roles:
+        assignments.append("""\
+roles_accepted = pd.roles_accepted OR NOT EXISTS (
+  SELECT 1 FROM role_acceptances AS ra
+  WHERE ra.uuid = pd.uuid AND ra.accepted IS NOT TRUE)""")
     cursor.execute("""\
-SELECT "user_id", "accepted"
-FROM license_acceptances
-WHERE uuid = %s""", (uuid_,))
-    existing_acceptors_mapping = dict(cursor.fetchall())
+UPDATE pending_documents AS pd
+SET {}
+WHERE pd.id = ANY(%s)""".format(',\n    '.join(assignments)),
+                   (list(document_ids),))
+
+
+def _insert_pending_licensors(cursor, document_ids):
+    acceptors = set([(uuid_, uid,)
+                     for uuid_, uid, _ in _pending_acceptors(cursor,
+                                                             document_ids)])
+    if acceptors:
+        execute_values(cursor, """\
+INSERT INTO license_acceptances ("uuid", "user_id", "accepted")
+VALUES %s
+ON CONFLICT DO NOTHING""", sorted(acceptors),
+                       template="(%s::uuid, %s, NULL)",
+                       page_size=len(acceptors))
+
+
+def _insert_pending_roles(cursor, document_ids):
+    acceptors = set([(uuid_, uid, _role_type_to_db_type(type_),)
+                     for uuid_, uid, type_ in _pending_acceptors(
+                         cursor, document_ids)])
 
-    # Who's not in the existing list?
-    existing_acceptors = set(existing_acceptors_mapping.keys())
-    new_acceptors = acceptors.difference(existing_acceptors)
+    # Upsert the user info.
+    upsert_users(cursor, [x[1] for x in acceptors])
 
-    # Insert the new licensor acceptors.
-    for acceptor in new_acceptors:
-        cursor.execute("""\
-INSERT INTO license_acceptances
-  ("uuid", "user_id", "accepted")
-VALUES (%s, %s, NULL)""", (uuid_, acceptor,))
+    if acceptors:
+        execute_values(cursor, """\
+INSERT INTO role_acceptances ("uuid", "user_id", "role_type", "accepted")
+VALUES %s
+ON CONFLICT DO NOTHING""", sorted(acceptors),
+                       template="(%s::uuid, %s, %s::role_types, NULL)",
+                       page_size=len(acceptors))
 
-    # Has everyone already accepted?
-    cursor.execute("""\
-SELECT user_id
-FROM license_acceptances
-WHERE
-  uuid = %s
-  AND
-  (accepted is UNKNOWN OR accepted is FALSE)""", (uuid_,))
-    defectors = set(cursor.fetchall())
 
-    if not defectors:
-        # Update the pending document license acceptance state.
-        cursor.execute("""\
-update pending_documents set license_accepted = 't'
-where id = %s""", (document_id,))
+def upsert_pending_licensors(cursor, document_id):
+    """Update or insert records for pending license acceptors."""
+    _insert_pending_licensors(cursor, [document_id])
+    _update_pending_acceptance(cursor, [document_id], roles=False)
 
 
 def upsert_pending_roles(cursor, document_id):
     """Update or insert records for pending document role acceptance."""
-    cursor.execute("""\
-SELECT "uuid", "metadata"
-FROM pending_documents
-WHERE id = %s""", (document_id,))
-    uuid_, metadata = cursor.fetchone()
+    _insert_pending_roles(cursor, [document_id])
+    _update_pending_acceptance(cursor, [document_id], licenses=False)
 
-    acceptors = set([(uid, _role_type_to_db_type(type_),)
-                     for uid, type_ in _dissect_roles(metadata)])
 
-    # Upsert the user info.
-    upsert_users(cursor, [x[0] for x in acceptors])
-
-    # Acquire a list of existing acceptors.
-    cursor.execute("""\
-SELECT user_id, role_type
-FROM role_acceptances
-WHERE uuid = %s""", (uuid_,))
-    existing_roles = set([(r, t,) for r, t in cursor.fetchall()])
-
-    # Who's not in the existing list?
-    existing_acceptors = existing_roles
-    new_acceptors = acceptors.difference(existing_acceptors)
-
-    # Insert the new role acceptors.
-    for acceptor, type_ in new_acceptors:
-        cursor.execute("""\
-INSERT INTO role_acceptances
-  ("uuid", "user_id", "role_type", "accepted")
-        VALUES (%s, %s, %s, DEFAULT)""", (uuid_, acceptor, type_))
+def upsert_publication_acceptances(cursor, publication_id,
+                                   document_ids=None):
+    """Update or insert records for the pending license acceptors and
+    role acceptance of all the documents in the publication
+    (at ``publication_id``), or only those listed by id as ``document_ids``.
+    This does for the whole publication what ``upsert_pending_licensors``
+    and ``upsert_pending_roles`` do for one document.
+    """
+    if document_ids is None:
+        cursor.execute("SELECT id FROM pending_documents "
+                       "WHERE publication_id = %s", (publication_id,))
+        document_ids = [x[0] for x in cursor.fetchall()]
+    if not document_ids:
+        return
+    _insert_pending_licensors(cursor, document_ids)
+    _insert_pending_roles(cursor, document_ids)
+    _update_pending_acceptance(cursor, document_ids)
+
+
+class _ByteaCopyStream(object):
+    """A file-like object that reads the binary contents of ``fileobjs``
+    in chunks and renders them as rows of ``COPY`` text format, one per
+    file, containing the file's (one based) position and its contents
+    as a hex encoded bytea value.
+    """
 
-    # Has everyone already accepted?
-    cursor.execute("""\
-SELECT user_id
-FROM role_acceptances
-WHERE
-  uuid = %s
-  AND
-  (accepted is UNKNOWN OR accepted is FALSE)""", (uuid_,))
-    defectors = set(cursor.fetchall())
+    def __init__(self, fileobjs, chunk_size=COPY_CHUNK_SIZE):
+        self._fileobjs = enumerate(fileobjs, 1)
+        self._fileobj = None
+        self._chunk_size = chunk_size
+        self._buffer = b''
 
-    if not defectors:
-        # Update the pending document license acceptance state.
+    def _next_row(self):
+        try:
+            position, self._fileobj = next(self._fileobjs)
+        except StopIteration:
+            self._fileobj = None
+            return False
+        # The bytea hex format prefix, with the backslash escaped for COPY.
+        self._buffer += str(position).encode('ascii') + b'\t\\\\x'
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            if self._fileobj is None and not self._next_row():
+                break
+            chunk = self._fileobj.read(self._chunk_size)
+            if chunk:
+                self._buffer += binascii.hexlify(chunk)
+            else:
+                self._buffer += b'\n'
+                self._fileobj = None
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _copy_bytea(cursor, fileobjs):
+    """Streams the contents of each of the ``fileobjs`` to the database,
+    where they are made available as rows of the ``bytea_stream``
+    temporary table. The table has an ``ord`` column, the (one based)
+    position of the file in ``fileobjs``, and a ``data`` column.
+    The data is sent in chunks, so that it never has to be held
+    in memory as a whole.
+
+    On a ``cnxpublishing.pool.Connection`` the table is only created
+    once and only emptied when it was already used in the transaction.
+    """
+    connection = cursor.connection
+    state = getattr(connection, 'bytea_stream', None)
+    if state is None:
         cursor.execute("""\
-update pending_documents set roles_accepted = 't'
-where id = %s""", (document_id,))
+CREATE TEMPORARY TABLE IF NOT EXISTS bytea_stream (ord INTEGER, data BYTEA)
+ON COMMIT DELETE ROWS""")
+    if state or not hasattr(connection, 'bytea_stream'):
+        # Deleting the few rows of a transaction is lighter
+        # on the catalog than truncating the table.
+        cursor.execute("DELETE FROM bytea_stream")
+    cursor.copy_expert("COPY bytea_stream (ord, data) FROM STDIN",
+                       _ByteaCopyStream(fileobjs),
+                       size=COPY_CHUNK_SIZE * 2)
+    if hasattr(connection, 'bytea_stream'):
+        connection.bytea_stream = True
 
 
 def _get_type_name(model):
@@ -212,54 +338,96 @@ def _get_type_name(model):
         return 'Document'
 
 
-def add_pending_resource(cursor, resource, document=None):
-    settings = get_current_registry().settings
-    args = {
-        'media_type': resource.media_type,
-        'hash': resource.hash,
-        'filename': resource.filename,
-        }
-    with resource.open() as data:
-        upload_limit = settings['file_upload_limit'] * 1024 * 1024
-        if data.seek(0, 2) > upload_limit:
-            raise ResourceFileExceededLimitError(
-                settings['file_upload_limit'], resource.filename)
-        data.seek(0)
-        args['data'] = psycopg2.Binary(data.read())
-
+def lookup_pending_resource_hashes(cursor, hashes):
+    """Given a list of resource hashes, look up which of them are
+    already stored as pending resources.
+    Returns the set of stored hashes.
+    """
+    hashes = list(set(hashes))
+    if not hashes:
+        return set([])
     cursor.execute("""\
+SELECT hash FROM pending_resources WHERE hash = ANY (%s::text[])""",
+                   (hashes,))
+    return set([r[0] for r in cursor.fetchall()])
+
+
+def add_pending_resource(cursor, resource, document=None,
+                         stored_hashes=None):
+    """Adds the resource as a pending resource and associates it with
+    the ``document`` when one is given.
+    See ``add_pending_resources`` for the use of ``stored_hashes``.
+    """
+    add_pending_resources(cursor, [resource], document=document,
+                          stored_hashes=stored_hashes)
+
+
+def _open_resources(resources):
+    for resource in resources:
+        with resource.open() as data:
+            yield data
+
+
+def add_pending_resources(cursor, resources, document=None,
+                          stored_hashes=None):
+    """Adds the resources as pending resources and associates them with
+    the ``document`` when one is given. The data of all the resources
+    is sent to the database at once.
+    The data is only sent to the database when the resource's hash
+    is not in ``stored_hashes`` (see ``lookup_pending_resource_hashes``),
+    which is updated to include the newly stored hashes.
+    """
+    resources = list(resources)
+    settings = get_current_registry().settings
+    upload_limit = settings['file_upload_limit'] * 1024 * 1024
+    missing = {}  # {<hash>: <resource>}
+    for resource in resources:
+        with resource.open() as data:
+            data.seek(0, 2)
+            if data.tell() > upload_limit:
+                raise ResourceFileExceededLimitError(
+                    settings['file_upload_limit'], resource.filename)
+        is_stored = stored_hashes is not None \
+            and resource.hash in stored_hashes
+        if not is_stored:
+            missing.setdefault(resource.hash, resource)
+
+    if missing:
+        missing_resources = [resource for _, resource
+                             in sorted(missing.items())]
+        _copy_bytea(cursor, _open_resources(missing_resources))
+        cursor.execute("""\
 INSERT INTO pending_resources
   (data, hash, media_type, filename)
-VALUES (%(data)s, %(hash)s, %(media_type)s, %(filename)s)
-""", args)
-
-    if document:
-        # upsert document and resource into pending resource associations
+SELECT s.data, r.hash, r.media_type, r.filename
+FROM bytea_stream AS s
+     JOIN unnest(%s::text[], %s::text[], %s::text[])
+          WITH ORDINALITY AS r(hash, media_type, filename, ord)
+          USING (ord)
+ORDER BY ord""", ([x.hash for x in missing_resources],
+                  [x.media_type for x in missing_resources],
+                  [x.filename for x in missing_resources],))
+        if stored_hashes is not None:
+            stored_hashes.update(missing.keys())
+
+    if document and resources:
+        # upsert document and resources into pending resource associations
         cursor.execute("""\
-WITH document AS (
-    SELECT id FROM pending_documents
-    WHERE ident_hash(uuid, major_version, minor_version) = %(id)s
-), resource AS (
-    SELECT id FROM pending_resources
-    WHERE hash = %(hash)s
-)
-INSERT INTO pending_resource_associations
-    (document_id, resource_id)
-    SELECT document.id, resource.id
-    FROM document, resource
-    WHERE NOT EXISTS
-    (SELECT * FROM pending_resource_associations, document, resource
-     WHERE document_id = document.id AND resource_id = resource.id)
-""", {'id': document.ident_hash, 'hash': resource.hash})
-    resource.id = resource.hash
-
-
-# FIXME Cache this this function. There is no reason it needs to run
-#       more than once in a 24hr period.
+INSERT INTO pending_resource_associations (document_id, resource_id)
+SELECT d.id, r.id
+FROM pending_documents AS d, pending_resources AS r
+WHERE ident_hash(d.uuid, d.major_version, d.minor_version) = %s
+      AND r.hash = ANY (%s::text[])
+ON CONFLICT DO NOTHING""", (document.ident_hash,
+                            list(set([x.hash for x in resources])),))
+    for resource in resources:
+        resource.id = resource.hash
+
+
+@cache_manager.cache(expire=REFERENCE_DATA_EXPIRE)
 def obtain_licenses():
     """Obtain the licenses in a dictionary form, keyed by url."""
-    settings = get_current_registry().settings
-    with psycopg2.connect(settings[CONNECTION_STRING]) as db_conn:
+    with db_connect() as db_conn:
         with db_conn.cursor() as cursor:
             cursor.execute("""\
 SELECT combined_row.url, row_to_json(combined_row) FROM (
@@ -269,6 +437,14 @@ SELECT combined_row.url, row_to_json(combined_row) FROM (
     return licenses
 
 
+def invalidate_reference_data():
+    """Drop the cached licenses, subjects and role types, so that they
+    are looked up again on next use.
+    """
+    for func in (obtain_licenses, obtain_subjects, _obtain_role_types,):
+        cache_manager.invalidate(func)
+
+
 def _validate_license(model):
     """Given the model, check the license is one valid for publication."""
     license_mapping = obtain_licenses()
@@ -305,14 +481,14 @@ def _validate_roles(model):
                 raise exceptions.InvalidRole(role_key, role)
 
 
-def _validate_derived_from(cursor, model):
-    """Given a database cursor and model, check the derived-from
-    value accurately points to content in the archive.
-    The value can be nothing or must point to existing content.
+def _parse_derived_from(model):
+    """Given a model, parse the derived-from value into
+    an ident-hash, uuid and version.
+    Returns ``None`` when the model has no derived-from value.
     """
     derived_from_uri = model.metadata.get('derived_from_uri')
     if derived_from_uri is None:
-        return  # bail out early
+        return None
 
     # Can we parse the value?
     try:
@@ -321,22 +497,57 @@ def _validate_derived_from(cursor, model):
     except (ValueError, IdentHashSyntaxError, IdentHashShortId) as exc:
         raise exceptions.InvalidMetadata('derived_from_uri', derived_from_uri,
                                          original_exception=exc)
+    return ident_hash, uuid_, version
+
+
+def _lookup_derived_from(cursor, pointers):
+    """Given a database cursor and a list of ``(uuid, version)`` pointers,
+    check which of them point at existing content in the archive.
+    Returns the set of the pointers' indexes that exist.
+    """
+    indexes, uuids, major_versions, minor_versions, is_versioned = \
+        [], [], [], [], []
+    for i, (uuid_, version) in enumerate(pointers):
+        try:
+            uuid_ = str(uuid.UUID(str(uuid_)))
+        except ValueError:
+            continue  # can't possibly exist
+        indexes.append(i)
+        uuids.append(uuid_)
+        major_versions.append(version[0])
+        minor_versions.append(version[1])
+        is_versioned.append(version != (None, None,))
+    if not indexes:
+        return set([])
+    cursor.execute("""\
+SELECT p.idx
+FROM unnest(%s::integer[], %s::uuid[], %s::integer[], %s::integer[],
+            %s::boolean[])
+     AS p(idx, uuid, major_version, minor_version, is_versioned)
+WHERE EXISTS (
+  SELECT 1 FROM modules AS m
+  WHERE m.uuid = p.uuid
+        AND (NOT p.is_versioned
+             OR (m.major_version = p.major_version
+                 AND m.minor_version IS NOT DISTINCT FROM p.minor_version)))
+""", (indexes, uuids, major_versions, minor_versions, is_versioned,))
+    return set([r[0] for r in cursor.fetchall()])
+
+
+def _validate_derived_from(cursor, model):
+    """Given a database cursor and model, check the derived-from
+    value accurately points to content in the archive.
+    The value can be nothing or must point to existing content.
+    """
+    parsed = _parse_derived_from(model)
+    if parsed is None:
+        return  # bail out early
+    ident_hash, uuid_, version = parsed
+
     # Is the ident-hash a valid pointer?
-    args = [uuid_]
-    table = 'modules'
-    version_condition = ''
-    if version != (None, None,):
-        args.extend(version)
-        table = 'modules'
-        version_condition = " AND major_version = %s" \
-                            " AND minor_version {} %s" \
-                            .format(version[1] is None and 'is' or '=')
-    cursor.execute("""SELECT 't' FROM {} WHERE uuid::text = %s{}"""
-                   .format(table, version_condition), args)
-    try:
-        exists = cursor.fetchone()[0]
-    except TypeError:  # None type
-        raise exceptions.InvalidMetadata('derived_from_uri', derived_from_uri)
+    if not _lookup_derived_from(cursor, [(uuid_, version,)]):
+        raise exceptions.InvalidMetadata(
+            'derived_from_uri', model.metadata['derived_from_uri'])
 
     # Assign the derived_from value so that we don't have to split it again.
     model.metadata['derived_from'] = ident_hash
@@ -346,25 +557,29 @@ def _validate_subjects(cursor, model):
     """Give a database cursor and model, check the subjects against
     the subject vocabulary.
     """
-    subject_vocab = [term[0] for term in acquire_subject_vocabulary(cursor)]
+    subject_vocab = obtain_subjects()
     subjects = model.metadata.get('subjects', [])
     invalid_subjects = [s for s in subjects if s not in subject_vocab]
     if invalid_subjects:
         raise exceptions.InvalidMetadata('subjects', invalid_subjects)
 
 
-def validate_model(cursor, model):
-    """Validates the model using a series of checks on bits of the data."""
-    # Check the license is one valid for publication.
-    _validate_license(model)
-    _validate_roles(model)
-
+def _validate_required_metadata(model):
+    """Given the model, check the required metadata has values."""
     # Other required metadata includes: title, summary
     required_metadata = ('title', 'summary',)
     for metadata_key in required_metadata:
         if model.metadata.get(metadata_key) in [None, '', []]:
             raise exceptions.MissingRequiredMetadata(metadata_key)
 
+
+def validate_model(cursor, model):
+    """Validates the model using a series of checks on bits of the data."""
+    # Check the license is one valid for publication.
+    _validate_license(model)
+    _validate_roles(model)
+    _validate_required_metadata(model)
+
     # Ensure that derived-from values are either None
     # or point at a live record in the archive.
     _validate_derived_from(cursor, model)
@@ -378,14 +593,69 @@ def validate_model(cursor, model):
     #   created, revised, keywords, google_analytics, buylink
 
 
+def _validate_models(cursor, models):
+    """Validates many models at once. This makes the same checks
+    as ``validate_model``, but looks up the derived-from values
+    of all the models in a single query.
+    Returns a dictionary of invalid models to the exception info
+    (i.e. ``sys.exc_info()``) of their validation failure.
+    """
+    failures = {}
+    derived_from = []  # [(<model>, <ident-hash>, <uuid>, <version>), ...]
+    for model in models:
+        try:
+            _validate_license(model)
+            _validate_roles(model)
+            _validate_required_metadata(model)
+            parsed = _parse_derived_from(model)
+        except exceptions.PublicationException:
+            failures[model] = sys.exc_info()
+            continue
+        if parsed is not None:
+            derived_from.append((model,) + parsed)
+
+    # Ensure that derived-from values are either None
+    # or point at a live record in the archive.
+    existing = _lookup_derived_from(
+        cursor, [(uuid_, version,) for _, _, uuid_, version in derived_from])
+    for i, (model, ident_hash, _, _) in enumerate(derived_from):
+        if i in existing:
+            model.metadata['derived_from'] = ident_hash
+            continue
+        try:
+            raise exceptions.InvalidMetadata(
+                'derived_from_uri', model.metadata['derived_from_uri'])
+        except exceptions.PublicationException:
+            failures[model] = sys.exc_info()
+
+    # Are the given 'subjects'
+    for model in models:
+        if model in failures:
+            continue
+        try:
+            _validate_subjects(cursor, model)
+        except exceptions.PublicationException:
+            failures[model] = sys.exc_info()
+    return failures
+
+
 def is_publication_permissible(cursor, publication_id, uuid_):
     """Check the given publisher of this publication given
     by ``publication_id`` is allowed to publish the content given
     by ``uuid``.
     """
+    return str(uuid_) in _permissible_uuids(cursor, publication_id, [uuid_])
+
+
+def _permissible_uuids(cursor, publication_id, uuids):
+    """Check the given publisher of this publication given
+    by ``publication_id`` is allowed to publish the content given
+    by each of the ``uuids``.
+    Returns the set of uuids (as strings) that may be published.
+    """
     # Check the publishing user has permission to publish
     cursor.execute("""\
-SELECT 't'::boolean
+SELECT DISTINCT pd.uuid::text
 FROM
   pending_documents AS pd
   NATURAL JOIN document_acl AS acl
@@ -393,94 +663,157 @@ FROM
 WHERE
   p.id = %s
   AND
-  pd.uuid = %s
+  pd.uuid = ANY (%s::uuid[])
   AND
   p.publisher = acl.user_id
   AND
-  acl.permission = 'publish'""", (publication_id, uuid_,))
-    try:
-        is_allowed = cursor.fetchone()[0]
-    except TypeError:
-        is_allowed = False
-    return is_allowed
-
-
-def add_pending_model(cursor, publication_id, model):
-    """Adds a model (binder or document) that is awaiting publication
-    to the database.
+  acl.permission = 'publish'""",
+                   (publication_id, [str(u) for u in uuids],))
+    return set([r[0] for r in cursor.fetchall()])
+
+
+def _insert_pending_models(cursor, publication_id, models):
+    """Inserts the models as pending documents and assigns each of them
+    an identifier and version. This is done in a fixed number of
+    statements regardless of the number of models.
+    Returns a list of the pending documents' id, uuid and ident-hash
+    in the order of the given models.
+    Raises ``ValueError`` when more than one model has the same uuid.
     """
     # FIXME Too much happening here...
-    assert isinstance(model, (cnxepub.Document, cnxepub.Binder,)), type(model)
-    uri = model.get_uri('cnx-archive')
-
-    if uri is not None:
+    for model in models:
+        assert isinstance(model, (cnxepub.Document, cnxepub.Binder,)), \
+            type(model)
+    if not models:
+        return []
+
+    ids = {}  # {<model>: <uuid>}
+    next_major_versions = {}  # {<model>: <next-major-version>}
+    existing_models = []
+    new_models = []
+    for model in models:
+        uri = model.get_uri('cnx-archive')
+        if uri is None:
+            new_models.append(model)
+            continue
         ident_hash = parse_archive_uri(uri)
         id, version = split_ident_hash(ident_hash, split_version=True)
+        ids[model] = id
+        existing_models.append(model)
+    # The pending documents are paired with the models by uuid,
+    # which must therefore be unique to each model.
+    uuids = [str(ids[model]) for model in existing_models]
+    if len(set(uuids)) != len(uuids):
+        duplicates = sorted(set([u for u in uuids if uuids.count(u) > 1]))
+        raise ValueError("More than one model has the uuid: {}"
+                         .format(', '.join(duplicates)))
+
+    if existing_models:
         cursor.execute("""\
-SELECT major_version + 1 as next_version
-FROM latest_modules
-WHERE uuid = %s
-UNION ALL
-SELECT 1 as next_version
-ORDER BY next_version DESC
-LIMIT 1
-""", (id,))
-        next_major_version = cursor.fetchone()[0]
-        if isinstance(model, cnxepub.Document):
-            version = (next_major_version, None,)
-        else:  # ...assume it's a binder.
-            version = (next_major_version, 1,)
-    else:
+SELECT u.ord, COALESCE(lm.major_version + 1, 1) AS next_version
+FROM unnest(%s::uuid[]) WITH ORDINALITY AS u(uuid, ord)
+     LEFT JOIN latest_modules AS lm ON (lm.uuid = u.uuid)
+""", ([ids[model] for model in existing_models],))
+        versions = dict(cursor.fetchall())
+        for i, model in enumerate(existing_models, 1):
+            next_major_versions[model] = versions[i]
+
+    if new_models:
         cursor.execute("""\
 WITH
 control_insert AS (
-  INSERT INTO document_controls (uuid) VALUES (DEFAULT) RETURNING uuid),
+  INSERT INTO document_controls (uuid)
+  SELECT uuid_generate_v4() FROM generate_series(1, %s)
+  RETURNING uuid),
 acl_insert AS (
   INSERT INTO document_acl (uuid, user_id, permission)
-  VALUES ((SELECT uuid FROM control_insert),
-          (SELECT publisher FROM publications WHERE id = %s),
-          'publish'::permission_type))
-SELECT uuid FROM control_insert""", (publication_id,))
-        id = cursor.fetchone()[0]
+  SELECT uuid,
+         (SELECT publisher FROM publications WHERE id = %s),
+         'publish'::permission_type
+  FROM control_insert)
+SELECT uuid FROM control_insert""", (len(new_models), publication_id,))
+        for model, (id,) in zip(new_models, cursor.fetchall()):
+            ids[model] = id
+
+    rows = []
+    for model in models:
+        id = ids[model]
+        major_version = next_major_versions.get(model, 1)
         if isinstance(model, cnxepub.Document):
-            version = (1, None,)
+            version = (major_version, None,)
         else:  # ...assume it's a binder.
-            version = (1, 1,)
+            version = (major_version, 1,)
 
-    type_ = _get_type_name(model)
-    model.id = str(id)
-    model.metadata['version'] = '.'.join([str(v) for v in version if v])
-    args = [publication_id, id, version[0], version[1], type_,
-            json.dumps(model.metadata)]
-    cursor.execute("""\
+        type_ = _get_type_name(model)
+        model.id = str(id)
+        model.metadata['version'] = '.'.join([str(v) for v in version if v])
+        rows.append((publication_id, id, version[0], version[1], type_,
+                     json.dumps(model.metadata),))
+
+    execute_values(cursor, """\
 INSERT INTO "pending_documents"
   ("publication_id", "uuid", "major_version", "minor_version", "type",
     "license_accepted", "roles_accepted", "metadata")
-VALUES (%s, %s, %s, %s, %s, 'f', 'f', %s)
+SELECT publication_id, uuid, major_version, minor_version, type,
+       'f', 'f', metadata
+FROM (VALUES %s) AS v(publication_id, uuid, major_version,
+                      minor_version, type, metadata)
 RETURNING "id", "uuid", module_version("major_version", "minor_version")
-""", args)
-    pending_id, uuid_, version = cursor.fetchone()
-    pending_ident_hash = join_ident_hash(uuid_, version)
+""", rows, template="(%s, %s::uuid, %s::integer, %s::integer, "
+                   "%s::document_types, %s::json)",
+                   page_size=len(rows))
+    pending = dict([(str(row[1]), row,) for row in cursor.fetchall()])
 
-    # Assign the new ident-hash to the document for later use.
     request = get_current_request()
-    path = request.route_path('get-content', ident_hash=pending_ident_hash)
-    model.set_uri('cnx-archive', path)
-
-    # Check if the publication is allowed for the publishing user.
-    if not is_publication_permissible(cursor, publication_id, id):
-        # Set the failure but continue the operation of inserting
-        # the pending document.
-        exc = exceptions.NotAllowed(id)
-        exc.publication_id = publication_id
-        exc.pending_document_id = pending_id
-        exc.pending_ident_hash = pending_ident_hash
-        set_publication_failure(cursor, exc)
+    results = []
+    for model in models:
+        pending_id, uuid_, version = pending[str(ids[model])]
+        pending_ident_hash = join_ident_hash(uuid_, version)
+        # Assign the new ident-hash to the document for later use.
+        path = request.route_path('get-content',
+                                  ident_hash=pending_ident_hash)
+        model.set_uri('cnx-archive', path)
+        results.append((pending_id, uuid_, pending_ident_hash,))
+    return results
 
-    try:
-        validate_model(cursor, model)
-    except exceptions.PublicationException as exc:
-        exc_info = sys.exc_info()
+
+def add_pending_model(cursor, publication_id, model):
+    """Adds a model (binder or document) that is awaiting publication
+    to the database.
+    """
+    return add_pending_models(cursor, publication_id, [model])[0]
+
+
+def add_pending_models(cursor, publication_id, models):
+    """Adds the models (binders or documents) that are awaiting publication
+    to the database. The models are validated together, which
+    saves a round trip to the database per model.
+    Returns a list of pending ident-hashes in the order of the given models.
+    """
+    pending = _insert_pending_models(cursor, publication_id, models)
+
+    permissible_uuids = _permissible_uuids(
+        cursor, publication_id, [uuid_ for _, uuid_, _ in pending])
+    failures = _validate_models(cursor, models)
+
+    valid_ids = []
+    for model, (pending_id, uuid_, pending_ident_hash) in zip(models, pending):
+        # Check if the publication is allowed for the publishing user.
+        if str(uuid_) not in permissible_uuids:
+            # Set the failure but continue the operation of inserting
+            # the pending document.
+            exc = exceptions.NotAllowed(model.id)
+            exc.publication_id = publication_id
+            exc.pending_document_id = pending_id
+            exc.pending_ident_hash = pending_ident_hash
+            set_publication_failure(cursor, exc)
+
+        try:
+            exc_info = failures[model]
+        except KeyError:
+            valid_ids.append(pending_id)
+            continue
+        exc = exc_info[1]
         exc.publication_id = publication_id
         exc.pending_document_id = pending_id
         exc.pending_ident_hash = pending_ident_hash
@@ -496,11 +829,65 @@ RETURNING "id", "uuid", module_version("major_version", "minor_version")
             traceback.print_exc()
             # Raise the previous exception, so we know the original cause.
             raise exc_info[0], exc_info[1], exc_info[2]
-    else:
-        upsert_pending_licensors(cursor, pending_id)
-        upsert_pending_roles(cursor, pending_id)
+
+    upsert_publication_acceptances(cursor, publication_id, valid_ids)
+    for pending_id in valid_ids:
         notify_users(cursor, pending_id)
-    return pending_ident_hash
+    return [pending_ident_hash for _, _, pending_ident_hash in pending]
+
+
+def lookup_module_idents(cursor, ident_hashes):
+    """Given a database cursor and a sequence of ident-hashes,
+    look up the ``module_ident`` of each published module.
+    Returns a mapping of ident-hash to ``module_ident``. Ident-hashes
+    that do not point at a specific version of a published module
+    are left out of the mapping.
+
+    The ident-hashes are split here rather than in the query, so that
+    the lookup is done on the ``uuid`` and version columns. The results
+    are remembered on the connection for the rest of the transaction.
+    """
+    memo = getattr(cursor.connection, 'module_idents', {})
+    found, missing = {}, []
+    for ident_hash in set(ident_hashes):
+        if ident_hash in memo:
+            found[ident_hash] = memo[ident_hash]
+            continue
+        try:
+            uuid_, version = split_ident_hash(ident_hash, split_version=True)
+            uuid_ = str(uuid.UUID(str(uuid_)))
+        except (ValueError, IdentHashSyntaxError, IdentHashShortId):
+            continue  # can't possibly exist
+        if version[0] is None:
+            continue  # only a specific version has a module_ident
+        missing.append((ident_hash, uuid_, version[0], version[1],))
+    if missing:
+        columns = [list(column) for column in zip(*missing)]
+        MODULE_IDENTS_LOOKUP.execute(cursor, dict(zip(
+            ('ident_hashes', 'uuids', 'major_versions', 'minor_versions',),
+            columns)))
+        idents = dict(cursor.fetchall())
+        memo.update(idents)
+        found.update(idents)
+    return found
+
+
+def remember_module_ident(cursor, ident_hash, module_ident):
+    """Given a database cursor, remember the ``module_ident`` of a module
+    inserted in the current transaction, so that lookups of its
+    ident-hash (see ``lookup_module_idents``) need not query for it.
+    """
+    memo = getattr(cursor.connection, 'module_idents', None)
+    if memo is not None:
+        memo[ident_hash] = module_ident
+
+
+def lookup_module_ident(cursor, ident_hash):
+    """Given a database cursor and an ident-hash, look up the
+    ``module_ident`` of the published module.
+    Returns ``None`` when there is no such module.
+    """
+    return lookup_module_idents(cursor, [ident_hash]).get(ident_hash)
 
 
 def lookup_document_pointer(ident_hash, cursor):
@@ -523,11 +910,13 @@ def lookup_document_pointer(ident_hash, cursor):
     return cnxepub.DocumentPointer(ident_hash, metadata)
 
 
-def add_pending_model_content(cursor, publication_id, model):
+def add_pending_model_content(cursor, publication_id, model,
+                              stored_hashes=None):
     """Updates the pending model's content.
     This is a secondary step not in ``add_pending_model, because
     content reference resolution requires the identifiers as they
     will appear in the end publication.
+    See ``add_pending_resources`` for the use of ``stored_hashes``.
     """
     cursor.execute("""\
         SELECT id, ident_hash(uuid, major_version, minor_version)
@@ -552,8 +941,8 @@ def add_pending_model_content(cursor, publication_id, model):
         attach_info_to_exception(exc)
         set_publication_failure(cursor, exc)
 
-    for resource in getattr(model, 'resources', []):
-        add_pending_resource(cursor, resource, document=model)
+    add_pending_resources(cursor, getattr(model, 'resources', []),
+                          document=model, stored_hashes=stored_hashes)
 
     if isinstance(model, cnxepub.Document):
         for reference in model.references:
@@ -654,102 +1043,134 @@ UPDATE publications SET ("state", "state_messages") = (%s, %s)
 WHERE id = %s""", ('Failed/Error', state_messages, publication_id,))
 
 
-def add_publication(cursor, epub, epub_file, is_pre_publication=False):
-    """Adds a publication entry and makes each item
-    a pending document.
+def spool_publication(cursor, epub, epub_file, is_pre_publication=False):
+    """Adds a publication entry for the given ``epub``, storing the
+    ``epub_file`` with it. Returns the publication's id.
     """
     publisher = epub[0].metadata['publisher']
     publish_message = epub[0].metadata['publication_message']
-    epub_binary = psycopg2.Binary(epub_file.read())
-    args = (publisher, publish_message, epub_binary, is_pre_publication,)
+    # Stream the file, rather than reading it into memory.
+    _copy_bytea(cursor, [epub_file])
+    args = (publisher, publish_message, is_pre_publication,)
     cursor.execute("""\
 INSERT INTO publications
   ("publisher", "publication_message", "epub", "is_pre_publication")
-VALUES (%s, %s, %s, %s)
+SELECT %s, %s, data, %s
+FROM bytea_stream
 RETURNING id
 """, args)
-    publication_id = cursor.fetchone()[0]
+    return cursor.fetchone()[0]
+
+
+def add_publication_models(cursor, publication_id, epub, progress=None):
+    """Makes each item of the ``epub`` a pending document
+    of the publication. Returns a mapping of the items' ids to the
+    pending ident-hashes.
+
+    ``progress``, when given, is called with the number of models
+    processed and the total number of models as each model is stored.
+    """
     insert_mapping = {}
 
-    models = set([])
+    # The models are kept in order, with a set for the membership checks.
+    models = []
+    seen = set()
     for package in epub:
         binder = cnxepub.adapt_package(package)
-        if binder in models:
+        if binder in seen:
             continue
         for document in cnxepub.flatten_to_documents(binder):
-            if document not in models:
-                ident_hash = add_pending_model(
-                    cursor, publication_id, document)
-                insert_mapping[document.id] = ident_hash
-                models.add(document)
+            if document not in seen:
+                models.append(document)
+                seen.add(document)
         # The binding object could be translucent/see-through,
         # (case for a binder that only contains loose-documents).
         # Otherwise we should also publish the the binder.
         if not binder.is_translucent:
-            ident_hash = add_pending_model(cursor, publication_id, binder)
-            insert_mapping[binder.id] = ident_hash
-            models.add(binder)
-    for model in models:
+            models.append(binder)
+            seen.add(binder)
+    # Validate and insert all the models in one go.
+    ident_hashes = add_pending_models(cursor, publication_id, models)
+    for model, ident_hash in zip(models, ident_hashes):
+        insert_mapping[model.id] = ident_hash
+    # Resources are often shared between documents and publications.
+    # Only the resources that have not yet been stored are uploaded.
+    stored_hashes = lookup_pending_resource_hashes(
+        cursor, [resource.hash for model in models
+                 for resource in getattr(model, 'resources', [])])
+    for i, model in enumerate(models):
         # Now that all models have been given an identifier
         # we can write the content to the database.
         try:
-            add_pending_model_content(cursor, publication_id, model)
+            add_pending_model_content(cursor, publication_id, model,
+                                      stored_hashes=stored_hashes)
         except ResourceFileExceededLimitError as e:
             e.publication_id = publication_id
             set_publication_failure(cursor, e)
-    return publication_id, insert_mapping
+        if progress is not None:
+            progress(i + 1, len(models))
+    return insert_mapping
 
 
-def _check_pending_document_license_state(cursor, document_id):
-    """Check the aggregate state on the pending document."""
-    cursor.execute("""\
-SELECT BOOL_AND(accepted IS TRUE)
-FROM
-  pending_documents AS pd,
-  license_acceptances AS la
-WHERE
-  pd.id = %s
-  AND
-  pd.uuid = la.uuid""",
-                   (document_id,))
-    try:
-        is_accepted = cursor.fetchone()[0]
-    except TypeError:
-        # There are no licenses associated with this document.
-        is_accepted = True
-    return is_accepted
+def add_publication(cursor, epub, epub_file, is_pre_publication=False):
+    """Adds a publication entry and makes each item
+    a pending document.
+    """
+    publication_id = spool_publication(cursor, epub, epub_file,
+                                       is_pre_publication)
+    insert_mapping = add_publication_models(cursor, publication_id, epub)
+    return publication_id, insert_mapping
 
 
-def _check_pending_document_role_state(cursor, document_id):
-    """Check the aggregate state on the pending document."""
+def _evaluate_pending_document_states(cursor, publication_id):
+    """Evaluate the license and role acceptance state of every pending
+    document in the publication (``publication_id``) and persist the
+    states that have changed.
+    Returns a mapping of pending document id to a list of the license
+    and role acceptance states. A state is ``None`` when there is
+    nothing to accept.
+    """
+    # A state that has been accepted stays accepted, otherwise the
+    # aggregate state of the document's acceptances is used.
     cursor.execute("""\
-SELECT BOOL_AND(accepted IS TRUE)
+SELECT
+  pd.id, pd.license_accepted, pd.roles_accepted,
+  la.accepted, ra.accepted
 FROM
-  role_acceptances AS ra,
-  pending_documents as pd
-WHERE
-  pd.id = %s
-  AND
-  pd.uuid = ra.uuid""",
-                   (document_id,))
-    try:
-        is_accepted = cursor.fetchone()[0]
-    except TypeError:
-        # There are no roles to accept
-        is_accepted = True
-    return is_accepted
-
-
-def _update_pending_document_state(cursor, document_id, is_license_accepted,
-                                   are_roles_accepted):
-    """Update the state of the document's state values."""
-    args = (bool(is_license_accepted), bool(are_roles_accepted),
-            document_id,)
-    cursor.execute("""\
-UPDATE pending_documents
-SET (license_accepted, roles_accepted) = (%s, %s)
-WHERE id = %s""",
-                   args)
+  pending_documents AS pd
+  LEFT JOIN LATERAL (
+    SELECT BOOL_AND(accepted IS TRUE) AS accepted
+    FROM license_acceptances
+    WHERE uuid = pd.uuid) AS la ON (pd.license_accepted IS NOT TRUE)
+  LEFT JOIN LATERAL (
+    SELECT BOOL_AND(accepted IS TRUE) AS accepted
+    FROM role_acceptances
+    WHERE uuid = pd.uuid) AS ra ON (pd.roles_accepted IS NOT TRUE)
+WHERE pd.publication_id = %s""", (publication_id,))
+    states = {}
+    changed = []
+    for row in cursor.fetchall():
+        id, is_license_accepted, are_roles_accepted = row[:3]
+        if not is_license_accepted:
+            is_license_accepted = row[3]
+        if not are_roles_accepted:
+            are_roles_accepted = row[4]
+        states[id] = [is_license_accepted, are_roles_accepted]
+        if (bool(is_license_accepted), bool(are_roles_accepted),) \
+           != (bool(row[1]), bool(row[2]),):
+            changed.append((id, bool(is_license_accepted),
+                            bool(are_roles_accepted),))
+
+    if changed:
+        ids, license_states, role_states = [list(x) for x in zip(*changed)]
+        cursor.execute("""\
+UPDATE pending_documents AS pd
+SET (license_accepted, roles_accepted) = (s.license_accepted,
+                                          s.roles_accepted)
+FROM unnest(%s::integer[], %s::boolean[], %s::boolean[])
+     AS s(id, license_accepted, roles_accepted)
+WHERE pd.id = s.id""", (ids, license_states, role_states,))
+    return states
 
 
 @with_db_cursor
@@ -791,39 +1212,8 @@ WHERE id = %s""", (publication_id,))
         return current_state, messages
 
     # Check for acceptance...
-    cursor.execute("""\
-SELECT
-  pd.id, license_accepted, roles_accepted
-FROM publications AS p JOIN pending_documents AS pd ON p.id = pd.publication_id
-WHERE p.id = %s
-""", (publication_id,))
-    pending_document_states = cursor.fetchall()
-    publication_state_mapping = {}
-    for document_state in pending_document_states:
-        id, is_license_accepted, are_roles_accepted = document_state
-        publication_state_mapping[id] = [is_license_accepted,
-                                         are_roles_accepted]
-        has_changed_state = False
-        if is_license_accepted and are_roles_accepted:
-            continue
-        if not is_license_accepted:
-            accepted = _check_pending_document_license_state(
-                cursor, id)
-            if accepted != is_license_accepted:
-                has_changed_state = True
-                is_license_accepted = accepted
-                publication_state_mapping[id][0] = accepted
-        if not are_roles_accepted:
-            accepted = _check_pending_document_role_state(
-                cursor, id)
-            if accepted != are_roles_accepted:
-                has_changed_state = True
-                are_roles_accepted = accepted
-                publication_state_mapping[id][1] = accepted
-        if has_changed_state:
-            _update_pending_document_state(cursor, id,
-                                           is_license_accepted,
-                                           are_roles_accepted)
+    publication_state_mapping = _evaluate_pending_document_states(
+        cursor, publication_id)
 
     # Are all the documents ready for publication?
     state_lump = set([l and r for l, r in publication_state_mapping.values()])
@@ -880,17 +1270,14 @@ RETURNING state, state_messages""", (change_state, publication_id,))
     return publication_state, messages
 
 
-def check_publication_state(publication_id):
+@with_db_cursor
+def check_publication_state(publication_id, cursor):
     """Check the publication's current state."""
-    registry = get_current_registry()
-    conn_str = registry.settings[CONNECTION_STRING]
-    with psycopg2.connect(conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor.execute("""\
 SELECT "state", "state_messages"
 FROM publications
 WHERE id = %s""", (publication_id,))
-            publication_state, publication_messages = cursor.fetchone()
+    publication_state, publication_messages = cursor.fetchone()
     return publication_state, publication_messages
 
 
@@ -926,6 +1313,26 @@ def _reassemble_binder(id, tree, metadata):
     return binder
 
 
+def _load_pending_resources(cursor, hashes):
+    """Given a list of resource hashes, load the pending resources.
+    Returns a dictionary of hashes to ``cnxepub.Resource`` objects.
+    """
+    hashes = list(set(hashes))
+    if not hashes:
+        return {}
+    # The resources shared by several documents are loaded once,
+    # in one query.
+    cursor.execute("""\
+SELECT hash, data, media_type
+FROM pending_resources
+WHERE hash = ANY (%s::text[])""", (hashes,))
+    resources = {}
+    for hash, data, media_type in cursor.fetchall():
+        resources[hash] = cnxepub.Resource(
+            hash, io.BytesIO(data), media_type, filename=hash)
+    return resources
+
+
 def publish_pending(cursor, publication_id):
     """Given a publication id as ``publication_id``,
     write the documents to the *Connexions Archive*.
@@ -950,6 +1357,7 @@ WHERE id = %s""",
 SELECT id, uuid, major_version, minor_version, metadata, content
 FROM pending_documents
 WHERE type = %s AND publication_id = %s""", (type_, publication_id,))
+    documents = []
     for row in cursor.fetchall():
         # FIXME Oof, this is hideous!
         id, major_version, minor_version = row[1:4]
@@ -962,16 +1370,21 @@ WHERE type = %s AND publication_id = %s""", (type_, publication_id,))
         metadata['version'] = version
 
         document = cnxepub.Document(id, content, metadata)
+        documents.append(document)
+
+    # Load the resources of all the documents in one go. A resource
+    # used by many documents is loaded (and held in memory) once.
+    hashes = set([ref.uri[len('/resources/'):]
+                  for document in documents
+                  for ref in document.references
+                  if ref.uri.startswith('/resources/')])
+    resources = _load_pending_resources(cursor, hashes)
+
+    for document in documents:
         for ref in document.references:
             if ref.uri.startswith('/resources/'):
                 hash = ref.uri[len('/resources/'):]
-                cursor.execute("""\
-SELECT data, media_type
-FROM pending_resources
-WHERE hash = %s""", (hash,))
-                data, media_type = cursor.fetchone()
-                document.resources.append(cnxepub.Resource(
-                    hash, io.BytesIO(data[:]), media_type, filename=hash))
+                document.resources.append(resources[hash])
 
         ident_hash = publish_model(cursor, document, publisher, message)
         all_models.append(document)
@@ -1004,8 +1417,15 @@ WHERE ident_hash(uuid, major_version, minor_version) = %s""",
         all_models.append(binder)
 
     # Republish binders containing shared documents.
-    from .publish import republish_binders
-    republished_ident_hashes = republish_binders(cursor, all_models)
+    settings = get_current_registry().settings or {}
+    if asbool(settings.get('republishing.parallel', False)):
+        from .publish import republish_binders_in_parallel
+        if republish_binders_in_parallel(cursor, publication_id, all_models):
+            # The state is updated once the binders have been republished.
+            return 'Publishing'
+    else:
+        from .publish import republish_binders
+        republished_ident_hashes = republish_binders(cursor, all_models)
 
     # Lastly, update the publication status.
     cursor.execute("""\
@@ -1017,11 +1437,23 @@ RETURNING state""", (publication_id,))
     return state
 
 
+def notify_publication_acceptance(cursor, publication_id):
+    """Notify the channel processor that the acceptances of the
+    publication (at ``publication_id``) have changed, so that it pokes
+    at the publication's state. The notification is only delivered
+    once the transaction is committed.
+    """
+    cursor.execute("SELECT pg_notify('publication_acceptance', %s)",
+                   (json.dumps({'publication_id': int(publication_id)}),))
+
+
 def accept_publication_license(cursor, publication_id, user_id,
-                               document_ids, is_accepted=False):
+                               document_ids, is_accepted=False, notify=False):
     """Accept or deny  the document license for the publication
     (``publication_id``) and user (at ``user_id``)
     for the documents (listed by id as ``document_ids``).
+    When ``notify`` is true, the channel processor is notified of the
+    change (see ``notify_publication_acceptance``).
     """
     cursor.execute("""\
 UPDATE license_acceptances AS la
@@ -1036,13 +1468,17 @@ WHERE
   AND
   pd.uuid = la.uuid""",
                    (is_accepted, publication_id, user_id, document_ids,))
+    if notify:
+        notify_publication_acceptance(cursor, publication_id)
 
 
 def accept_publication_role(cursor, publication_id, user_id,
-                            document_ids, is_accepted=False):
+                            document_ids, is_accepted=False, notify=False):
     """Accept or deny  the document role attribution for the publication
     (``publication_id``) and user (at ``user_id``)
     for the documents (listed by id as ``document_ids``).
+    When ``notify`` is true, the channel processor is notified of the
+    change (see ``notify_publication_acceptance``).
     """
     cursor.execute("""\
 UPDATE role_acceptances AS ra
@@ -1057,6 +1493,8 @@ WHERE
   AND
   pd.uuid = ra.uuid""",
                    (is_accepted, publication_id, user_id, document_ids,))
+    if notify:
+        notify_publication_acceptance(cursor, publication_id)
 
 
 def upsert_license_requests(cursor, uuid_, roles):
@@ -1067,50 +1505,22 @@ def upsert_license_requests(cursor, uuid_, roles):
     if not isinstance(roles, (list, set, tuple,)):
         raise TypeError("``roles`` is an invalid type: {}".format(type(roles)))
 
-    acceptors = set([x['uid'] for x in roles])
+    # The first mention of a user wins.
+    acceptors = {}
+    for x in roles:
+        acceptors.setdefault(x['uid'], x.get('has_accepted', None))
+    if not acceptors:
+        return
 
-    # Acquire a list of existing acceptors.
-    cursor.execute("""\
-SELECT user_id, accepted FROM license_acceptances WHERE uuid = %s""",
-                   (uuid_,))
-    existing_acceptors = cursor.fetchall()
-
-    # Who's not in the existing list?
-    new_acceptors = acceptors.difference([x[0] for x in existing_acceptors])
-
-    # Insert the new licensor acceptors.
-    if new_acceptors:
-        args = []
-        values_fmt = []
-        for uid in new_acceptors:
-            has_accepted = [x.get('has_accepted', None)
-                            for x in roles
-                            if uid == x['uid']][0]
-            args.extend([uuid_, uid, has_accepted])
-            values_fmt.append("(%s, %s, %s)")
-        values_fmt = ', '.join(values_fmt)
-        cursor.execute("""\
+    execute_values(cursor, """\
 INSERT INTO license_acceptances (uuid, user_id, accepted)
-VALUES {}""".format(values_fmt), args)
-
-    # Update any existing license acceptors
-    acceptors = set([
-        (x['uid'], x.get('has_accepted', None),)
-        for x in roles
-        # Prevent updating newly inserted records.
-        if (x['uid'], x.get('has_accepted', None),) not in new_acceptors
-        ])
-    existing_acceptors = set([
-        x for x in existing_acceptors
-        # Prevent updating newly inserted records.
-        if x[0] not in new_acceptors
-        ])
-    tobe_updated_acceptors = acceptors.difference(existing_acceptors)
-
-    for uid, has_accepted in tobe_updated_acceptors:
-            cursor.execute("""\
-UPDATE license_acceptances SET accepted = %s
-WHERE uuid = %s AND user_id = %s""", (has_accepted, uuid_, uid,))
+VALUES %s
+ON CONFLICT (uuid, user_id) DO UPDATE
+SET accepted = EXCLUDED.accepted""",
+                   [(uuid_, uid, has_accepted,)
+                    for uid, has_accepted in sorted(acceptors.items())],
+                   template="(%s::uuid, %s, %s::boolean)",
+                   page_size=len(acceptors))
 
 
 def remove_license_requests(cursor, uuid_, uids):
@@ -1138,47 +1548,24 @@ def upsert_role_requests(cursor, uuid_, roles):
         raise TypeError("``roles`` is an invalid type: {}"
                         .format(type(roles)))
 
-    acceptors = set([(x['uid'], x['role'],) for x in roles])
+    # The first mention of a user's role wins.
+    acceptors = {}
+    for x in roles:
+        acceptors.setdefault((x['uid'], x['role'],),
+                             x.get('has_accepted', None))
+    if not acceptors:
+        return
 
-    # Acquire a list of existing acceptors.
-    cursor.execute("""\
-SELECT user_id, role_type, accepted
-FROM role_acceptances
-WHERE uuid = %s""", (uuid_,))
-    existing_roles = cursor.fetchall()
-
-    # Who's not in the existing list?
-    existing_acceptors = set([(r, t,) for r, t, _ in existing_roles])
-    new_acceptors = acceptors.difference(existing_acceptors)
-
-    # Insert the new role acceptors.
-    for acceptor, type_ in new_acceptors:
-        has_accepted = [x.get('has_accepted', None)
-                        for x in roles
-                        if acceptor == x['uid'] and type_ == x['role']][0]
-        cursor.execute("""\
+    execute_values(cursor, """\
 INSERT INTO role_acceptances ("uuid", "user_id", "role_type", "accepted")
-VALUES (%s, %s, %s, %s)""", (uuid_, acceptor, type_, has_accepted,))
-
-    # Update any existing license acceptors
-    acceptors = set([
-        (x['uid'], x['role'], x.get('has_accepted', None),)
-        for x in roles
-        # Prevent updating newly inserted records.
-        if (x['uid'], x.get('has_accepted', None),) not in new_acceptors
-        ])
-    existing_acceptors = set([
-        x for x in existing_roles
-        # Prevent updating newly inserted records.
-        if (x[0], x[1],) not in new_acceptors
-        ])
-    tobe_updated_acceptors = acceptors.difference(existing_acceptors)
-
-    for uid, type_, has_accepted in tobe_updated_acceptors:
-        cursor.execute("""\
-UPDATE role_acceptances SET accepted = %s
-WHERE uuid = %s AND user_id = %s AND role_type = %s""",
-                       (has_accepted, uuid_, uid, type_,))
+VALUES %s
+ON CONFLICT (uuid, user_id, role_type) DO UPDATE
+SET accepted = EXCLUDED.accepted""",
+                   [(uuid_, uid, type_, has_accepted,)
+                    for (uid, type_), has_accepted
+                    in sorted(acceptors.items())],
+                   template="(%s::uuid, %s, %s::role_types, %s::boolean)",
+                   page_size=len(acceptors))
 
 
 def remove_role_requests(cursor, uuid_, roles):
@@ -1192,11 +1579,54 @@ def remove_role_requests(cursor, uuid_, roles):
     acceptors = set([(x['uid'], x['role'],) for x in roles])
 
     # Remove the the entries.
-    for uid, role_type in acceptors:
-        cursor.execute("""\
-DELETE FROM role_acceptances
-WHERE uuid = %s AND user_id = %s AND role_type = %s""",
-                       (uuid_, uid, role_type,))
+    cursor.execute("""\
+DELETE FROM role_acceptances AS ra
+USING unnest(%s::text[], %s::role_types[]) AS r(user_id, role_type)
+WHERE
+  ra.uuid = %s
+  AND ra.user_id = r.user_id
+  AND ra.role_type = r.role_type""",
+                   ([uid for uid, _ in acceptors],
+                    [type_ for _, type_ in acceptors],
+                    uuid_,))
+
+
+def upsert_acls(cursor, entries):
+    """Given a set of access control entries given as a tuple of
+    ``uuid``, ``uid`` and ``permission``, upsert them into the database.
+    Returns the number of entries that were added.
+    """
+    entries = set(entries)
+    if not entries:
+        return 0
+    uuids, uids, permissions = zip(*entries)
+    cursor.execute("""\
+INSERT INTO document_acl ("uuid", "user_id", "permission")
+SELECT *
+FROM unnest(%s::uuid[], %s::text[], %s::permission_type[])
+ON CONFLICT DO NOTHING""", (list(uuids), list(uids), list(permissions),))
+    return cursor.rowcount
+
+
+def remove_acls(cursor, entries):
+    """Given a set of access control entries given as a tuple of
+    ``uuid``, ``uid`` and ``permission``, remove them from the database.
+    Returns the number of entries that were removed.
+    """
+    entries = set(entries)
+    if not entries:
+        return 0
+    uuids, uids, permissions = zip(*entries)
+    cursor.execute("""\
+DELETE FROM document_acl AS acl
+USING unnest(%s::uuid[], %s::text[], %s::permission_type[])
+  AS e(uuid, user_id, permission)
+WHERE
+  acl.uuid = e.uuid
+  AND acl.user_id = e.user_id
+  AND acl.permission = e.permission""",
+                   (list(uuids), list(uids), list(permissions),))
+    return cursor.rowcount
 
 
 def upsert_acl(cursor, uuid_, permissions):
@@ -1207,24 +1637,8 @@ def upsert_acl(cursor, uuid_, permissions):
         raise TypeError("``permissions`` is an invalid type: {}"
                         .format(type(permissions)))
 
-    permissions = set(permissions)
-
-    # Acquire the existin ACL.
-    cursor.execute("""\
-SELECT user_id, permission
-FROM document_acl
-WHERE uuid = %s""", (uuid_,))
-    existing = set([(r, t,) for r, t in cursor.fetchall()])
-
-    # Who's not in the existing list?
-    new_entries = permissions.difference(existing)
-
-    # Insert the new permissions.
-    for uid, permission in new_entries:
-        cursor.execute("""\
-INSERT INTO document_acl
-  ("uuid", "user_id", "permission")
-VALUES (%s, %s, %s)""", (uuid_, uid, permission))
+    upsert_acls(cursor, [(uuid_, uid, permission,)
+                         for uid, permission in permissions])
 
 
 def remove_acl(cursor, uuid_, permissions):
@@ -1235,97 +1649,84 @@ def remove_acl(cursor, uuid_, permissions):
         raise TypeError("``permissions`` is an invalid type: {}"
                         .format(type(permissions)))
 
-    permissions = set(permissions)
+    remove_acls(cursor, [(uuid_, uid, permission,)
+                         for uid, permission in permissions])
 
-    # Remove the the entries.
-    for uid, permission in permissions:
-        cursor.execute("""\
-DELETE FROM document_acl
-WHERE uuid = %s AND user_id = %s AND permission = %s""",
-                       (uuid_, uid, permission,))
+
+def _lookup_profiles(cursor, user_ids, lookup_func):
+    """Look up the profiles of the users (at ``user_ids``) using
+    the ``lookup_func``. The profiles that have not already been looked up
+    in the current transaction are looked up concurrently.
+    Returns a list of profiles in the order of the (distinct) ``user_ids``.
+    """
+    user_ids = sorted(set(user_ids))
+    memo = getattr(cursor.connection, 'profiles', {})
+    missing = [u for u in user_ids if u not in memo]
+    if len(missing) > 1:
+        pool = ThreadPool(min(len(missing), PROFILE_LOOKUP_THREADS))
+        try:
+            memo.update(zip(missing, pool.map(lookup_func, missing)))
+        finally:
+            pool.close()
+            pool.join()
+    elif missing:
+        memo[missing[0]] = lookup_func(missing[0])
+    return [memo[u] for u in user_ids]
 
 
 def _upsert_persons(cursor, person_ids, lookup_func):
     """Upsert's user info into the database.
     The model contains the user info as part of the role values.
     """
-    person_ids = list(set(person_ids))  # cleanse data
-
-    # Check for existing records to update.
-    cursor.execute("SELECT personid from persons where personid = ANY (%s)",
-                   (person_ids,))
-
-    existing_person_ids = [x[0] for x in cursor.fetchall()]
-
-    new_person_ids = [p for p in person_ids if p not in existing_person_ids]
-
-    # Update existing records.
-    for person_id in existing_person_ids:
-        # TODO only update based on a delta against the 'updated' column.
-        person_info = lookup_func(person_id)
-        cursor.execute("""\
-UPDATE persons
-SET (personid, firstname, surname, fullname) =
-    ( %(username)s, %(first_name)s, %(last_name)s,
-     %(full_name)s)
-WHERE personid = %(username)s""", person_info)
-
-    # Insert new records.
+    profiles = _lookup_profiles(cursor, person_ids, lookup_func)
+    if not profiles:
+        return
     # Email is an empty string because
     # accounts no longer gives out user
     # email info but a string datatype
     # is still needed for legacy to
     # properly process the persons table
-    for person_id in new_person_ids:
-        person_info = lookup_func(person_id)
-        cursor.execute("""\
+    # TODO only update based on a delta against the 'updated' column.
+    execute_values(cursor, """\
 INSERT INTO persons
 (personid, firstname, surname, fullname, email)
-VALUES
-(%(username)s, %(first_name)s,
-%(last_name)s, %(full_name)s, '')""", person_info)
+VALUES %s
+ON CONFLICT (personid) DO UPDATE
+SET (firstname, surname, fullname) =
+    (EXCLUDED.firstname, EXCLUDED.surname, EXCLUDED.fullname)""",
+                   profiles,
+                   template="(%(username)s, %(first_name)s, %(last_name)s, "
+                            "%(full_name)s, '')",
+                   page_size=len(profiles))
 
 
 def _upsert_users(cursor, user_ids, lookup_func):
     """Upsert's user info into the database.
     The model contains the user info as part of the role values.
     """
-    user_ids = list(set(user_ids))  # cleanse data
-
-    # Check for existing records to update.
-    cursor.execute("SELECT username from users where username = ANY (%s)",
-                   (user_ids,))
-
-    existing_user_ids = [x[0] for x in cursor.fetchall()]
-
-    new_user_ids = [u for u in user_ids if u not in existing_user_ids]
-
-    # Update existing records.
-    for user_id in existing_user_ids:
-        # TODO only update based on a delta against the 'updated' column.
-        user_info = lookup_func(user_id)
-        cursor.execute("""\
-UPDATE users
-SET (updated, username, first_name, last_name, full_name, title) =
-    (CURRENT_TIMESTAMP, %(username)s, %(first_name)s, %(last_name)s,
-     %(full_name)s, %(title)s)
-WHERE username = %(username)s""", user_info)
-
-    # Insert new records.
-    for user_id in new_user_ids:
-        user_info = lookup_func(user_id)
-        cursor.execute("""\
+    profiles = _lookup_profiles(cursor, user_ids, lookup_func)
+    if not profiles:
+        return
+    # TODO only update based on a delta against the 'updated' column.
+    execute_values(cursor, """\
 INSERT INTO users
 (username, first_name, last_name, full_name, suffix, title)
-VALUES
-(%(username)s, %(first_name)s, %(last_name)s, %(full_name)s,
- %(suffix)s, %(title)s)""", user_info)
+VALUES %s
+ON CONFLICT (username) DO UPDATE
+SET (updated, first_name, last_name, full_name, title) =
+    (CURRENT_TIMESTAMP, EXCLUDED.first_name, EXCLUDED.last_name,
+     EXCLUDED.full_name, EXCLUDED.title)""",
+                   profiles,
+                   template="(%(username)s, %(first_name)s, %(last_name)s, "
+                            "%(full_name)s, %(suffix)s, %(title)s)",
+                   page_size=len(profiles))
 
 
 def upsert_users(cursor, user_ids):
     """Given a set of user identifiers (``user_ids``),
     upsert them into the database after checking accounts for
     the latest information.
+    The profiles are fetched from accounts once per transaction.
     """
     accounts = get_current_registry().getUtility(IOpenstaxAccounts)
 
@@ -1441,27 +1842,41 @@ __all__ = (
     'acquire_subject_vocabulary',
     'add_pending_model',
     'add_pending_model_content',
+    'add_pending_models',
     'add_pending_resource',
+    'add_pending_resources',
     'add_publication',
+    'add_publication_models',
     'check_publication_state',
     'db_connect',
+    'invalidate_reference_data',
     'is_publication_permissible',
     'is_revision_publication',
+    'lookup_pending_resource_hashes',
     'lookup_document_pointer',
+    'lookup_module_ident',
+    'lookup_module_idents',
+    'notify_publication_acceptance',
     'notify_users',
     'obtain_licenses',
+    'obtain_subjects',
     'poke_publication_state',
     'publish_pending',
+    'remember_module_ident',
     'remove_acl',
+    'remove_acls',
     'remove_license_requests',
     'remove_role_requests',
     'set_post_publications_state',
     'set_publication_failure',
+    'spool_publication',
     'update_module_state',
     'upsert_acl',
+    'upsert_acls',
     'upsert_license_requests',
     'upsert_pending_licensors',
     'upsert_pending_roles',
+    'upsert_publication_acceptances',
     'upsert_role_requests',
     'upsert_users',
     'validate_model',
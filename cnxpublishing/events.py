@@ -56,10 +56,26 @@ class PostPublicationEvent(PGNotifyEvent):
         return "<{} {{{}}}>".format(name, ', '.join(props))
 
 
+class PublicationAcceptanceEvent(PGNotifyEvent):
+    """Notifications coming from the 'publication_acceptance' Postgres
+    channel, which are sent when a publication's license or role
+    acceptances change.
+    """
+
+    @property
+    def publication_id(self):
+        return self._payload['publication_id']
+
+    def __repr__(self):  # pragma: no cover
+        name = type(self).__class__.__name__
+        return "<{} {{publication_id={}}}>".format(name, self.publication_id)
+
+
 # TODO grok all decendents of PGNotifyEvent into a named utility listing.
 #      Thus replacing the need for this mapping.
 _CHANNEL_MAPPER = {
     'post_publication': PostPublicationEvent,
+    'publication_acceptance': PublicationAcceptanceEvent,
     None: PGNotifyEvent,
 }
 
@@ -84,4 +100,5 @@ __all__ = (
     'ChannelProcessingStartUpEvent',
     'PGNotifyEvent',
     'PostPublicationEvent',
+    'PublicationAcceptanceEvent',
 )
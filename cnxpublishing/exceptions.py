@@ -34,6 +34,24 @@ class DocumentLookupError(Exception):
     """Generally used when a document cannot be found."""
 
 
+class ConnectionPoolTimeout(Exception):
+    """Raised when a database connection could not be checked out
+    of the connection pool within the configured timeout.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    @property
+    def message(self):
+        return "Timed out after {} seconds waiting for a database " \
+               "connection.".format(self.timeout)
+
+    @property
+    def args(self):
+        return (self.message, self.__dict__,)
+
+
 # ########################## #
 #   Publication Exceptions   #
 # ########################## #
@@ -273,7 +291,46 @@ class ResourceFileExceededLimitError(PublicationException):
         return data
 
 
+class RepublishError(PublicationException):
+    """Raised when a binder that shares documents with the publication
+    could not be republished.
+    """
+    code = 23
+    _message_template = "Failed to republish '{ident_hash}'."
+
+    def __init__(self, ident_hash, publication_id=None):
+        super(RepublishError, self).__init__(publication_id=publication_id)
+        self._ident_hash = ident_hash
+
+    @property
+    def __dict__(self):
+        data = super(RepublishError, self).__dict__
+        data['ident_hash'] = self._ident_hash
+        return data
+
+
+class PipelineError(PublicationException):
+    """Raised when a stage of the asynchronous publication pipeline
+    failed unexpectedly.
+    """
+    code = 24
+    _message_template = "Failed while {stage} the publication: {error}"
+
+    def __init__(self, stage, error, publication_id=None):
+        super(PipelineError, self).__init__(publication_id=publication_id)
+        self._stage = stage
+        self._error = error
+
+    @property
+    def __dict__(self):
+        data = super(PipelineError, self).__dict__
+        data['stage'] = self._stage
+        data['error'] = self._error
+        return data
+
+
 __all__ = (
+    'ConnectionPoolTimeout',
     'DocumentLookupError',
     'InvalidLicense',
     'InvalidRole',
@@ -282,7 +339,9 @@ __all__ = (
     'InvalidDocumentPointer',
     'MissingRequiredMetadata',
     'NotAllowed',
+    'PipelineError',
     'PublicationException',
+    'RepublishError',
     'ResourceFileExceededLimitError',
     'UserFetchError',
     )
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2017, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+The asynchronous publication pipeline.
+
+When the application is configured with ``publishing.async = true``,
+a publication request only spools the EPUB into a publication entry.
+The rest of the publication is carried out by Celery tasks,
+one for each stage of the pipeline:
+
+1. ``process_publication`` makes each item of the EPUB
+   a pending document of the publication.
+2. ``publish_publication`` pokes at the publication, which
+   publishes it to the archive once it is ready to be published.
+
+The progress of the pipeline is kept in the Celery result backend
+under an id derived from the publication's id (see ``get_progress``),
+along with the mapping of the EPUB's item ids to pending ident-hashes
+once the publication has been processed (see ``get_mapping``).
+
+"""
+from __future__ import absolute_import
+
+import io
+import logging
+import time
+
+import celery
+import cnxepub
+from pyramid.threadlocal import get_current_registry
+
+from .db import (
+    add_publication_models,
+    poke_publication_state,
+    set_publication_failure,
+    with_db_cursor,
+    )
+from .exceptions import PipelineError
+from .tasks import task
+
+
+logger = logging.getLogger('cnxpublishing')
+
+# The (custom) task state the pipeline's progress is stored under.
+PROGRESS_STATE = 'PROGRESS'
+# The stages of the pipeline, in order.
+STAGES = ('queued', 'processing', 'publishing', 'done', 'failed',)
+
+
+def _progress_id(publication_id):
+    return 'publication-{}'.format(publication_id)
+
+
+def report_progress(publication_id, **changes):
+    """Record the progress of the publication's pipeline.
+    The ``changes`` are any of ``stage``, ``models`` (the number of
+    models in the publication), ``models_processed`` and ``mapping``
+    (the mapping of the EPUB's item ids to pending ident-hashes).
+    """
+    celery_app = get_current_registry().celery_app
+    task_id = _progress_id(publication_id)
+    progress = celery_app.AsyncResult(task_id).info
+    if not isinstance(progress, dict):
+        progress = {
+            'stage': STAGES[0],
+            'models': None,
+            'models_processed': 0,
+            'mapping': None,
+            'started': time.time(),
+            'finished': None,
+            }
+    progress.update(changes)
+    if progress['stage'] in STAGES[-2:]:
+        progress['finished'] = time.time()
+    celery_app.backend.store_result(task_id, progress, PROGRESS_STATE)
+
+
+def _get_progress_record(publication_id):
+    celery_app = get_current_registry().celery_app
+    result = celery_app.AsyncResult(_progress_id(publication_id))
+    progress = result.info
+    if result.state != PROGRESS_STATE or not isinstance(progress, dict):
+        return None
+    return progress
+
+
+def get_progress(publication_id):
+    """Returns the progress of the publication's pipeline as a dict
+    containing the ``stage``, the number of ``models``, the number of
+    ``models_processed`` and the ``elapsed`` time in seconds.
+    Returns ``None`` when the publication did not go through the pipeline.
+    """
+    progress = _get_progress_record(publication_id)
+    if progress is None:
+        return None
+    finished = progress['finished'] or time.time()
+    return {
+        'stage': progress['stage'],
+        'models': progress['models'],
+        'models_processed': progress['models_processed'],
+        'elapsed': finished - progress['started'],
+        }
+
+
+def get_mapping(publication_id):
+    """Returns the mapping of the publication's EPUB item ids to
+    pending ident-hashes. Returns ``None`` until the processing stage
+    of the pipeline has finished.
+    """
+    progress = _get_progress_record(publication_id)
+    if progress is None:
+        return None
+    return progress.get('mapping')
+
+
+def start_publication(cursor, publication_id):
+    """Queue the pipeline for the (spooled) publication.
+
+    This commits the current transaction, so that the tasks are able to
+    see the publication. When the pipeline can't be queued,
+    the publication is marked as failed.
+    """
+    cursor.connection.commit()
+    report_progress(publication_id, stage='queued')
+
+    celery_app = get_current_registry().celery_app
+    process_task = celery_app.tasks[
+        'cnxpublishing.pipeline.process_publication']
+    publish_task = celery_app.tasks[
+        'cnxpublishing.pipeline.publish_publication']
+    try:
+        celery.chain(process_task.si(publication_id),
+                     publish_task.si(publication_id)).delay()
+    except Exception as exc:
+        logger.exception('Failed to queue the pipeline of '
+                         'publication_id={}'.format(publication_id))
+        _fail_publication(publication_id, 'queueing', exc, cursor=cursor)
+        raise
+
+
+@with_db_cursor
+def _fail_publication(publication_id, stage, error, cursor):
+    error = '{}: {}'.format(type(error).__name__, error)
+    set_publication_failure(
+        cursor, PipelineError(stage, error, publication_id=publication_id))
+    # Committed now, whatever happens to the caller's transaction.
+    cursor.connection.commit()
+    report_progress(publication_id, stage='failed')
+
+
+@with_db_cursor
+def _process_publication(publication_id, cursor):
+    cursor.execute("SELECT epub FROM publications WHERE id = %s",
+                   (publication_id,))
+    epub = cnxepub.EPUB.from_file(io.BytesIO(cursor.fetchone()[0][:]))
+
+    def progress(models_processed, models):
+        report_progress(publication_id, models=models,
+                        models_processed=models_processed)
+
+    return add_publication_models(cursor, publication_id, epub,
+                                  progress=progress)
+
+
+@task()
+def process_publication(publication_id):
+    """Make the items of the publication's EPUB pending documents."""
+    report_progress(publication_id, stage='processing')
+    try:
+        mapping = _process_publication(publication_id)
+    except Exception as exc:
+        logger.exception('Uncaught exception while processing '
+                         'publication_id={}'.format(publication_id))
+        _fail_publication(publication_id, 'processing', exc)
+        raise
+    report_progress(publication_id, mapping=mapping)
+
+
+@task()
+def publish_publication(publication_id):
+    """Poke at the publication to publish it, if it is ready to be.
+    Returns the publication's state.
+    """
+    report_progress(publication_id, stage='publishing')
+    try:
+        state, messages = poke_publication_state(publication_id)
+    except Exception as exc:
+        logger.exception('Uncaught exception while publishing '
+                         'publication_id={}'.format(publication_id))
+        _fail_publication(publication_id, 'publishing', exc)
+        raise
+    report_progress(publication_id, stage='done')
+    return state
+
+
+__all__ = (
+    'get_mapping',
+    'get_progress',
+    'process_publication',
+    'publish_publication',
+    'report_progress',
+    'start_publication',
+    )
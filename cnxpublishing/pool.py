@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2017, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+A registry scoped pool of database connections.
+
+The pool is created as part of the application configuration and
+is available at ``registry.db_pool``. Use ``cnxpublishing.db.db_connect``
+or the ``cnxpublishing.db.with_db_cursor`` decorator rather than
+using the pool directly.
+
+Views share a single connection and transaction for the lifetime of
+the request through ``request.db_cursor``. The transaction is committed
+before the response is sent, or rolled back when the request raised
+an exception.
+
+Connections handed out by the pool are instances of ``Connection``,
+which carries state that lives only as long as the current transaction.
+
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_UNKNOWN,
+    )
+
+from .config import CONNECTION_STRING
+from .exceptions import ConnectionPoolTimeout
+
+
+class Connection(psycopg2.extensions.connection):
+    """A psycopg2 connection that carries state scoped to the
+    current transaction. The state is dropped when the transaction
+    ends, whether it was committed or rolled back.
+
+    ``module_idents`` is a mapping of ident-hash to ``module_ident``
+    for the modules looked up in the current transaction
+    (see ``cnxpublishing.db.lookup_module_idents``).
+
+    ``profiles`` is a mapping of username to the user's accounts profile
+    for the users looked up in the current transaction
+    (see ``cnxpublishing.db.upsert_users``).
+
+    ``prepared_statements`` is the set of names of the statements
+    that have been prepared on the connection. Unlike the above,
+    it lives as long as the connection
+    (see ``cnxpublishing.statements``).
+
+    ``bytea_stream`` is ``None`` until the ``bytea_stream`` temporary table
+    has been created on the connection, and otherwise tells whether
+    the table holds rows in the current transaction
+    (see ``cnxpublishing.db._copy_bytea``).
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.module_idents = {}
+        self.profiles = {}
+        self.prepared_statements = set()
+        self.bytea_stream = None
+
+    def _end_transaction(self, committed):
+        self.module_idents.clear()
+        self.profiles.clear()
+        if not committed:
+            # The table may have been created in the rolled back
+            # transaction.
+            self.bytea_stream = None
+        elif self.bytea_stream is not None:
+            # The table's rows are deleted on commit.
+            self.bytea_stream = False
+
+    def commit(self):
+        super(Connection, self).commit()
+        self._end_transaction(True)
+
+    def rollback(self):
+        self._end_transaction(False)
+        super(Connection, self).rollback()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The ``with`` block commits or rolls back without going
+        # through the methods above.
+        try:
+            result = super(Connection, self).__exit__(exc_type, exc_value,
+                                                      traceback)
+        except Exception:
+            self._end_transaction(False)
+            raise
+        self._end_transaction(exc_type is None)
+        return result
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of database connections.
+
+    At most ``max_size`` connections are open at any one time. A checkout
+    waits up to ``timeout`` seconds for a connection to be returned
+    before giving up. Connections that have been sitting idle for longer
+    than ``check_interval`` seconds are checked for health before being
+    handed out.
+
+    """
+
+    def __init__(self, connection_string, min_size=1, max_size=10,
+                 timeout=30, check_interval=30):
+        if min_size > max_size:
+            raise ValueError("min_size ({}) is greater than max_size ({})"
+                             .format(min_size, max_size))
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Condition()
+        self._idle = []  # [(<connection>, <returned-at>), ...]
+        self._size = 0  # open connections, both idle and checked out
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'discarded': 0,
+            }
+
+    def _check_process(self):
+        # Connections cannot be shared across a fork (e.g. the celery
+        # worker pool), so start afresh in the child process.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self):
+        return psycopg2.connect(self.connection_string,
+                                connection_factory=Connection)
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.time() - returned_at < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:  # pragma: no cover
+                pass
+        with self._lock:
+            self._size -= 1
+            self._stats['discarded'] += 1
+            self._lock.notify()
+
+    def _checkout(self):
+        """Returns an idle connection and the time it was returned
+        or ``None`` when a new connection should be opened.
+        """
+        with self._lock:
+            wait_started = None
+            while not self._idle and self._size >= self.max_size:
+                now = time.time()
+                if wait_started is None:
+                    wait_started = now
+                    self._stats['waits'] += 1
+                remaining = wait_started + self.timeout - now
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._stats['wait_time'] += now - wait_started
+                    raise ConnectionPoolTimeout(self.timeout)
+                self._lock.wait(remaining)
+            if wait_started is not None:
+                self._stats['wait_time'] += time.time() - wait_started
+            self._stats['checkouts'] += 1
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            return None
+
+    def _fill(self):
+        """Open connections until the pool holds ``min_size``."""
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                raise
+            with self._lock:
+                self._idle.append((conn, time.time(),))
+                self._lock.notify()
+
+    def getconn(self):
+        """Borrow a connection from the pool."""
+        self._check_process()
+        if self._size < self.min_size:
+            self._fill()
+        while True:
+            idle = self._checkout()
+            if idle is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._discard(None)
+                    raise
+            conn, returned_at = idle
+            if self._is_healthy(conn, returned_at):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """Return a borrowed connection to the pool.
+        Any open transaction on the connection is rolled back.
+        """
+        if self._pid != os.getpid():
+            # Borrowed before a fork, this belongs to the parent process.
+            return
+        if not conn.closed \
+           and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed \
+           or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._idle.append((conn, time.time(),))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the ``with`` block.
+        The transaction is committed when the block exits cleanly
+        or rolled back when it exits with an exception.
+        """
+        conn = self.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.putconn(conn)
+
+    @property
+    def stats(self):
+        """A snapshot of the pool's usage statistics."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+        stats['min_size'] = self.min_size
+        stats['max_size'] = self.max_size
+        return stats
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            if not conn.closed:
+                conn.close()
+
+
+def db_cursor(request):
+    """A cursor on a pooled connection that is shared by everything
+    that runs as part of the request (i.e. ``request.db_cursor``).
+    """
+    pool = request.registry.db_pool
+    conn = pool.getconn()
+    cursor = conn.cursor()
+
+    def commit(request, response):
+        if request.exception is None:
+            conn.commit()
+        else:
+            conn.rollback()
+
+    def release(request):
+        try:
+            cursor.close()
+        finally:
+            # Anything that has not been committed is rolled back.
+            pool.putconn(conn)
+
+    request.add_response_callback(commit)
+    request.add_finished_callback(release)
+    return cursor
+
+
+def includeme(config):
+    """Configures the database connection pool"""
+    settings = config.registry.settings
+    config.registry.db_pool = ConnectionPool(
+        settings[CONNECTION_STRING],
+        min_size=int(settings.get('db_pool.min_size', 1)),
+        max_size=int(settings.get('db_pool.max_size', 10)),
+        timeout=float(settings.get('db_pool.timeout', 30)),
+        check_interval=float(settings.get('db_pool.check_interval', 30)),
+        )
+    config.add_request_method(db_cursor, 'db_cursor', reify=True)
+
+
+__all__ = (
+    'Connection',
+    'ConnectionPool',
+    )
@@ -8,17 +8,36 @@
 """\
 Functions used to commit publication works to the archive.
 """
+from __future__ import absolute_import
+
 import hashlib
 import io
+import logging
+import sys
+from contextlib import contextmanager
 
+import celery
 import cnxepub
-import psycopg2
+from psycopg2.extras import execute_values
 from cnxepub import (
     Binder,
     CompositeDocument,
     Document,
     )
-
+from pyramid.threadlocal import get_current_registry
+
+from .db import (
+    COPY_CHUNK_SIZE,
+    _copy_bytea,
+    lookup_module_ident,
+    lookup_module_idents,
+    remember_module_ident,
+    set_publication_failure,
+    with_db_cursor,
+    )
+from .exceptions import RepublishError
+from .statements import get_statement, register_statement
+from .tasks import task
 from .utils import (
     issequence,
     join_ident_hash,
@@ -27,6 +46,9 @@ from .utils import (
     )
 
 
+logger = logging.getLogger('cnxpublishing')
+
+
 ATTRIBUTED_ROLE_KEYS = (
     'authors', 'copyright_holders', 'editors', 'illustrators',
     'publishers', 'translators',
@@ -60,12 +82,9 @@ module_insertion AS (
      %(publisher)s, %(publication_message)s,
      (SELECT abstractid FROM abstract_insertion),
      (SELECT licenseid FROM license_lookup),
-     (SELECT module_ident FROM modules
-        WHERE ident_hash(uuid, major_version, minor_version) = \
-              %(parent_ident_hash)s),
+     %(parent_module_ident)s,
      (SELECT authors FROM modules
-        WHERE ident_hash(uuid, major_version, minor_version) = \
-              %(parent_ident_hash)s),
+        WHERE module_ident = %(parent_module_ident)s),
      %(authors)s, %(publishers)s, %(copyright_holders)s,
      DEFAULT, DEFAULT,
      DEFAULT, ' ',%(print_style)s)
@@ -98,16 +117,71 @@ keywords_relationship_from_existing AS (
 SELECT module_ident, ident_hash FROM module_insertion
 """
 
-
-TREE_NODE_INSERT = """
+LATEST_MODULEID_LOOKUP = register_statement('latest_moduleid_lookup', """\
+SELECT moduleid FROM latest_modules WHERE uuid = %(uuid)s::uuid""")
+FILES_LOOKUP = register_statement('files_lookup', """\
+SELECT sha1, fileid FROM files WHERE sha1 = ANY (%(hashes)s::text[])""")
+MODULE_FILES_LOOKUP = register_statement('module_files_lookup', """\
+SELECT filename, fileid
+FROM module_files
+WHERE module_ident = %(module_ident)s
+      AND filename = ANY (%(filenames)s::text[])""")
+
+# Used with ``execute_values`` to insert many nodes with preallocated ids.
+TREE_NODES_INSERT = """
 INSERT INTO trees
   (nodeid, parent_id, documentid,
    title, childorder, latest, is_collated)
-VALUES
-  (DEFAULT, %(parent_id)s, %(document_id)s,
-   %(title)s, %(child_order)s, %(is_latest)s, %(is_collated)s)
-RETURNING nodeid
+VALUES %s
 """
+TREE_NODES_INSERT_TEMPLATE = """\
+(%(node_id)s, %(parent_id)s, %(document_id)s,
+ %(title)s, %(child_order)s, %(is_latest)s, %(is_collated)s)"""
+
+# Copies the (non-collated) tree of a collection, remapping the documents
+# of the tree through a history mapping of previous to current
+# module_idents. Only the root and the nodes flagged as ``latest``
+# are remapped. The new root's ``nodeid`` is returned.
+TREE_CLONE = """\
+WITH RECURSIVE history(previous, current) AS (
+  SELECT * FROM unnest(%(previous)s::integer[], %(current)s::integer[])),
+t(nodeid, parent_id, documentid, title, childorder, latest, path) AS (
+  SELECT
+    tr.nodeid, tr.parent_id, tr.documentid,
+    tr.title, tr.childorder, tr.latest,
+    ARRAY[tr.nodeid]
+  FROM trees AS tr
+  WHERE tr.nodeid = (
+    SELECT min(nodeid) FROM trees
+    WHERE documentid = %(module_ident)s
+          AND parent_id IS NULL
+          AND is_collated = FALSE)
+UNION ALL
+  SELECT
+    c.nodeid, c.parent_id, c.documentid, c.title, c.childorder, c.latest,
+    path || ARRAY[c.nodeid]
+  FROM trees AS c JOIN t ON (c.parent_id = t.nodeid)
+  WHERE not c.nodeid = ANY(t.path) AND c.is_collated = FALSE
+),
+new_nodes AS (
+  SELECT nodeid, nextval('nodeid_seq') AS new_nodeid FROM t),
+inserted AS (
+  INSERT INTO trees
+    (nodeid, parent_id, documentid, title, childorder, latest)
+  SELECT
+    n.new_nodeid, p.new_nodeid,
+    CASE WHEN h.current IS NOT NULL
+              AND (t.latest OR t.parent_id IS NULL)
+         THEN h.current
+         ELSE t.documentid
+    END,
+    t.title, t.childorder, t.latest
+  FROM t
+       JOIN new_nodes AS n ON (n.nodeid = t.nodeid)
+       LEFT JOIN new_nodes AS p ON (p.nodeid = t.parent_id)
+       LEFT JOIN history AS h ON (h.previous = t.documentid)
+  RETURNING nodeid, parent_id)
+SELECT nodeid FROM inserted WHERE parent_id IS NULL"""
 
 
 def _model_to_portaltype(model):
@@ -151,6 +225,34 @@ INSERT INTO moduleoptionalroles (module_ident, roleid, personids)
 VALUES (%s, %s, %s)""", (ident, role_id, usernames,))
 
 
+def _module_insertion(has_ident, has_moduleid, has_created):
+    """Returns the statement for the variant of
+    ``MODULE_INSERTION_TEMPLATE`` that inserts the given values
+    rather than the defaults. Each variant is formatted once.
+    """
+    name = 'module_insertion_{:d}{:d}{:d}'.format(has_ident, has_moduleid,
+                                                  has_created)
+    try:
+        return get_statement(name)
+    except KeyError:
+        pass
+    if has_ident:
+        fields = {
+            '__uuid__': "%(_uuid)s::uuid",
+            '__major_version__': "%(_major_version)s",
+            '__minor_version__': "%(_minor_version)s",
+            }
+    else:
+        fields = {
+            '__uuid__': "DEFAULT",
+            '__major_version__': "DEFAULT",
+            '__minor_version__': "DEFAULT",
+            }
+    fields['__moduleid__'] = has_moduleid and "%(_moduleid)s" or "DEFAULT"
+    fields['__created__'] = has_created and "%(created)s" or "DEFAULT"
+    return register_statement(name, MODULE_INSERTION_TEMPLATE.format(**fields))
+
+
 def _insert_metadata(cursor, model, publisher, message):
     """Insert a module with the given ``metadata``."""
     params = model.metadata.copy()
@@ -164,7 +266,9 @@ def _insert_metadata(cursor, model, publisher, message):
     for person_field in ATTRIBUTED_ROLE_KEYS:
         params[person_field] = [parse_user_uri(x['id'])
                                 for x in params.get(person_field, [])]
-    params['parent_ident_hash'] = parse_parent_ident_hash(model)
+    parent_ident_hash = parse_parent_ident_hash(model)
+    params['parent_module_ident'] = parent_ident_hash and \
+        lookup_module_ident(cursor, parent_ident_hash)
 
     # Assign the id and version if one is known.
     if model.ident_hash is not None:
@@ -173,8 +277,7 @@ def _insert_metadata(cursor, model, publisher, message):
         params['_uuid'] = uuid
         params['_major_version'], params['_minor_version'] = version
         # Lookup legacy ``moduleid``.
-        cursor.execute("SELECT moduleid FROM latest_modules WHERE uuid = %s",
-                       (uuid,))
+        LATEST_MODULEID_LOOKUP.execute(cursor, {'uuid': uuid})
         # There is the chance that a uuid and version have been set,
         #   but a previous publication does not exist. Therefore the
         #   moduleid will not be found. This happens on a pre-publication.
@@ -183,30 +286,16 @@ def _insert_metadata(cursor, model, publisher, message):
         except TypeError as exc:  # NoneType
             moduleid = None
         params['_moduleid'] = moduleid
-
-        created = model.metadata.get('created', None)
-        # Format the statement to accept the identifiers.
-        stmt = MODULE_INSERTION_TEMPLATE.format(**{
-            '__uuid__': "%(_uuid)s::uuid",
-            '__major_version__': "%(_major_version)s",
-            '__minor_version__': "%(_minor_version)s",
-            '__moduleid__': moduleid is None and "DEFAULT" or "%(_moduleid)s",
-            '__created__': created is None and "DEFAULT" or "%(created)s",
-            })
+        statement = _module_insertion(True, moduleid is not None,
+                                      params.get('created') is not None)
     else:
-        created = model.metadata.get('created', None)
-        # Format the statement for defaults.
-        stmt = MODULE_INSERTION_TEMPLATE.format(**{
-            '__uuid__': "DEFAULT",
-            '__major_version__': "DEFAULT",
-            '__minor_version__': "DEFAULT",
-            '__moduleid__': "DEFAULT",
-            '__created__': created is None and "DEFAULT" or "%(created)s",
-            })
+        statement = _module_insertion(False, False,
+                                      params.get('created') is not None)
 
     # Insert the metadata
-    cursor.execute(stmt, params)
+    statement.execute(cursor, params)
     module_ident, ident_hash = cursor.fetchone()
+    remember_module_ident(cursor, ident_hash, module_ident)
     # Insert optional roles
     _insert_optional_roles(cursor, model, module_ident)
 
@@ -215,13 +304,65 @@ def _insert_metadata(cursor, model, publisher, message):
 
 def _get_file_sha1(file):
     """Return the SHA1 hash of the given a file-like object as ``file``.
+    The file is read in chunks, rather than as a whole.
     This will seek the file back to 0 when it's finished.
 
     """
-    bits = file.read()
+    h = hashlib.new('sha1')
+    for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+        h.update(chunk)
     file.seek(0)
-    h = hashlib.new('sha1', bits).hexdigest()
-    return h
+    return h.hexdigest()
+
+
+def _insert_files(cursor, files, hashes=None):
+    """Upsert many files, given as a sequence of ``(file, media_type)``
+    pairs, into the files table. The existing files are looked up in one
+    query and only the missing files are inserted, in one statement.
+    Returns a list of the ``fileid`` and ``sha1`` of the upserted files,
+    in the order of the given files.
+    The SHA1 ``hashes`` of the files are computed unless they are given.
+
+    This is safe to use concurrently (e.g. by many baking workers).
+    A file inserted by another transaction in the meantime is looked up
+    once that transaction has finished.
+
+    """
+    if hashes is None:
+        hashes = [_get_file_sha1(file) for file, media_type in files]
+    if not hashes:
+        return []
+    FILES_LOOKUP.execute(cursor, {'hashes': list(set(hashes))})
+    fileids = dict(cursor.fetchall())
+
+    missing_files = {}  # {<sha1>: (<file>, <media-type>)}
+    for (file, media_type), sha1 in zip(files, hashes):
+        if sha1 not in fileids and sha1 not in missing_files:
+            missing_files[sha1] = (file, media_type,)
+    if missing_files:
+        # Insert in a consistent order to prevent deadlocks between
+        # concurrent transactions inserting the same files.
+        missing_files = sorted(missing_files.items())
+        _copy_bytea(cursor, [file for _, (file, _) in missing_files])
+        cursor.execute("""\
+INSERT INTO files (file, media_type)
+SELECT s.data, m.media_type
+FROM bytea_stream AS s
+     JOIN unnest(%s::text[]) WITH ORDINALITY AS m(media_type, ord)
+          USING (ord)
+ORDER BY ord
+ON CONFLICT (sha1) DO NOTHING
+RETURNING sha1, fileid""", ([media_type
+                             for _, (_, media_type) in missing_files],))
+        fileids.update(cursor.fetchall())
+
+        # Files concurrently inserted by another transaction.
+        conflicted_hashes = [sha1 for sha1, _ in missing_files
+                             if sha1 not in fileids]
+        if conflicted_hashes:
+            FILES_LOOKUP.execute(cursor, {'hashes': conflicted_hashes})
+            fileids.update(cursor.fetchall())
+    return [(fileids[sha1], sha1,) for sha1 in hashes]
 
 
 def _insert_file(cursor, file, media_type):
@@ -229,89 +370,159 @@ def _insert_file(cursor, file, media_type):
     Returns the ``fileid`` and ``sha1`` of the upserted file.
 
     """
-    resource_hash = _get_file_sha1(file)
-    cursor.execute("SELECT fileid FROM files WHERE sha1 = %s",
-                   (resource_hash,))
+    return _insert_files(cursor, [(file, media_type,)])[0]
+
+
+def _insert_module_files(cursor, module_ident, files):
+    """Insert files, given as a sequence of ``(filename, file, media_type)``,
+    into the module_files table. This will create new file entries
+    or associate existing ones.
+    """
+    results = _insert_files(cursor, [(file, media_type,)
+                                     for _, file, media_type in files])
+    filenames = [filename for filename, _, _ in files]
+
+    # Is this file legitimately used twice within the same content?
+    MODULE_FILES_LOOKUP.execute(cursor, {'module_ident': module_ident,
+                                         'filenames': filenames})
+    existing_fileids = dict(cursor.fetchall())
+
+    args = []
+    for filename, (fileid, _) in zip(filenames, results):
+        is_same_file = None
+        if filename in existing_fileids:
+            is_same_file = existing_fileids[filename] == fileid
+        if is_same_file:
+            # All is good, skip it.
+            continue
+        elif is_same_file is not None:  # pragma: no cover
+            # This means the file is not the same, but a filename
+            #   conflict exists.
+            # FFF At this time, it is impossible to get to this logic.
+            raise Exception("filename conflict")
+        existing_fileids[filename] = fileid
+        args.append((module_ident, fileid, filename,))
+
+    if args:
+        execute_values(cursor, """\
+INSERT INTO module_files (module_ident, fileid, filename)
+VALUES %s""", args)
+
+
+@contextmanager
+def _open_resource_files(resources):
+    """Open the given resources, producing their
+    ``(filename, file, media_type)`` for use with ``_insert_module_files``.
+    The files stay open until the context exits.
+    """
+    opened = []
     try:
-        fileid = cursor.fetchone()[0]
-    except (IndexError, TypeError):
-        cursor.execute("INSERT INTO files (file, media_type) "
-                       "VALUES (%s, %s)"
-                       "RETURNING fileid",
-                       (psycopg2.Binary(file.read()), media_type,))
-        fileid = cursor.fetchone()[0]
-    return fileid, resource_hash
+        files = []
+        for resource in resources:
+            context = resource.open()
+            file = context.__enter__()
+            opened.append(context)
+            files.append((resource.filename, file, resource.media_type,))
+        yield files
+    finally:
+        exc_info = sys.exc_info()
+        for context in reversed(opened):
+            context.__exit__(*exc_info)
 
 
 def _insert_resource_file(cursor, module_ident, resource):
     """Insert a resource into the modules_files table. This will
     create a new file entry or associates an existing one.
     """
-    with resource.open() as file:
-        fileid, _ = _insert_file(cursor, file, resource.media_type)
+    with _open_resource_files([resource]) as files:
+        _insert_module_files(cursor, module_ident, files)
 
-    # Is this file legitimately used twice within the same content?
-    cursor.execute("""\
-select
-  (fileid = %s) as is_same_file
-from module_files
-where module_ident = %s and filename = %s""",
-                   (fileid, module_ident, resource.filename,))
-    try:
-        is_same_file = cursor.fetchone()[0]
-    except TypeError:  # NoneType
-        is_same_file = None
-    if is_same_file:
-        # All is good, bail out.
-        return
-    elif is_same_file is not None:  # pragma: no cover
-        # This means the file is not the same, but a filename
-        #   conflict exists.
-        # FFF At this time, it is impossible to get to this logic.
-        raise Exception("filename conflict")
 
-    args = (module_ident, fileid, resource.filename,)
-    cursor.execute("""\
-INSERT INTO module_files (module_ident, fileid, filename)
-VALUES (%s, %s, %s)""", args)
+def _flatten_tree(tree, parent=None, index=0):
+    """Flattens a binder tree into a list of nodes in depth-first order.
+    Each node is a dictionary that refers to its parent by position
+    in the list (``None`` for the top-level nodes).
+    """
+    nodes = []
+
+    def flatten(tree, parent, index):
+        if isinstance(tree, dict):
+            position = len(nodes)
+            nodes.append({
+                'id': tree['id'],
+                'title': tree.get('title', None),
+                'parent': parent,
+                'child_order': index,
+                })
+            if 'contents' in tree:
+                flatten(tree['contents'], position, 0)
+        elif isinstance(tree, list):
+            for i, tree_node in enumerate(tree):
+                flatten(tree_node, parent, i)
+
+    flatten(tree, parent, index)
+    return nodes
 
 
 def _insert_tree(cursor, tree, parent_id=None, index=0, is_collated=False):
-    """Inserts a binder tree into the archive."""
-    if isinstance(tree, dict):
-        if tree['id'] == 'subcol':
+    """Inserts a binder tree into the archive.
+    The documents of the tree are looked up in one query
+    and the tree's nodes are inserted in one statement.
+    """
+    nodes = _flatten_tree(tree, index=index)
+    if not nodes:
+        return
+
+    # Look up all the documents in the tree.
+    module_idents = lookup_module_idents(
+        cursor, [node['id'] for node in nodes if node['id'] != 'subcol'])
+    documents = {}
+    if module_idents:
+        cursor.execute("""\
+        SELECT module_ident, name
+        FROM modules
+        WHERE module_ident = ANY (%s)
+        """, (list(set(module_idents.values())),))
+        names = dict(cursor.fetchall())
+        documents = dict([(ident_hash, (module_ident, names[module_ident],))
+                          for ident_hash, module_ident
+                          in module_idents.items()])
+
+    # Allocate the node ids up front, so that the nodes can refer
+    # to their parents.
+    cursor.execute("SELECT nextval('nodeid_seq') "
+                   "FROM generate_series(1, %s)", (len(nodes),))
+    node_ids = [r[0] for r in cursor.fetchall()]
+
+    args = []
+    for node, node_id in zip(nodes, node_ids):
+        if node['id'] == 'subcol':
             document_id = None
-            title = tree['title']
+            title = node['title']
         else:
-            cursor.execute("""\
-            SELECT module_ident, name
-            FROM modules
-            WHERE ident_hash(uuid,major_version,minor_version) = %s
-            """, (tree['id'],))
             try:
-                document_id, document_title = cursor.fetchone()
-            except TypeError as exc:  # NoneType
+                document_id, document_title = documents[node['id']]
+            except KeyError:
                 raise ValueError("Missing published document for '{}'."
-                                 .format(tree['id']))
-            if tree.get('title', None):
-                title = tree['title']
+                                 .format(node['id']))
+            if node['title']:
+                title = node['title']
             else:
                 title = document_title
+        if node['parent'] is None:
+            node_parent_id = parent_id
+        else:
+            node_parent_id = node_ids[node['parent']]
         # TODO We haven't settled on a flag (name or value)
         #      to pin the node to a specific version.
         is_latest = True
-        cursor.execute(TREE_NODE_INSERT,
-                       dict(document_id=document_id, parent_id=parent_id,
-                            title=title, child_order=index,
-                            is_latest=is_latest, is_collated=is_collated))
-        node_id = cursor.fetchone()[0]
-        if 'contents' in tree:
-            _insert_tree(cursor, tree['contents'], parent_id=node_id,
-                         is_collated=is_collated)
-    elif isinstance(tree, list):
-        for tree_node in tree:
-            _insert_tree(cursor, tree_node, parent_id=parent_id,
-                         index=tree.index(tree_node), is_collated=is_collated)
+        args.append(dict(node_id=node_id, document_id=document_id,
+                         parent_id=node_parent_id, title=title,
+                         child_order=node['child_order'],
+                         is_latest=is_latest, is_collated=is_collated))
+    execute_values(cursor, TREE_NODES_INSERT, args,
+                   template=TREE_NODES_INSERT_TEMPLATE,
+                   page_size=len(args))
 
 
 def publish_model(cursor, model, publisher, message):
@@ -324,44 +535,25 @@ def publish_model(cursor, model, publisher, message):
     module_ident, ident_hash = _insert_metadata(cursor, model,
                                                 publisher, message)
 
-    for resource in getattr(model, 'resources', []):
-        _insert_resource_file(cursor, module_ident, resource)
-
-    if isinstance(model, Document):
-        html = str(cnxepub.DocumentContentFormatter(model)).encode('utf-8')
-        sha1 = hashlib.new('sha1', html).hexdigest()
-        cursor.execute("SELECT fileid FROM files WHERE sha1 = %s", (sha1,))
-        try:
-            fileid = cursor.fetchone()[0]
-        except TypeError:
-            file_args = {
-                'media_type': 'text/html',
-                'data': psycopg2.Binary(html),
-                }
-            cursor.execute("""\
-            insert into files (file, media_type)
-            VALUES (%(data)s, %(media_type)s)
-            returning fileid""", file_args)
-            fileid = cursor.fetchone()[0]
-        args = {
-            'module_ident': module_ident,
-            'filename': 'index.cnxml.html',
-            'fileid': fileid,
-            }
-        cursor.execute("""\
-        INSERT INTO module_files
-          (module_ident, fileid, filename)
-        VALUES
-          (%(module_ident)s, %(fileid)s, %(filename)s)""", args)
+    with _open_resource_files(getattr(model, 'resources', [])) as files:
+        if isinstance(model, Document):
+            html = str(cnxepub.DocumentContentFormatter(model)).encode('utf-8')
+            files.append(('index.cnxml.html', io.BytesIO(html), 'text/html',))
+        # Store the resources and content together.
+        _insert_module_files(cursor, module_ident, files)
 
-    elif isinstance(model, Binder):
+    if isinstance(model, Binder):
         tree = cnxepub.model_to_tree(model)
         tree = _insert_tree(cursor, tree)
     return ident_hash
 
 
-def publish_composite_model(cursor, model, parent_model, publisher, message):
-    """Publishes the ``model`` and return its ident_hash."""
+def publish_composite_model(cursor, model, parent_model, publisher, message,
+                            content=True):
+    """Publishes the ``model`` and return its ident_hash.
+    When ``content`` is false, the content of a composite document
+    is left to be published with ``publish_collated_documents``.
+    """
     if not (isinstance(model, CompositeDocument) or
             (isinstance(model, Binder) and
                 model.metadata.get('type') == 'composite-chapter')):
@@ -377,30 +569,58 @@ def publish_composite_model(cursor, model, parent_model, publisher, message):
     model.id, model.metadata['version'] = split_ident_hash(ident_hash)
     model.set_uri('cnx-archive', ident_hash)
 
-    for resource in model.resources:
-        _insert_resource_file(cursor, module_ident, resource)
+    with _open_resource_files(model.resources) as files:
+        _insert_module_files(cursor, module_ident, files)
 
-    if isinstance(model, CompositeDocument):
-        html = str(cnxepub.DocumentContentFormatter(model))
-        fileid, _ = _insert_file(cursor, io.BytesIO(html.encode('utf-8')),
-                                 'text/html')
-        file_arg = {
-            'module_ident': module_ident,
-            'parent_ident_hash': parent_model.ident_hash,
-            'fileid': fileid,
-            }
-        cursor.execute("""\
-        INSERT INTO collated_file_associations
-          (context, item, fileid)
-        VALUES
-          ((SELECT module_ident FROM modules
-            WHERE ident_hash(uuid, major_version, minor_version)
-           = %(parent_ident_hash)s),
-            %(module_ident)s, %(fileid)s)""", file_arg)
+    if content and isinstance(model, CompositeDocument):
+        publish_collated_documents(cursor, [model], parent_model)
 
     return ident_hash
 
 
+def _render_document(model):
+    """Renders the (collated) content of the ``model``.
+    Returns the HTML and its SHA1 hash.
+    """
+    html = str(cnxepub.DocumentContentFormatter(model))
+    return html, hashlib.sha1(html).hexdigest()
+
+
+def publish_collated_documents(cursor, models, parent_model, pool=None):
+    """Publish the collated content of many ``models`` in the context of
+    the `parent_model`. Note, the models' content is expected to already
+    have the collated content. This will just persist that content to
+    the archive.
+
+    The content is rendered using the ``pool`` (e.g. a ``ThreadPool``),
+    when one is given. The files and their associations are then written
+    in one statement each.
+
+    """
+    models = list(models)
+    if not models:
+        return
+    if pool is None:
+        rendered = [_render_document(model) for model in models]
+    else:
+        rendered = pool.map(_render_document, models)
+    results = _insert_files(cursor,
+                            [(io.BytesIO(html), 'text/html',)
+                             for html, _ in rendered],
+                            hashes=[sha1 for _, sha1 in rendered])
+
+    module_idents = lookup_module_idents(
+        cursor,
+        [model.ident_hash for model in models] + [parent_model.ident_hash])
+    parent_module_ident = module_idents.get(parent_model.ident_hash)
+    args = [(parent_module_ident, module_idents.get(model.ident_hash),
+             fileid,)
+            for model, (fileid, _) in zip(models, results)]
+    execute_values(cursor, """\
+INSERT INTO collated_file_associations (context, item, fileid)
+VALUES %s""", args, page_size=len(args))
+
+
 def publish_collated_document(cursor, model, parent_model):
     """Publish a given `module`'s collated content in the context of
     the `parent_model`. Note, the model's content is expected to already
@@ -408,37 +628,7 @@ def publish_collated_document(cursor, model, parent_model):
     the archive.
 
     """
-    html = str(cnxepub.DocumentContentFormatter(model)).encode('utf-8')
-    sha1 = hashlib.new('sha1', html).hexdigest()
-    cursor.execute("SELECT fileid FROM files WHERE sha1 = %s", (sha1,))
-    try:
-        fileid = cursor.fetchone()[0]
-    except TypeError:
-        file_args = {
-            'media_type': 'text/html',
-            'data': psycopg2.Binary(html),
-            }
-        cursor.execute("""\
-        INSERT INTO files (file, media_type)
-        VALUES (%(data)s, %(media_type)s)
-        RETURNING fileid""", file_args)
-        fileid = cursor.fetchone()[0]
-    args = {
-        'module_ident_hash': model.ident_hash,
-        'parent_ident_hash': parent_model.ident_hash,
-        'fileid': fileid,
-        }
-    stmt = """\
-INSERT INTO collated_file_associations (context, item, fileid)
-VALUES
-  ((SELECT module_ident FROM modules
-    WHERE ident_hash(uuid, major_version, minor_version)
-   = %(parent_ident_hash)s),
-   (SELECT module_ident FROM modules
-    WHERE ident_hash(uuid, major_version, minor_version)
-   = %(module_ident_hash)s),
-   %(fileid)s)"""
-    cursor.execute(stmt, args)
+    publish_collated_documents(cursor, [model], parent_model)
 
 
 def publish_collated_tree(cursor, tree):
@@ -451,9 +641,12 @@ def publish_collated_tree(cursor, tree):
     return tree
 
 
-def republish_binders(cursor, models):
-    """Republish the Binders that share Documents in the publication context.
-    This needs to be given all the models in the publication context."""
+def find_binders_to_republish(cursor, models):
+    """Find the Binders that share Documents in the publication context.
+    This needs to be given all the models in the publication context.
+    Returns the ident-hashes of the binders to republish and a mapping
+    of previous to current ident-hashes of the documents.
+    """
     documents = set([])
     binders = set([])
     history_mapping = {}  # <previous-ident-hash>: <current-ident-hash>
@@ -468,74 +661,191 @@ def republish_binders(cursor, models):
         else:
             documents.add(split_ident_hash(model.ident_hash))
 
-    to_be_republished = []
-    # What binders are these documents a part of?
-    for (uuid, version) in documents:
-        ident_hash = join_ident_hash(uuid, version)
-        previous_ident_hash = get_previous_publication(cursor, ident_hash)
-        if previous_ident_hash is None:
-            # Has no prior existence.
-            continue
-        else:
-            history_mapping[previous_ident_hash] = ident_hash
+    # What are the previous versions of these documents?
+    previous_publications = get_previous_publications(
+        cursor, [join_ident_hash(uuid, version)
+                 for (uuid, version) in documents])
+    for ident_hash, (previous_ident_hash, _) in previous_publications.items():
+        history_mapping[previous_ident_hash] = ident_hash
+
+    to_be_republished = set([])
+    # What binders are the previous versions a part of?
+    previous_module_idents = [module_ident for _, module_ident
+                              in previous_publications.values()]
+    if previous_module_idents:
         cursor.execute("""\
 WITH RECURSIVE t(nodeid, parent_id, documentid, path) AS (
   SELECT tr.nodeid, tr.parent_id, tr.documentid, ARRAY[tr.nodeid]
   FROM trees tr
-  WHERE tr.documentid = (
-    SELECT module_ident FROM modules
-    WHERE ident_hash(uuid, major_version, minor_version) = %s)
+  WHERE tr.documentid = ANY (%s)
 UNION ALL
   SELECT c.nodeid, c.parent_id, c.documentid, path || ARRAY[c.nodeid]
   FROM trees c JOIN t ON (c.nodeid = t.parent_id)
   WHERE not c.nodeid = ANY(t.path)
 )
-SELECT ident_hash(uuid, major_version, minor_version)
+SELECT DISTINCT ident_hash(uuid, major_version, minor_version)
 FROM t JOIN latest_modules m ON (t.documentid = m.module_ident)
 WHERE t.parent_id IS NULL
 """,
-                       (previous_ident_hash,))
-        to_be_republished.extend([split_ident_hash(x[0])
-                                  for x in cursor.fetchall()])
-    to_be_republished = set(to_be_republished)
+                       (previous_module_idents,))
+        to_be_republished = set([split_ident_hash(x[0])
+                                 for x in cursor.fetchall()])
+
+    # Binders already in the publication context are not republished.
+    to_be_republished = sorted([join_ident_hash(uuid, version)
+                                for (uuid, version) in to_be_republished
+                                if uuid not in binders])
+    return to_be_republished, history_mapping
+
+
+def republish_binder(cursor, ident_hash, history_mapping):
+    """Republish the binder identified as ``ident_hash`` as a minor version
+    with its tree remapped through ``history_mapping``, which is updated
+    with the republished binder. Returns the republished ident-hash.
+
+    An advisory lock on the binder's uuid is held for the rest of the
+    transaction, so that concurrent republishing of the same binder
+    does not attempt to bump it to the same version.
+    """
+    uuid = split_ident_hash(ident_hash)[0]
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))",
+                   ('republish:{}'.format(uuid),))
+    bumped_version = bump_version(cursor, uuid, is_minor_bump=True)
+    republished_ident_hash = republish_collection(cursor, ident_hash,
+                                                  version=bumped_version)
+    # Set the identifier history.
+    history_mapping[ident_hash] = republished_ident_hash
+    rebuild_collection_tree(cursor, ident_hash, history_mapping)
+    return republished_ident_hash
+
+
+def republish_binders(cursor, models):
+    """Republish the Binders that share Documents in the publication context.
+    This needs to be given all the models in the publication context."""
+    to_be_republished, history_mapping = find_binders_to_republish(
+        cursor, models)
 
     republished_ident_hashes = []
     # Republish the Collections set.
-    for (uuid, version) in to_be_republished:
-        if uuid in binders:
-            # This binder is already in the publication context,
-            # don't try to publish it again.
-            continue
-        ident_hash = join_ident_hash(uuid, version)
-        bumped_version = bump_version(cursor, uuid, is_minor_bump=True)
-        republished_ident_hash = republish_collection(cursor, ident_hash,
-                                                      version=bumped_version)
-        # Set the identifier history.
-        history_mapping[ident_hash] = republished_ident_hash
-        rebuild_collection_tree(cursor, ident_hash, history_mapping)
-        republished_ident_hashes.append(republished_ident_hash)
-
+    for ident_hash in to_be_republished:
+        republished_ident_hashes.append(
+            republish_binder(cursor, ident_hash, history_mapping))
     return republished_ident_hashes
 
 
+def republish_binders_in_parallel(cursor, publication_id, models):
+    """Republish the Binders that share Documents in the publication context
+    using a Celery task per binder, each in its own transaction.
+    The publication's state is set once all of them have finished
+    (see ``finish_republishing``).
+    Returns the ident-hashes of the binders that are being republished.
+
+    This commits the current transaction, so that the tasks are able to
+    see the publication's documents. When the tasks can't be queued,
+    the publication is marked as failed.
+    """
+    to_be_republished, history_mapping = find_binders_to_republish(
+        cursor, models)
+    if not to_be_republished:
+        return []
+    cursor.connection.commit()
+
+    celery_app = get_current_registry().celery_app
+    republish_task = celery_app.tasks[
+        'cnxpublishing.publish.republish_binder_task']
+    finish_task = celery_app.tasks[
+        'cnxpublishing.publish.finish_republishing']
+    header = [republish_task.s(ident_hash, history_mapping)
+              for ident_hash in to_be_republished]
+    try:
+        celery.chord(header)(finish_task.s(publication_id,
+                                           to_be_republished))
+    except Exception:
+        logger.exception('Failed to queue the republishing of '
+                         'publication_id={}'.format(publication_id))
+        for ident_hash in to_be_republished:
+            set_publication_failure(
+                cursor,
+                RepublishError(ident_hash, publication_id=publication_id))
+        # Otherwise the publication is left in the 'Publishing' state.
+        cursor.connection.commit()
+        raise
+    return to_be_republished
+
+
+@with_db_cursor
+def _republish_binder(ident_hash, history_mapping, cursor):
+    return republish_binder(cursor, ident_hash, history_mapping)
+
+
+@task()
+def republish_binder_task(ident_hash, history_mapping):
+    """Republish a binder in its own transaction.
+    Returns the republished ident-hash or ``None`` when it failed.
+    """
+    try:
+        return _republish_binder(ident_hash, history_mapping)
+    except Exception:
+        logger.exception('Uncaught exception during republishing '
+                         'ident_hash={}'.format(ident_hash))
+        return None
+
+
+@task()
+@with_db_cursor
+def finish_republishing(results, publication_id, ident_hashes, cursor=None):
+    """Set the state of the publication once the binders (``ident_hashes``)
+    have been republished, given the ``results`` of their tasks.
+    """
+    failures = [ident_hash
+                for ident_hash, result in zip(ident_hashes, results)
+                if result is None]
+    for ident_hash in failures:
+        set_publication_failure(
+            cursor, RepublishError(ident_hash, publication_id=publication_id))
+    if not failures:
+        cursor.execute("""\
+UPDATE publications
+SET state = 'Done/Success'
+WHERE id = %s""", (publication_id,))
+
+
+def get_previous_publications(cursor, ident_hashes):
+    """Get the previous publications of the given publications.
+    Returns a mapping of the given ident-hashes to the ident-hash and
+    module_ident of their previous publication. Publications without a
+    prior existence are left out of the mapping.
+    """
+    module_idents = lookup_module_idents(cursor, ident_hashes)
+    if not module_idents:
+        return {}
+    ident_hashes, module_idents = zip(*module_idents.items())
+    cursor.execute("""\
+SELECT context.ident_hash,
+       ident_hash(p.uuid, p.major_version, p.minor_version),
+       p.module_ident
+FROM unnest(%s::text[], %s::integer[])
+     AS context(ident_hash, module_ident)
+     JOIN modules AS c ON (c.module_ident = context.module_ident)
+     CROSS JOIN LATERAL (
+       SELECT m.uuid, m.major_version, m.minor_version, m.module_ident
+       FROM modules AS m
+       WHERE m.uuid = c.uuid AND m.module_ident < c.module_ident
+       ORDER BY m.revised DESC
+       LIMIT 1) AS p""", (list(ident_hashes), list(module_idents),))
+    return dict([(ident_hash, (previous_ident_hash, module_ident,))
+                 for ident_hash, previous_ident_hash, module_ident
+                 in cursor.fetchall()])
+
+
 def get_previous_publication(cursor, ident_hash):
     """Get the previous publication of the given
     publication as an ident-hash.
     """
-    cursor.execute("""\
-WITH contextual_module AS (
-  SELECT uuid, module_ident
-  FROM modules
-  WHERE ident_hash(uuid, major_version, minor_version) = %s)
-SELECT ident_hash(m.uuid, m.major_version, m.minor_version)
-FROM modules AS m JOIN contextual_module AS context ON (m.uuid = context.uuid)
-WHERE
-  m.module_ident < context.module_ident
-ORDER BY revised DESC
-LIMIT 1""", (ident_hash,))
+    previous = get_previous_publications(cursor, [ident_hash])
     try:
-        previous_ident_hash = cursor.fetchone()[0]
-    except TypeError:  # NoneType
+        previous_ident_hash = previous[ident_hash][0]
+    except KeyError:
         previous_ident_hash = None
     return previous_ident_hash
 
@@ -576,7 +886,7 @@ def republish_collection(cursor, ident_hash, version):
 WITH previous AS (
   SELECT module_ident
   FROM modules
-  WHERE ident_hash(uuid, major_version, minor_version) = %s),
+  WHERE module_ident = %s),
 inserted AS (
   INSERT INTO modules
     (uuid, major_version, minor_version, revised,
@@ -610,97 +920,53 @@ tags AS (
   SELECT i.module_ident, tagid
   FROM moduletags AS mt, inserted AS i, previous AS p
   WHERE mt.module_ident = p.module_ident)
-SELECT ident_hash FROM inserted""",
-                   (ident_hash, major_version, minor_version,))
-    repub_ident_hash = cursor.fetchone()[0]
+SELECT ident_hash, module_ident FROM inserted""",
+                   (lookup_module_ident(cursor, ident_hash),
+                    major_version, minor_version,))
+    repub_ident_hash, repub_module_ident = cursor.fetchone()
+    remember_module_ident(cursor, repub_ident_hash, repub_module_ident)
     return repub_ident_hash
 
 
 def rebuild_collection_tree(cursor, ident_hash, history_map):
     """Create a new tree for the collection based on the old tree but with
-    new document ids
+    new document ids. The tree is copied by the database in one statement.
+    Returns the ``nodeid`` of the new tree's root.
     """
-    collection_tree_sql = """\
-WITH RECURSIVE t(nodeid, parent_id, documentid, title, childorder, latest,
-                 ident_hash, path) AS (
-  SELECT
-    tr.nodeid, tr.parent_id, tr.documentid,
-    tr.title, tr.childorder, tr.latest,
-    (SELECT ident_hash(uuid, major_version, minor_version)
-     FROM modules
-     WHERE module_ident = tr.documentid) AS ident_hash,
-    ARRAY[tr.nodeid]
-  FROM trees AS tr
-  WHERE tr.documentid = (
-    SELECT module_ident
-    FROM modules
-    WHERE ident_hash(uuid, major_version, minor_version) = %s)
-    AND tr.is_collated = FALSE
-UNION ALL
-  SELECT
-    c.nodeid, c.parent_id, c.documentid, c.title, c.childorder, c.latest,
-    (SELECT ident_hash(uuid, major_version, minor_version)
-     FROM modules
-     WHERE module_ident = c.documentid) AS ident_hash,
-    path || ARRAY[c.nodeid]
-  FROM trees AS c JOIN t ON (c.parent_id = t.nodeid)
-  WHERE not c.nodeid = ANY(t.path) AND c.is_collated = FALSE
-)
-SELECT row_to_json(row) FROM (SELECT * FROM t) AS row"""
-
-    tree_insert_sql = """\
-INSERT INTO trees
-  (nodeid, parent_id,
-   documentid,
-   title, childorder, latest)
-VALUES
-  (DEFAULT, %(parent_id)s,
-   (SELECT module_ident
-    FROM modules
-    WHERE ident_hash(uuid, major_version, minor_version) = \
-          %(ident_hash)s),
-   %(title)s, %(childorder)s, %(latest)s)
-RETURNING nodeid"""
-
-    def get_tree():
-        cursor.execute(collection_tree_sql, (ident_hash,))
-        for row in cursor.fetchall():
-            yield row[0]
-
-    def insert(fields):
-        cursor.execute(tree_insert_sql, fields)
-        results = cursor.fetchone()[0]
-        return results
-
-    tree = {}  # {<current-nodeid>: {<row-data>...}, ...}
-    children = {}  # {<nodeid>: [<child-nodeid>, ...], <child-nodeid>: [...]}
-    for node in get_tree():
-        tree[node['nodeid']] = node
-        children.setdefault(node['parent_id'], [])
-        children[node['parent_id']].append(node['nodeid'])
-
-    def build_tree(nodeid, parent_id):
-        data = tree[nodeid]
-        data['parent_id'] = parent_id
-        if history_map.get(data['ident_hash']) is not None \
-           and (data['latest'] or parent_id is None):
-            data['ident_hash'] = history_map[data['ident_hash']]
-        new_nodeid = insert(data)
-        for child_nodeid in children.get(nodeid, []):
-            build_tree(child_nodeid, new_nodeid)
-
-    root_node = children[None][0]
-    build_tree(root_node, None)
+    module_idents = lookup_module_idents(
+        cursor, [ident_hash] + list(history_map.keys()) +
+        list(history_map.values()))
+    history = [(module_idents[previous], module_idents[current],)
+               for previous, current in history_map.items()
+               if previous in module_idents and current in module_idents]
+    previous, current = [list(x) for x in zip(*history)] or ([], [])
+    cursor.execute(TREE_CLONE, {
+        'module_ident': module_idents.get(ident_hash),
+        'previous': previous,
+        'current': current,
+        })
+    try:
+        root_nodeid = cursor.fetchone()[0]
+    except TypeError:  # NoneType
+        root_nodeid = None
+    return root_nodeid
 
 
 __all__ = (
     'bump_version',
+    'find_binders_to_republish',
+    'finish_republishing',
     'get_previous_publication',
+    'get_previous_publications',
     'publish_collated_document',
+    'publish_collated_documents',
     'publish_collated_tree',
     'publish_composite_model',
     'publish_model',
     'rebuild_collection_tree',
+    'republish_binder',
+    'republish_binder_task',
     'republish_binders',
+    'republish_binders_in_parallel',
     'republish_collection',
     )
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2017, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""\
+A registry of frequently executed SQL statements.
+
+A statement is registered once, by name, with SQL that uses named
+(``%(name)s``) parameters. The first time a statement is executed on
+a connection, it is prepared on that connection (using ``PREPARE``),
+so that later executions skip parsing and planning the statement
+(using ``EXECUTE``). Prepared statements outlive the transaction and
+live for as long as the connection, which is why this works best with
+pooled connections (see ``cnxpublishing.pool.Connection``). On other
+connections the statement is executed as is.
+
+"""
+import re
+
+
+# Matches the named parameters, including any type cast that follows
+# them, and the escaped percent signs of a statement.
+_PARAMETER_PATTERN = re.compile(r'%\((\w+)\)s((?:::\w+(?:\[\])?)?)|%%')
+
+_registry = {}
+
+
+class Statement(object):
+    """A named SQL statement that uses named (pyformat) parameters."""
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.parameters = []
+        casts = {}
+
+        def to_positional(match):
+            parameter, cast = match.groups()
+            if parameter is None:
+                return '%'
+            if parameter not in self.parameters:
+                self.parameters.append(parameter)
+            if cast:
+                casts.setdefault(parameter, cast)
+            return '${}{}'.format(self.parameters.index(parameter) + 1, cast)
+
+        self.prepare_sql = 'PREPARE {} AS {}'.format(
+            name, _PARAMETER_PATTERN.sub(to_positional, sql))
+        # The arguments are cast like the parameters are, because
+        # some values (e.g. an array of nulls) can not be coerced
+        # to the parameter's type otherwise.
+        arguments = ['%({})s{}'.format(x, casts.get(x, ''))
+                     for x in self.parameters]
+        if arguments:
+            self.execute_sql = 'EXECUTE {} ({})'.format(
+                name, ', '.join(arguments))
+        else:
+            self.execute_sql = 'EXECUTE {}'.format(name)
+
+    def __repr__(self):  # pragma: no cover
+        return "<{} {}>".format(type(self).__name__, self.name)
+
+    def execute(self, cursor, params=None):
+        """Execute the statement with ``params`` using the ``cursor``."""
+        prepared = getattr(cursor.connection, 'prepared_statements', None)
+        if prepared is None:
+            cursor.execute(self.sql, params)
+            return
+        if self.name not in prepared:
+            cursor.execute(self.prepare_sql)
+            prepared.add(self.name)
+        cursor.execute(self.execute_sql, params or {})
+
+
+def register_statement(name, sql):
+    """Register the ``sql`` as the statement called ``name``.
+    Registering the same statement again returns the registered statement.
+    """
+    try:
+        statement = _registry[name]
+    except KeyError:
+        statement = _registry[name] = Statement(name, sql)
+    else:
+        if statement.sql != sql:
+            raise ValueError("A different statement is already registered "
+                             "as '{}'.".format(name))
+    return statement
+
+
+def get_statement(name):
+    """Returns the statement registered as ``name``."""
+    return _registry[name]
+
+
+def execute_statement(cursor, name, params=None):
+    """Execute the statement registered as ``name`` with ``params``
+    using the ``cursor``.
+    """
+    get_statement(name).execute(cursor, params)
+
+
+__all__ = (
+    'execute_statement',
+    'get_statement',
+    'register_statement',
+    'Statement',
+    )
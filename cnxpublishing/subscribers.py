@@ -7,8 +7,9 @@ from pyramid.threadlocal import get_current_registry
 
 
 from . import events
-from .bake import remove_baked, bake
+from .bake import bake, formatter_fingerprint, remove_baked
 from .db import (
+    poke_publication_state,
     update_module_state,
     with_db_cursor,
 )
@@ -46,6 +47,17 @@ def post_publication_processing(event, cursor):
     track_baking_proc_state(result, module_ident, cursor)
 
 
+@subscriber(events.PublicationAcceptanceEvent)
+def publication_acceptance_processing(event):
+    """Move the publication along once its acceptances have changed."""
+    publication_id = event.publication_id
+    logger.debug('Processing acceptances of publication_id={}'
+                 .format(publication_id))
+    state, messages = poke_publication_state(publication_id)
+    logger.debug('publication_id={} is in the \'{}\' state'
+                 .format(publication_id, state))
+
+
 def _get_recipe_ids(module_ident, cursor):
     """Returns a tuple of length 2 of primary and fallback recipe ids.
 
@@ -93,8 +105,7 @@ def baking_processor(module_ident, ident_hash, cursor=None):
 
     cursor.execute("""\
 SELECT submitter, submitlog FROM modules
-WHERE ident_hash(uuid, major_version, minor_version) = %s""",
-                   (ident_hash,))
+WHERE module_ident = %s""", (module_ident,))
     publisher, message = cursor.fetchone()
     remove_baked(ident_hash, cursor=cursor)
 
@@ -122,6 +133,10 @@ WHERE ident_hash(uuid, major_version, minor_version) = %s""",
             update_module_state(cursor, module_ident, state, recipe_id)
             break
 
+    # Remembered as the result of the task, so that the next bake
+    # is able to tell whether this bake's content can be reused.
+    return {'formatter': formatter_fingerprint()}
+
 
 @subscriber(events.ChannelProcessingStartUpEvent)
 @with_db_cursor
@@ -144,7 +159,20 @@ WHERE stateid = (
     WHERE statename = 'post-publication');""")
 
 
+@subscriber(events.ChannelProcessingStartUpEvent)
+@with_db_cursor
+def publication_acceptance_start_up(event, cursor):
+    # Catch up on the acceptances made while the processor was down.
+    cursor.execute("""\
+SELECT pg_notify('publication_acceptance',
+                 '{"publication_id": '||id||'}')
+FROM publications
+WHERE state = 'Waiting for acceptance';""")
+
+
 __all__ = (
     'post_publication_processing',
     'post_publication_start_up',
+    'publication_acceptance_processing',
+    'publication_acceptance_start_up',
 )
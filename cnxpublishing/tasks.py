@@ -70,6 +70,10 @@ def includeme(config):
         result_backend=settings['celery.backend'],
         result_persistent=True,
     )
+    if 'celery.result_expires' in settings:
+        # Seconds to keep the task results for, where 0 keeps them forever.
+        expires = int(settings['celery.result_expires'])
+        config.registry.celery_app.conf.result_expires = expires or None
     # Override the existing Task class.
     config.registry.celery_app.Task = PyramidAwareTask
 
@@ -6,18 +6,47 @@
 # See LICENCE.txt for details.
 # ###
 import unittest
+import uuid
+from copy import deepcopy
 try:
     from unittest import mock
 except ImportError:
     import mock
 
 import cnxepub
+from pyramid import testing
 
 from . import use_cases
 from .testing import db_connect
 from .test_db import BaseDatabaseIntegrationTestCase
 
 
+class BakedFormatterFingerprintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        self.celery_app = mock.Mock()
+        self.config.registry.celery_app = self.celery_app
+
+    @property
+    def target(self):
+        from cnxpublishing.bake import _baked_formatter_fingerprint
+        return _baked_formatter_fingerprint
+
+    def test(self):
+        self.celery_app.AsyncResult.return_value = mock.Mock(
+            state='SUCCESS', result={'formatter': 'abc'})
+        self.assertEqual(self.target(1), 'abc')
+        self.celery_app.AsyncResult.assert_called_once_with('1')
+
+    def test_expired(self):
+        # An expired (or unknown) result is reported as pending.
+        self.celery_app.AsyncResult.return_value = mock.Mock(
+            state='PENDING', result=None)
+        self.assertEqual(self.target(1), None)
+
+
 class AmendWithBakeTestCase(BaseDatabaseIntegrationTestCase):
 
     @property
@@ -42,8 +71,7 @@ WHERE
         file = cursor.fetchone()[0]
         return file[:]
 
-    @db_connect
-    def test(self, cursor):
+    def check_bake(self, cursor):
         binder = use_cases.setup_COMPLEX_BOOK_ONE_in_archive(self, cursor)
         cursor.connection.commit()
         publisher = 'ream'
@@ -103,6 +131,112 @@ WHERE
         for doc, content in content_to_check:
             self.assertIn(content, self._get_baked_file(cursor, doc, binder))
 
+    @db_connect
+    def test(self, cursor):
+        self.check_bake(cursor)
+
+    @db_connect
+    def test_pipeline(self, cursor):
+        settings = self.config.registry.settings
+        settings['baking.pipeline'] = 'true'
+        settings['baking.pipeline.threads'] = '2'
+        self.check_bake(cursor)
+
+    @db_connect
+    def test_incremental(self, cursor):
+        settings = self.config.registry.settings
+        settings['baking.incremental'] = 'true'
+        settings['baking.incremental.print_styles'] = 'chapters'
+        binder = use_cases.setup_COMPLEX_BOOK_ONE_in_archive(self, cursor)
+        revised_binder = deepcopy(binder)
+        publisher = 'ream'
+        msg = 'part of collated publish'
+
+        metadata = [x.metadata.copy()
+                    for x in cnxepub.flatten_to_documents(binder)][0]
+        del metadata['cnx-archive-uri']
+        del metadata['version']
+        metadata['created'] = None
+        metadata['revised'] = None
+        metadata['title'] = "Made up of other things"
+
+        collated = []  # the chapter sizes given to each collation
+        composites = []
+
+        def cnxepub_collate(binder_model, ruleset=None, includes=None):
+            collated.append([len(chapter) for chapter in binder_model])
+            for chapter in binder_model:
+                for doc in chapter:
+                    doc.content = '<p>collated</p>'
+                composite_doc = cnxepub.CompositeDocument(
+                    None, '<p>composite</p>', metadata.copy())
+                chapter.append(composite_doc)
+                composites.append(composite_doc)
+            return binder_model
+
+        from cnxpublishing.bake import formatter_fingerprint
+        from cnxpublishing.db import update_module_state
+        fake_recipe_id = 1
+
+        with mock.patch('cnxpublishing.bake.collate_models') as mock_collate:
+            mock_collate.side_effect = cnxepub_collate
+            self.target(binder, fake_recipe_id, publisher, msg, cursor=cursor)
+        baked_composites = [x.ident_hash for x in composites]
+
+        # Mark the book as baked, as the baking task would.
+        cursor.execute("""\
+SELECT module_ident
+FROM modules
+WHERE ident_hash(uuid, major_version, minor_version) = %s""",
+                       (binder.ident_hash,))
+        module_ident = cursor.fetchone()[0]
+        update_module_state(cursor, module_ident, 'current', fake_recipe_id)
+        cursor.execute("""\
+INSERT INTO document_baking_result_associations (module_ident, result_id)
+VALUES (%s, %s)""", (module_ident, str(uuid.uuid4()),))
+
+        # Revise the second chapter of the book.
+        from cnxpublishing.publish import publish_model
+        revised_binder.metadata['version'] = '1.2'
+        revised_binder[1] = cnxepub.TranslucentBinder(
+            metadata={u'title': u'Part Two'},
+            title_overrides=['Document Four', 'Document Three'],
+            nodes=[revised_binder[1][1], revised_binder[1][0]])
+        publish_model(cursor, revised_binder, publisher, msg)
+        cursor.execute("UPDATE modules SET print_style = 'chapters' "
+                       "WHERE uuid = %s", (binder.id,))
+
+        with mock.patch('cnxpublishing.bake.collate_models') as mock_collate, \
+                mock.patch('cnxpublishing.bake._baked_formatter_fingerprint',
+                           return_value=formatter_fingerprint()):
+            mock_collate.side_effect = cnxepub_collate
+            errors = self.target(revised_binder, fake_recipe_id,
+                                 publisher, msg, cursor=cursor)
+        self.assertEqual(errors, [])
+
+        # Only the revised chapter was collated.
+        self.assertEqual(collated, [[2, 2], [0, 2]])
+
+        # The baked tree reuses the first chapter's composite,
+        # but not the second's.
+        cursor.execute("SELECT tree_to_json(%s, %s, TRUE)::json;",
+                       (revised_binder.id, '1.2',))
+        baked_tree = cursor.fetchone()[0]
+        ident_hashes = list(cnxepub.flatten_tree_to_ident_hashes(baked_tree))
+        self.assertIn(baked_composites[0], ident_hashes)
+        self.assertNotIn(baked_composites[1], ident_hashes)
+        self.assertIn(composites[-1].ident_hash, ident_hashes)
+        self.assertEqual(
+            [x['title'] for x in baked_tree['contents'][1]['contents']],
+            ['Document Four', 'Document Three', "Made up of other things"])
+
+        # The first chapter's collated content is reused.
+        self.assertEqual(
+            self._get_baked_file(cursor, binder[0][0], binder),
+            self._get_baked_file(cursor, binder[0][0], revised_binder))
+        self.assertIn('collated', self._get_baked_file(
+            cursor, revised_binder[1][0], revised_binder))
+
 
 class RemoveBakedTestCase(BaseDatabaseIntegrationTestCase):
 
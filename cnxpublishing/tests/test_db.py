@@ -54,6 +54,100 @@ class DatabaseUtilsTestCase(unittest.TestCase):
         self.assertTrue(result)
 
 
+class ByteaCopyStreamTestCase(unittest.TestCase):
+    """Verify the rendering of file contents for ``COPY``"""
+
+    def test_read(self):
+        from ..db import _ByteaCopyStream
+        stream = _ByteaCopyStream([io.BytesIO(b'\x00\xffabc'),
+                                   io.BytesIO(b''),
+                                   io.BytesIO(b'd')],
+                                  chunk_size=2)
+
+        chunks = []
+        while True:
+            chunk = stream.read(3)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        self.assertTrue(max([len(c) for c in chunks]) <= 3)
+        self.assertEqual(b''.join(chunks),
+                         b'1\t\\\\x00ff616263\n'
+                         b'2\t\\\\x\n'
+                         b'3\t\\\\x64\n')
+
+    def test_copy(self):
+        settings = integration_test_settings()
+        from ..config import CONNECTION_STRING
+        from ..db import _copy_bytea
+        data = [os.urandom(1024 * 300), b'', os.urandom(10)]
+
+        with psycopg2.connect(settings[CONNECTION_STRING]) as db_conn:
+            with db_conn.cursor() as cursor:
+                _copy_bytea(cursor, [io.BytesIO(d) for d in data])
+                cursor.execute("SELECT ord, data FROM bytea_stream "
+                               "ORDER BY ord")
+                self.assertEqual(
+                    [(ord, bytes(d),) for ord, d in cursor.fetchall()],
+                    list(enumerate(data, 1)))
+
+    def test_copy_on_pooled_connection(self):
+        settings = integration_test_settings()
+        from ..config import CONNECTION_STRING
+        from ..db import _copy_bytea
+        from ..pool import Connection
+
+        class RecordingCursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+                self.connection = cursor.connection
+                self.executed = []
+
+            def execute(self, sql, *args):
+                self.executed.append(sql)
+                return self.cursor.execute(sql, *args)
+
+            def copy_expert(self, *args, **kwargs):
+                return self.cursor.copy_expert(*args, **kwargs)
+
+        def copy(cursor, data):
+            cursor = RecordingCursor(cursor)
+            _copy_bytea(cursor, [io.BytesIO(d) for d in data])
+            cursor.cursor.execute("SELECT data FROM bytea_stream "
+                                  "ORDER BY ord")
+            return ([bytes(d) for d, in cursor.cursor.fetchall()],
+                    cursor.executed,)
+
+        db_conn = psycopg2.connect(settings[CONNECTION_STRING],
+                                   connection_factory=Connection)
+        self.addCleanup(db_conn.close)
+        with db_conn.cursor() as cursor:
+            data, executed = copy(cursor, [b'a', b'b'])
+            self.assertEqual(data, [b'a', b'b'])
+            self.assertEqual(len(executed), 1)  # creates the table
+            self.assertTrue(db_conn.bytea_stream)
+
+            # The rows of the previous copy are dropped.
+            data, executed = copy(cursor, [b'c'])
+            self.assertEqual(data, [b'c'])
+            self.assertEqual(executed, ["DELETE FROM bytea_stream"])
+            db_conn.commit()
+
+            # The table outlives the transaction, but its rows don't.
+            self.assertFalse(db_conn.bytea_stream)
+            data, executed = copy(cursor, [b'd'])
+            self.assertEqual(data, [b'd'])
+            self.assertEqual(executed, [])
+
+            # After a rollback, the table is created anew when needed.
+            db_conn.rollback()
+            self.assertEqual(db_conn.bytea_stream, None)
+            data, executed = copy(cursor, [b'e'])
+            self.assertEqual(data, [b'e'])
+            self.assertEqual(len(executed), 1)
+
+
 class BaseDatabaseIntegrationTestCase(unittest.TestCase):
     """Verify database interactions"""
 
@@ -87,6 +181,8 @@ class BaseDatabaseIntegrationTestCase(unittest.TestCase):
 
     def tearDown(self):
         self._tear_down_database()
+        from ..db import invalidate_reference_data
+        invalidate_reference_data()
         testing.tearDown()
 
     @classmethod
@@ -178,6 +274,132 @@ VALUES (%s, %s, 'Document')""", (id, publication_id,))
         self.assertFalse(is_revision_publication(publication_id, cursor))
 
 
+class ReferenceDataTestCase(BaseDatabaseIntegrationTestCase):
+    """Verify the cached lookup of licenses, subjects and role types."""
+
+    def test_obtain_licenses(self):
+        from ..db import obtain_licenses
+        licenses = obtain_licenses()
+
+        self.assertTrue(
+            licenses[VALID_LICENSE_URL]['is_valid_for_publication'])
+        # Subsequent calls are served from the cache.
+        with mock.patch('cnxpublishing.db.db_connect') as db_connect:
+            self.assertIs(obtain_licenses(), licenses)
+        self.assertFalse(db_connect.called)
+
+    def test_obtain_subjects(self):
+        from ..db import obtain_subjects
+        subjects = obtain_subjects()
+
+        self.assertTrue(isinstance(subjects, frozenset))
+        self.assertIn(u'Humanities', subjects)
+        with mock.patch('cnxpublishing.db.db_connect') as db_connect:
+            self.assertIs(obtain_subjects(), subjects)
+        self.assertFalse(db_connect.called)
+
+    def test_role_type_to_db_type(self):
+        from ..db import _role_type_to_db_type
+        self.assertEqual(_role_type_to_db_type('authors'), 'Author')
+        with mock.patch('cnxpublishing.db.db_connect') as db_connect:
+            self.assertEqual(_role_type_to_db_type('publishers'),
+                             'Publisher')
+        self.assertFalse(db_connect.called)
+
+    def test_invalidate_reference_data(self):
+        from ..db import invalidate_reference_data, obtain_subjects
+        subjects = obtain_subjects()
+
+        invalidate_reference_data()
+
+        self.assertIsNot(obtain_subjects(), subjects)
+        self.assertEqual(obtain_subjects(), subjects)
+
+
+class ModuleIdentLookupTestCase(BaseDatabaseIntegrationTestCase):
+    """Verify the lookup of module_idents by ident-hash."""
+
+    def connect(self):
+        from ..pool import Connection
+        return psycopg2.connect(self.db_conn_str,
+                                connection_factory=Connection)
+
+    def insert_modules(self, cursor, count=1):
+        cursor.execute("""\
+INSERT INTO modules (uuid, major_version, minor_version,
+                     name, licenseid, doctype)
+SELECT uuid_generate_v4(), 1, NULL, 'title', 11, ''
+FROM generate_series(1, %s)
+RETURNING ident_hash(uuid, major_version, minor_version), module_ident""",
+                       (count,))
+        return dict(cursor.fetchall())
+
+    def test_lookup(self):
+        from ..db import lookup_module_ident, lookup_module_idents
+        with self.connect() as db_conn:
+            with db_conn.cursor() as cursor:
+                expected = self.insert_modules(cursor, 2)
+                ident_hash = list(expected.keys())[0]
+                uuid_ = split_ident_hash(ident_hash)[0]
+                ident_hashes = list(expected.keys()) + [
+                    '{}@2'.format(uuid_),  # unknown version
+                    uuid_,  # unversioned
+                    'not-an-ident-hash',
+                    ]
+
+                self.assertEqual(lookup_module_idents(cursor, ident_hashes),
+                                 expected)
+                self.assertEqual(lookup_module_ident(cursor, ident_hash),
+                                 expected[ident_hash])
+                self.assertEqual(lookup_module_ident(cursor, uuid_), None)
+
+    def test_memo(self):
+        from ..db import lookup_module_ident
+        with self.connect() as db_conn:
+            with db_conn.cursor() as cursor:
+                ident_hash, module_ident = \
+                    list(self.insert_modules(cursor).items())[0]
+
+                self.assertEqual(lookup_module_ident(cursor, ident_hash),
+                                 module_ident)
+                self.assertEqual(db_conn.module_idents,
+                                 {ident_hash: module_ident})
+                # Subsequent lookups are answered from the memo.
+                db_conn.module_idents[ident_hash] = -1
+                self.assertEqual(lookup_module_ident(cursor, ident_hash), -1)
+
+                # The memo does not outlive the transaction.
+                db_conn.rollback()
+                self.assertEqual(db_conn.module_idents, {})
+                self.assertEqual(lookup_module_ident(cursor, ident_hash),
+                                 None)
+
+    def test_query_plan(self):
+        # Benchmarks the lookup on a large ``modules`` table that lacks
+        # the functional ``ident_hash`` index.
+        from ..db import lookup_module_idents
+        with self.connect() as db_conn:
+            with db_conn.cursor() as cursor:
+                ident_hashes = list(self.insert_modules(cursor, 10000))[:3]
+                cursor.execute("DROP INDEX IF EXISTS modules_ident_hash")
+                cursor.execute("ANALYZE modules")
+
+                def explain(stmt, args=None):
+                    cursor.execute('EXPLAIN ' + stmt, args)
+                    return '\n'.join([r[0] for r in cursor.fetchall()])
+
+                plan_by_function = explain("""\
+SELECT module_ident FROM modules
+WHERE ident_hash(uuid, major_version, minor_version) = ANY (%s)""",
+                                           (ident_hashes,))
+                lookup_module_idents(cursor, ident_hashes)
+                plan_by_columns = explain(cursor.query.decode('utf-8'))
+
+        self.assertIn('Seq Scan on modules', plan_by_function)
+        self.assertNotIn('Seq Scan on modules', plan_by_columns)
+        self.assertIn('modules_uuid_idx', plan_by_columns)
+
+
 class PublicationLicenseAcceptanceTestCase(BaseDatabaseIntegrationTestCase):
     """Verify license acceptance functionality"""
 
@@ -263,6 +485,95 @@ ORDER BY user_id""", (uuid_,))
         expected = [('frahablar',), ('rings',)]
         self.assertEqual(entries, expected)
 
+    def test_accept_license_notification(self):
+        """The channel processor is only notified of acceptance changes
+        when asked to be.
+        """
+        from ..db import accept_publication_license
+        with psycopg2.connect(self.db_conn_str) as listen_conn:
+            listen_conn.autocommit = True
+            with listen_conn.cursor() as listen_cursor:
+                listen_cursor.execute('LISTEN publication_acceptance')
+
+            for notify in (False, True,):
+                with psycopg2.connect(self.db_conn_str) as db_conn:
+                    with db_conn.cursor() as cursor:
+                        accept_publication_license(
+                            cursor, self.publication_id, 'ream', [],
+                            True, notify=notify)
+                listen_conn.poll()
+                payloads = [json.loads(n.payload)
+                            for n in listen_conn.notifies]
+                del listen_conn.notifies[:]
+                if notify:
+                    self.assertEqual(
+                        payloads, [{'publication_id': self.publication_id}])
+                else:
+                    self.assertEqual(payloads, [])
+
+
+class PendingDocumentStatesTestCase(BaseDatabaseIntegrationTestCase):
+    """Verify the evaluation of the pending documents' acceptance states"""
+
+    def setUp(self):
+        super(PendingDocumentStatesTestCase, self).setUp()
+        self.publication_id = self.make_publication()
+
+    def call_target(self, *args, **kwargs):
+        from ..db import _evaluate_pending_document_states
+        return _evaluate_pending_document_states(*args, **kwargs)
+
+    def make_pending_document(self, cursor, license_accepted=False,
+                              licenses=(), roles=()):
+        cursor.execute("""\
+WITH control_insert AS (
+  INSERT INTO document_controls (uuid) VALUES (DEFAULT) RETURNING uuid)
+INSERT INTO pending_documents
+  (publication_id, uuid, major_version, minor_version,
+   type, license_accepted)
+VALUES (%s, (SELECT uuid FROM control_insert), 1, NULL, 'Document', %s)
+RETURNING id, uuid""", (self.publication_id, license_accepted,))
+        pending_id, uuid_ = cursor.fetchone()
+        for user_id, accepted in licenses:
+            cursor.execute("""\
+INSERT INTO license_acceptances (uuid, user_id, accepted)
+VALUES (%s, %s, %s)""", (uuid_, user_id, accepted,))
+        for user_id, accepted in roles:
+            cursor.execute("""\
+INSERT INTO role_acceptances (uuid, user_id, role_type, accepted)
+VALUES (%s, %s, 'Author', %s)""", (uuid_, user_id, accepted,))
+        return pending_id
+
+    @db_connect
+    def test(self, cursor):
+        partially_accepted = self.make_pending_document(
+            cursor,
+            licenses=[('charrose', True), ('ream', True)],
+            roles=[('charrose', True), ('ream', None)])
+        nothing_to_accept = self.make_pending_document(cursor)
+        accepted = self.make_pending_document(
+            cursor, license_accepted=True,
+            # Once accepted, a state is not evaluated again.
+            licenses=[('charrose', False)],
+            roles=[('charrose', True)])
+
+        states = self.call_target(cursor, self.publication_id)
+
+        self.assertEqual(states, {
+            partially_accepted: [True, False],
+            nothing_to_accept: [None, None],
+            accepted: [True, True],
+            })
+        cursor.execute("""\
+SELECT id, license_accepted, roles_accepted
+FROM pending_documents
+WHERE publication_id = %s""", (self.publication_id,))
+        self.assertEqual(dict([(r[0], r[1:]) for r in cursor.fetchall()]), {
+            partially_accepted: (True, False),
+            nothing_to_accept: (False, False),
+            accepted: (True, True),
+            })
+
 
 class LicenseRequestTestCase(BaseDatabaseIntegrationTestCase):
     """Verify license request functionality"""
@@ -463,6 +774,92 @@ ORDER BY user_id""", (uuid_,))
         self.assertEqual(entries, expected)
 
 
+class PublicationAcceptancesTestCase(BaseDatabaseIntegrationTestCase):
+    """Verify license and role acceptance functionality
+    for a whole publication"""
+
+    def setUp(self):
+        super(PublicationAcceptancesTestCase, self).setUp()
+        self.publication_id = self.make_publication()
+
+    def call_target(self, *args, **kwargs):
+        from ..db import upsert_publication_acceptances
+        return upsert_publication_acceptances(*args, **kwargs)
+
+    def insert_pending_document(self, cursor, model, type_):
+        cursor.execute("""\
+WITH control_insert AS (
+  INSERT INTO document_controls (uuid) VALUES (DEFAULT) RETURNING uuid)
+INSERT INTO pending_documents
+  (publication_id, uuid, major_version, minor_version,
+   type, metadata)
+VALUES (%s, (SELECT uuid FROM control_insert), 1, 1, %s, %s)
+RETURNING id, uuid""", (self.publication_id, type_,
+                        json.dumps(model.metadata),))
+        return cursor.fetchone()
+
+    @db_connect
+    def test(self, cursor):
+        book_id, book_uuid = self.insert_pending_document(
+            cursor, use_cases.BOOK, 'Binder')
+        page_id, page_uuid = self.insert_pending_document(
+            cursor, use_cases.PAGE_ONE, 'Document')
+
+        # Everyone has already accepted the book's license and roles.
+        roles = [
+            ('charrose', 'Author'), ('frahablar', 'Illustrator'),
+            ('frahablar', 'Translator'), ('impicky', 'Editor'),
+            ('marknewlyn', 'Author'), ('ream', 'Copyright Holder'),
+            ('ream', 'Publisher'), ('rings', 'Publisher'),
+            ]
+        for uid in sorted(set([uid for uid, _ in roles])):
+            cursor.execute("""\
+INSERT INTO license_acceptances (uuid, user_id, accepted)
+VALUES (%s, %s, TRUE)""", (book_uuid, uid,))
+        for uid, role_type in roles:
+            cursor.execute("""\
+INSERT INTO role_acceptances (uuid, user_id, role_type, accepted)
+VALUES (%s, %s, %s, TRUE)""", (book_uuid, uid, role_type,))
+
+        # Call the target.
+        self.call_target(cursor, self.publication_id)
+
+        # Check the results.
+        cursor.execute("""\
+SELECT uuid = %s, user_id, accepted
+FROM license_acceptances
+ORDER BY uuid = %s, user_id""", (book_uuid, book_uuid,))
+        self.assertEqual(cursor.fetchall(), [
+            (False, 'charrose', None), (False, 'frahablar', None),
+            (False, 'impicky', None), (False, 'marknewlyn', None),
+            (False, 'ream', None), (False, 'rings', None),
+            (False, 'sarblyth', None),
+            (True, 'charrose', True), (True, 'frahablar', True),
+            (True, 'impicky', True), (True, 'marknewlyn', True),
+            (True, 'ream', True), (True, 'rings', True),
+            ])
+        cursor.execute("""\
+SELECT user_id, role_type, accepted
+FROM role_acceptances
+WHERE uuid = %s
+ORDER BY user_id, role_type""", (page_uuid,))
+        self.assertEqual(cursor.fetchall(), [
+            ('charrose', 'Author', None), ('frahablar', 'Illustrator', None),
+            ('frahablar', 'Translator', None), ('impicky', 'Editor', None),
+            ('marknewlyn', 'Author', None),
+            ('ream', 'Copyright Holder', None), ('ream', 'Publisher', None),
+            ('rings', 'Publisher', None), ('sarblyth', 'Author', None),
+            ])
+        cursor.execute("""\
+SELECT id, license_accepted, roles_accepted
+FROM pending_documents
+ORDER BY id""")
+        self.assertEqual(cursor.fetchall(), [
+            (book_id, True, True),
+            (page_id, False, False),
+            ])
+
+
 class RoleRequestTestCase(BaseDatabaseIntegrationTestCase):
     """Verify role acceptance request functionality"""
 
@@ -709,6 +1106,38 @@ class UserUpsertTestCase(BaseDatabaseIntegrationTestCase):
         entries = [x[0] for x in cursor.fetchall()]
         self.assertIn(uids[-1], entries)
 
+    def test_profiles_looked_up_once(self):
+        """Profiles are looked up once per transaction"""
+        from openstax_accounts.interfaces import IOpenstaxAccounts
+        accounts = self.config.registry.getUtility(IOpenstaxAccounts)
+        uids = ['charrose', 'frahablar', 'impicky']
+
+        from ..pool import Connection
+        db_conn = psycopg2.connect(self.db_conn_str,
+                                   connection_factory=Connection)
+        self.addCleanup(db_conn.close)
+        with mock.patch.object(accounts, 'get_profile_by_username',
+                               wraps=accounts.get_profile_by_username) \
+                as get_profile:
+            with db_conn:
+                with db_conn.cursor() as cursor:
+                    self.call_target(cursor, uids[:2])
+                    self.call_target(cursor, uids)
+            looked_up = sorted([c[0][0] for c in get_profile.call_args_list])
+            self.assertEqual(looked_up, uids)
+
+            # Nothing is remembered beyond the transaction.
+            with db_conn:
+                with db_conn.cursor() as cursor:
+                    self.call_target(cursor, uids[:1])
+            self.assertEqual(get_profile.call_count, len(uids) + 1)
+
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                cursor.execute("SELECT username FROM users "
+                               "ORDER BY username")
+                self.assertEqual([x[0] for x in cursor.fetchall()], uids)
+
     @db_connect
     def test_fetch_error(self, cursor):
         """Verify user fetch error"""
@@ -740,6 +1169,99 @@ SELECT COUNT(*) FROM pending_resources WHERE hash = %s""", [
         self.assertEqual(resource.id,
                          '22596363b3de40b06f981fb85d82312e8c0ed511')
 
+    def test_add_stored_pending_resources(self):
+        """Add pending resources that have already been stored"""
+        resource = cnxepub.Resource('a.txt', io.BytesIO('hello world\n'),
+                                    'text/plain')
+        other_resource = cnxepub.Resource('b.txt', io.BytesIO('hi world\n'),
+                                          'text/plain')
+
+        from ..db import add_pending_resource, lookup_pending_resource_hashes
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                add_pending_resource(cursor, resource)
+                stored_hashes = lookup_pending_resource_hashes(
+                    cursor, [resource.hash, other_resource.hash,
+                             resource.hash])
+                self.assertEqual(stored_hashes, set([resource.hash]))
+
+                with mock.patch('cnxpublishing.db._copy_bytea') as copy:
+                    add_pending_resource(cursor, resource,
+                                         stored_hashes=stored_hashes)
+                self.assertFalse(copy.called)
+
+                add_pending_resource(cursor, other_resource,
+                                     stored_hashes=stored_hashes)
+                self.assertEqual(stored_hashes,
+                                 set([resource.hash, other_resource.hash]))
+                cursor.execute("SELECT count(*) FROM pending_resources")
+                self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_add_pending_resources(self):
+        """Add the resources of a document at once"""
+        resources = [
+            cnxepub.Resource('a.txt', io.BytesIO('hello world\n'),
+                             'text/plain'),
+            cnxepub.Resource('b.txt', io.BytesIO('hi world\n'),
+                             'text/plain'),
+            cnxepub.Resource('c.txt', io.BytesIO('hello world\n'),
+                             'text/plain'),
+            ]
+
+        from ..db import _copy_bytea, add_pending_resources
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                stored_hashes = set([])
+                with mock.patch('cnxpublishing.db._copy_bytea',
+                                wraps=_copy_bytea) as copy:
+                    add_pending_resources(cursor, resources,
+                                          stored_hashes=stored_hashes)
+                # The data is sent once, regardless of duplicates.
+                self.assertEqual(copy.call_count, 1)
+                self.assertEqual(stored_hashes,
+                                 set([r.hash for r in resources]))
+                cursor.execute("""\
+SELECT hash, filename, convert_from(data, 'utf-8')
+FROM pending_resources ORDER BY filename""")
+                self.assertEqual(cursor.fetchall(), [
+                    (resources[0].hash, 'a.txt', 'hello world\n',),
+                    (resources[1].hash, 'b.txt', 'hi world\n',),
+                    ])
+        self.assertEqual([r.id for r in resources],
+                         [r.hash for r in resources])
+
+    def test_load_pending_resources(self):
+        """Load the pending resources used by several documents"""
+        resources = [
+            cnxepub.Resource('{}.txt'.format(i),
+                             io.BytesIO('resource {}\n'.format(i)),
+                             'text/plain')
+            for i in range(12)]
+        shared_resource = resources[0]
+        # The hashes used by each of the documents.
+        documents_hashes = [
+            [shared_resource.hash] + [r.hash for r in resources[1:6]],
+            [shared_resource.hash] + [r.hash for r in resources[6:]],
+            [shared_resource.hash, 'missing'],
+            ]
+
+        from ..db import _load_pending_resources, add_pending_resources
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                add_pending_resources(cursor, resources)
+                loaded = _load_pending_resources(
+                    cursor, [hash for hashes in documents_hashes
+                             for hash in hashes])
+
+        # A missing resource is left out.
+        self.assertEqual(sorted(loaded.keys()),
+                         sorted([r.hash for r in resources]))
+        for resource in resources:
+            with loaded[resource.hash].open() as loaded_data:
+                with resource.open() as data:
+                    self.assertEqual(loaded_data.read(), data.read())
+            self.assertEqual(loaded[resource.hash].media_type, 'text/plain')
+
     def test_add_new_pending_document(self):
         """Add a pending document to the database."""
         publication_id = self.make_publication()
@@ -776,6 +1298,115 @@ WHERE
         self.assertEqual(is_license_accepted, False)
         self.assertEqual(are_roles_accepted, False)
 
+    def test_add_pending_models(self):
+        """Add several pending documents to the database at once."""
+        publication_id = self.make_publication()
+
+        metadata = {
+            'authors': [{'id': 'able', 'type': 'cnx-id'}],
+            'publishers': [{'id': 'able', 'type': 'cnx-id'}],
+            'license_url': VALID_LICENSE_URL,
+            'title': 'Valid',
+            'summary': 'Valid.',
+            }
+        valid_document = self.make_document(metadata=deepcopy(metadata))
+        metadata['title'] = 'Invalid subjects'
+        metadata['subjects'] = ['Math and Stuph']
+        invalid_subjects_document = self.make_document(
+            metadata=deepcopy(metadata))
+        metadata['title'] = 'Invalid derived-from'
+        metadata['subjects'] = []
+        metadata['derived_from_uri'] = \
+            'http://cnx.org/contents/{}@1'.format(uuid.uuid4())
+        invalid_derived_from_document = self.make_document(
+            metadata=deepcopy(metadata))
+        models = [invalid_subjects_document, valid_document,
+                  invalid_derived_from_document]
+
+        from ..db import add_pending_models
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                ident_hashes = add_pending_models(
+                    cursor, publication_id, models)
+
+        self.assertEqual(len(ident_hashes), 3)
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                cursor.execute("""\
+SELECT ident_hash(uuid, major_version, minor_version)
+FROM pending_documents
+WHERE publication_id = %s
+ORDER BY id""", (publication_id,))
+                self.assertEqual([r[0] for r in cursor.fetchall()],
+                                 ident_hashes)
+                cursor.execute("""\
+SELECT state, state_messages FROM publications WHERE id = %s""",
+                               (publication_id,))
+                state, state_messages = cursor.fetchone()
+
+        # The failures are recorded in the order of the models.
+        self.assertEqual(state, 'Failed/Error')
+        self.assertEqual(
+            [(m['pending_ident_hash'], m['key'],) for m in state_messages],
+            [(ident_hashes[0], 'subjects',),
+             (ident_hashes[2], 'derived_from_uri',)])
+
+    def test_insert_pending_models_pairing(self):
+        """Each model is paired with its own pending document."""
+        publication_id = self.make_publication()
+
+        models = []
+        for i in range(5):
+            metadata = {
+                'authors': [{'id': 'able', 'type': 'cnx-id'}],
+                'license_url': VALID_LICENSE_URL,
+                'title': 'Document {}'.format(i),
+                }
+            models.append(self.make_document(metadata=metadata))
+
+        from ..db import _insert_pending_models
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                pending = _insert_pending_models(
+                    cursor, publication_id, models)
+                cursor.execute("""\
+SELECT id, uuid, metadata->>'title'
+FROM pending_documents
+WHERE publication_id = %s""", (publication_id,))
+                rows = dict([(r[0], (str(r[1]), r[2],))
+                             for r in cursor.fetchall()])
+
+        self.assertEqual(len(pending), len(models))
+        for model, (pending_id, uuid_, ident_hash) in zip(models, pending):
+            self.assertEqual(rows[pending_id],
+                             (model.id, model.metadata['title'],))
+            self.assertEqual(str(uuid_), model.id)
+            self.assertTrue(
+                model.get_uri('cnx-archive').endswith(ident_hash))
+
+    def test_insert_pending_models_w_duplicate_uuids(self):
+        """Models that share a uuid can't be paired with their pending
+        documents.
+        """
+        publication_id = self.make_publication()
+
+        uri = 'http://cnx.org/contents/{}@1'.format(uuid.uuid4())
+        models = []
+        for i in range(2):
+            metadata = {
+                'authors': [{'id': 'able', 'type': 'cnx-id'}],
+                'license_url': VALID_LICENSE_URL,
+                'title': 'Document {}'.format(i),
+                'cnx-archive-uri': uri,
+                }
+            models.append(self.make_document(metadata=metadata))
+
+        from ..db import _insert_pending_models
+        with psycopg2.connect(self.db_conn_str) as db_conn:
+            with db_conn.cursor() as cursor:
+                with self.assertRaises(ValueError):
+                    _insert_pending_models(cursor, publication_id, models)
+
     def test_add_pending_document_w_existing_license_accepted(self):
         """Add a pending document to the database.
         In this case we have an existing license acceptance for the author(s)
@@ -50,6 +50,17 @@ class PGNotifyFactoryTestCase(unittest.TestCase):
         self.assertEqual(event.ident_hash, payload['ident_hash'])
         self.assertEqual(event.timestamp, payload['timestamp'])
 
+    def test_publication_acceptance_notify_to_event(self):
+        payload = {"publication_id": 3}
+        channel = 'publication_acceptance'
+        notif = self._make_one(json.dumps(payload), channel)
+
+        event = self.target(notif)
+
+        from cnxpublishing.events import PublicationAcceptanceEvent
+        self.assertEqual(type(event), PublicationAcceptanceEvent)
+        self.assertEqual(event.publication_id, payload['publication_id'])
+
     def test_null_notify_to_event(self):
         payload = None  # null payload
         channel = 'testing'
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2017, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import cnxepub
+from pyramid import testing
+
+from . import use_cases
+from .testing import db_connect
+from .test_db import BaseDatabaseIntegrationTestCase
+
+
+class FauxCeleryApp(object):
+    """Stands in for a celery application and its result backend."""
+
+    def __init__(self):
+        self.results = {}
+        self.backend = self
+
+    def store_result(self, task_id, result, state):
+        self.results[task_id] = (state, result,)
+
+    def AsyncResult(self, task_id):
+        state, info = self.results.get(task_id, ('PENDING', None,))
+        return mock.Mock(state=state, info=info)
+
+
+class ProgressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        self.celery_app = FauxCeleryApp()
+        self.config.registry.celery_app = self.celery_app
+
+    def test_no_progress(self):
+        from ..pipeline import get_progress
+        self.assertEqual(get_progress(1), None)
+
+    @mock.patch('cnxpublishing.pipeline.time.time')
+    def test_progress(self, time):
+        from ..pipeline import get_progress, report_progress
+        time.return_value = 100.0
+        report_progress(1, stage='queued')
+        time.return_value = 101.0
+        report_progress(1, stage='processing')
+        report_progress(1, models=3, models_processed=1)
+
+        time.return_value = 103.5
+        self.assertEqual(get_progress(1), {
+            'stage': 'processing',
+            'models': 3,
+            'models_processed': 1,
+            'elapsed': 3.5,
+            })
+        # Other publications are unaffected.
+        self.assertEqual(get_progress(2), None)
+
+    @mock.patch('cnxpublishing.pipeline.time.time')
+    def test_finished(self, time):
+        from ..pipeline import get_progress, report_progress
+        time.return_value = 100.0
+        report_progress(1, stage='queued')
+        time.return_value = 110.0
+        report_progress(1, stage='done')
+
+        # The elapsed time stops once the pipeline is finished.
+        time.return_value = 200.0
+        progress = get_progress(1)
+        self.assertEqual(progress['stage'], 'done')
+        self.assertEqual(progress['elapsed'], 10.0)
+
+    def test_mapping(self):
+        from ..pipeline import get_mapping, get_progress, report_progress
+        self.assertEqual(get_mapping(1), None)
+        report_progress(1, stage='processing')
+        # No mapping until the publication has been processed.
+        self.assertEqual(get_mapping(1), None)
+
+        mapping = {'book': 'c3bb4bfb-3b53-41a9-bb03-583cf9ce3408@1.1'}
+        report_progress(1, mapping=mapping)
+        report_progress(1, stage='publishing')
+        self.assertEqual(get_mapping(1), mapping)
+        self.assertNotIn('mapping', get_progress(1))
+
+
+class PipelineIntegrationTestCase(BaseDatabaseIntegrationTestCase):
+    """Runs the pipeline's tasks against a spooled publication"""
+
+    def setUp(self):
+        super(PipelineIntegrationTestCase, self).setUp()
+        self.celery_app = FauxCeleryApp()
+        self.config.registry.celery_app = self.celery_app
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @db_connect
+    def spool(self, cursor, binder=use_cases.BOOK):
+        from ..db import spool_publication
+        zip_fd, zip_filepath = tempfile.mkstemp('.epub', dir=self.tmpdir)
+        cnxepub.make_publication_epub(binder, 'ream', 'pipelined',
+                                      zip_filepath)
+        epub = cnxepub.EPUB.from_file(zip_filepath)
+        with open(zip_filepath, 'rb') as epub_file:
+            return spool_publication(cursor, epub, epub_file)
+
+    @db_connect
+    def fetch_publication(self, cursor, publication_id):
+        cursor.execute("""\
+SELECT state, state_messages FROM publications WHERE id = %s""",
+                       (publication_id,))
+        state, state_messages = cursor.fetchone()
+        cursor.execute("""\
+SELECT type FROM pending_documents WHERE publication_id = %s
+ORDER BY type""", (publication_id,))
+        types = [row[0] for row in cursor.fetchall()]
+        return state, state_messages, types
+
+    def test_process_and_publish(self):
+        from ..pipeline import (
+            get_mapping, get_progress, process_publication,
+            publish_publication)
+        publication_id = self.spool()
+
+        process_publication(publication_id)
+
+        # The items of the EPUB are now pending documents.
+        state, state_messages, types = self.fetch_publication(publication_id)
+        documents = list(cnxepub.flatten_to_documents(use_cases.BOOK))
+        self.assertEqual(types, ['Binder'] + ['Document'] * len(documents))
+        self.assertEqual(state, 'Processing')
+        self.assertEqual(get_progress(publication_id)['models_processed'],
+                         len(types))
+        # The items of the EPUB are mapped to the pending documents.
+        from ..utils import split_ident_hash
+        mapping = get_mapping(publication_id)
+        self.assertEqual(len(mapping), len(types))
+        for id, ident_hash in mapping.items():
+            self.assertEqual(split_ident_hash(ident_hash)[0], id)
+
+        returned_state = publish_publication(publication_id)
+
+        # The roles and license have yet to be accepted.
+        state, state_messages, types = self.fetch_publication(publication_id)
+        self.assertEqual(returned_state, state)
+        self.assertEqual(state, 'Waiting for acceptance')
+        self.assertEqual(get_progress(publication_id)['stage'], 'done')
+
+    def test_process_failure(self):
+        from ..pipeline import get_mapping, get_progress, process_publication
+        publication_id = self.spool()
+
+        with mock.patch('cnxpublishing.pipeline.add_publication_models') \
+                as add_publication_models:
+            add_publication_models.side_effect = ValueError('bad epub')
+            with self.assertRaises(ValueError):
+                process_publication(publication_id)
+
+        state, state_messages, types = self.fetch_publication(publication_id)
+        self.assertEqual(state, 'Failed/Error')
+        self.assertEqual(types, [])
+        self.assertEqual(len(state_messages), 1)
+        message = state_messages[0]
+        self.assertEqual(message['code'], 24)
+        self.assertEqual(message['stage'], 'processing')
+        self.assertEqual(message['error'], 'ValueError: bad epub')
+        self.assertEqual(message['message'],
+                         "Failed while processing the publication: "
+                         "ValueError: bad epub")
+        self.assertEqual(get_progress(publication_id)['stage'], 'failed')
+        self.assertEqual(get_mapping(publication_id), None)
+
+    def test_publish_failure(self):
+        from ..pipeline import (
+            get_progress, process_publication, publish_publication)
+        publication_id = self.spool()
+        process_publication(publication_id)
+
+        with mock.patch('cnxpublishing.pipeline.poke_publication_state') \
+                as poke_publication_state:
+            poke_publication_state.side_effect = RuntimeError('lost')
+            with self.assertRaises(RuntimeError):
+                publish_publication(publication_id)
+
+        state, state_messages, types = self.fetch_publication(publication_id)
+        self.assertEqual(state, 'Failed/Error')
+        self.assertEqual(state_messages[-1]['stage'], 'publishing')
+        self.assertEqual(get_progress(publication_id)['stage'], 'failed')
+
+    @db_connect
+    def test_queueing_failure(self, cursor):
+        from ..pipeline import get_progress, start_publication
+        publication_id = self.spool()
+        self.celery_app.tasks = {
+            'cnxpublishing.pipeline.process_publication': mock.Mock(),
+            'cnxpublishing.pipeline.publish_publication': mock.Mock(),
+            }
+
+        with mock.patch('cnxpublishing.pipeline.celery.chain') as chain:
+            chain.return_value.delay.side_effect = IOError('broker is down')
+            with self.assertRaises(IOError):
+                start_publication(cursor, publication_id)
+
+        # The publication isn't left waiting on a pipeline that never ran.
+        state, state_messages, types = self.fetch_publication(publication_id)
+        self.assertEqual(state, 'Failed/Error')
+        self.assertEqual(state_messages[-1]['stage'], 'queueing')
+        self.assertEqual(get_progress(publication_id)['stage'], 'failed')
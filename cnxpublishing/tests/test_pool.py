@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2017, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import psycopg2
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_INTRANS,
+    )
+
+
+class FauxConnection(object):
+    """Stands in for a psycopg2 connection."""
+
+    def __init__(self):
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+        self.is_broken = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def cursor(self):
+        conn = self
+
+        class Cursor(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, stmt):
+                if conn.is_broken:
+                    raise psycopg2.OperationalError()
+                conn.status = TRANSACTION_STATUS_INTRANS
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+    def commit(self):
+        self.commits += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def connect(connection_string, **kwargs):
+            conn = FauxConnection()
+            self.connections.append(conn)
+            return conn
+
+        patcher = mock.patch('psycopg2.connect', side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_one(self, **kwargs):
+        from ..pool import ConnectionPool
+        return ConnectionPool('dbname=faux', **kwargs)
+
+    def test_reuse(self):
+        pool = self.make_one(min_size=1, max_size=2)
+
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_min_size(self):
+        pool = self.make_one(min_size=3, max_size=5)
+
+        pool.getconn()
+
+        self.assertEqual(len(self.connections), 3)
+        stats = pool.stats
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 2)
+
+    def test_invalid_sizes(self):
+        with self.assertRaises(ValueError):
+            self.make_one(min_size=3, max_size=2)
+
+    def test_timeout(self):
+        pool = self.make_one(min_size=0, max_size=1, timeout=0.01)
+        pool.getconn()
+
+        from ..exceptions import ConnectionPoolTimeout
+        with self.assertRaises(ConnectionPoolTimeout):
+            pool.getconn()
+
+        stats = pool.stats
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertTrue(stats['wait_time'] > 0)
+
+    def test_wait_for_return(self):
+        pool = self.make_one(min_size=0, max_size=1, timeout=5)
+        conn = pool.getconn()
+
+        timer = threading.Timer(0.05, pool.putconn, (conn,))
+        timer.start()
+        self.assertIs(pool.getconn(), conn)
+        timer.join()
+
+        stats = pool.stats
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+
+    def test_rollback_on_return(self):
+        pool = self.make_one()
+        conn = pool.getconn()
+        conn.status = TRANSACTION_STATUS_INTRANS
+
+        pool.putconn(conn)
+
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(pool.stats['idle'], 1)
+
+    def test_closed_connection_discarded(self):
+        pool = self.make_one(min_size=0, max_size=1)
+        conn = pool.getconn()
+        conn.close()
+        pool.putconn(conn)
+
+        new_conn = pool.getconn()
+
+        self.assertIsNot(new_conn, conn)
+        self.assertEqual(pool.stats['discarded'], 1)
+
+    def test_health_check_on_borrow(self):
+        pool = self.make_one(min_size=0, max_size=1, check_interval=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.is_broken = True
+
+        new_conn = pool.getconn()
+
+        self.assertIsNot(new_conn, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats['discarded'], 1)
+
+    def test_connection_context_manager(self):
+        pool = self.make_one()
+
+        with pool.connection() as conn:
+            pass
+        self.assertEqual(conn.commits, 1)
+
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as conn:
+                raise RuntimeError()
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(pool.stats['in_use'], 0)
+
+    def test_forked_process(self):
+        pool = self.make_one()
+        conn = pool.getconn()
+        pool.putconn(conn)
+
+        with mock.patch('os.getpid', return_value=-1):
+            new_conn = pool.getconn()
+
+        self.assertIsNot(new_conn, conn)
+        self.assertEqual(pool.stats['checkouts'], 1)
+
+
+class RequestCursorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid import testing
+        self.connections = []
+
+        def connect(connection_string, **kwargs):
+            conn = FauxConnection()
+            self.connections.append(conn)
+            return conn
+
+        patcher = mock.patch('psycopg2.connect', side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        from ..pool import ConnectionPool
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        self.pool = ConnectionPool('dbname=faux')
+        self.config.registry.db_pool = self.pool
+
+    def make_request(self):
+        from pyramid import testing
+        request = testing.DummyRequest()
+        request.registry = self.config.registry
+        request.exception = None
+        return request
+
+    def finish(self, request, exception=None):
+        request.exception = exception
+        for callback in request.response_callbacks:
+            callback(request, None)
+        for callback in request.finished_callbacks:
+            callback(request)
+
+    def target(self, request):
+        from ..pool import db_cursor
+        return db_cursor(request)
+
+    def test_commit(self):
+        request = self.make_request()
+        cursor = self.target(request)
+        cursor.execute("SELECT 1")
+        self.assertEqual(self.pool.stats['in_use'], 1)
+
+        self.finish(request)
+
+        conn = self.connections[0]
+        self.assertEqual(conn.commits, 1)
+        self.assertEqual(conn.rollbacks, 0)
+        self.assertEqual(self.pool.stats['in_use'], 0)
+
+    def test_rollback_on_exception(self):
+        request = self.make_request()
+        cursor = self.target(request)
+        cursor.execute("SELECT 1")
+
+        self.finish(request, RuntimeError())
+
+        conn = self.connections[0]
+        self.assertEqual(conn.commits, 0)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(self.pool.stats['in_use'], 0)
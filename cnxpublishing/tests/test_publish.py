@@ -8,8 +8,11 @@
 import os
 import io
 import datetime
+import threading
+import time
 import uuid
 import unittest
+from copy import deepcopy
 try:
     from unittest import mock
 except ImportError:
@@ -46,6 +49,63 @@ class PublishUtilityTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             target(ugly)
 
+    def test_flatten_tree(self):
+        """Binder trees are flattened in depth-first order."""
+        from ..publish import _flatten_tree as target
+        tree = {
+            'id': 'book', 'title': 'Book',
+            'contents': [
+                {'id': 'subcol', 'title': 'Part',
+                 'contents': [{'id': 'page1', 'title': ''},
+                              {'id': 'page2', 'title': 'Page Two'}]},
+                {'id': 'page1', 'title': ''},
+                ]}
+
+        nodes = target(tree)
+
+        self.assertEqual(
+            [(n['id'], n['title'], n['parent'], n['child_order'],)
+             for n in nodes],
+            [('book', 'Book', None, 0,),
+             ('subcol', 'Part', 0, 0,),
+             ('page1', '', 1, 0,),
+             ('page2', 'Page Two', 1, 1,),
+             ('page1', '', 0, 1,)])
+
+    def test_open_resource_files(self):
+        """Resources stay open until the context exits."""
+        from contextlib import contextmanager
+        from ..publish import _open_resource_files as target
+
+        class Resource(object):
+            media_type = 'text/plain'
+
+            def __init__(self, filename):
+                self.filename = filename
+
+            @contextmanager
+            def open(self):
+                file = io.BytesIO(self.filename)
+                try:
+                    yield file
+                finally:
+                    file.close()
+
+        resources = [Resource('a.txt'), Resource('b.txt')]
+        with target(resources) as files:
+            self.assertEqual(
+                [(filename, file.read(), media_type,)
+                 for filename, file, media_type in files],
+                [('a.txt', 'a.txt', 'text/plain',),
+                 ('b.txt', 'b.txt', 'text/plain',)])
+        self.assertTrue(all([file.closed for _, file, _ in files]))
+
+        # The files are closed when an error is raised.
+        with self.assertRaises(ValueError):
+            with target(resources) as files:
+                raise ValueError()
+        self.assertTrue(all([file.closed for _, file, _ in files]))
+
 
 class PublishIntegrationTestCase(unittest.TestCase):
     """Verify publication interactions with the archive database."""
@@ -455,6 +515,187 @@ RETURNING module_ident""", (abstractid,))
                 #   the same resource.
                 _insert_resource_file(cursor, module_ident, resource)
 
+    def test_module_ident_remembered(self):
+        """The module_idents of inserted modules are remembered for the
+        rest of the transaction.
+        """
+        metadata = {
+            'title': "Dingbat's Dilemma",
+            'language': 'en-us',
+            'summary': "The options are limitless.",
+            'license_url': 'http://creativecommons.org/licenses/by/3.0/',
+            'authors': [{'id': 'rbates', 'type': 'cnx-id',
+                         'name': 'Richard Bates'}],
+            'subjects': [],
+            'keywords': [],
+            'print_style': None,
+            }
+        document = self.make_document(metadata=metadata)
+
+        from ..pool import Connection
+        from ..publish import _insert_metadata
+        with psycopg2.connect(self.db_conn_str,
+                              connection_factory=Connection) as db_conn:
+            with db_conn.cursor() as cursor:
+                module_ident, ident_hash = _insert_metadata(
+                    cursor, document, 'rbates', 'no msg')
+                self.assertEqual(db_conn.module_idents,
+                                 {ident_hash: module_ident})
+            db_conn.rollback()
+            self.assertEqual(db_conn.module_idents, {})
+
+    def make_numbered_documents(self, count):
+        documents = []
+        for i in range(count):
+            metadata = deepcopy(use_cases.PAGE_ONE.metadata)
+            metadata['title'] = 'Document {}'.format(i)
+            content = io.BytesIO(
+                '<p>Document {}.</p>'.format(i).encode('utf-8'))
+            documents.append(self.make_document(metadata=metadata,
+                                                content=content))
+        return documents
+
+    def publish_documents(self, connection_factory, documents):
+        """Publishes the ``documents`` on a connection made by
+        ``connection_factory``. Returns the closed connection.
+        """
+        from ..publish import publish_model
+        with psycopg2.connect(self.db_conn_str,
+                              connection_factory=connection_factory) \
+                as db_conn:
+            with db_conn.cursor() as cursor:
+                ident_hashes = [publish_model(cursor, document,
+                                              'ream', 'no msg')
+                                for document in documents]
+                cursor.execute("""\
+SELECT count(*) FROM modules AS m NATURAL JOIN module_files AS mf
+WHERE ident_hash(m.uuid, m.major_version, m.minor_version) = ANY (%s)
+      AND mf.filename = 'index.cnxml.html'""", (ident_hashes,))
+                self.assertEqual(cursor.fetchone()[0], len(documents))
+        db_conn.close()
+        return db_conn
+
+    def test_prepared_statements(self):
+        """Statements of ``publish_model`` are prepared
+        on a pooled connection.
+        """
+        from ..pool import Connection
+        db_conn = self.publish_documents(Connection,
+                                         self.make_numbered_documents(2))
+        self.assertIn('module_insertion_001', db_conn.prepared_statements)
+        self.assertIn('files_lookup', db_conn.prepared_statements)
+
+        # A plain connection works without preparing anything.
+        db_conn = self.publish_documents(psycopg2.extensions.connection,
+                                         self.make_numbered_documents(2))
+        self.assertFalse(hasattr(db_conn, 'prepared_statements'))
+
+    @unittest.skipUnless(os.environ.get('BENCHMARK'),
+                         "set BENCHMARK=1 to run the benchmarks")
+    def test_prepared_statements_benchmark(self):
+        """Benchmarks ``publish_model`` with and without
+        preparing its statements (run with ``-s`` to see the timings).
+        """
+        count = 50
+
+        from ..pool import Connection
+        timings = {}
+        for connection_factory in (psycopg2.extensions.connection,
+                                   Connection,):
+            documents = self.make_numbered_documents(count)
+            started = time.time()
+            self.publish_documents(connection_factory, documents)
+            timings[connection_factory] = time.time() - started
+
+        print('\npublish_model x {}: {:.3f}s unprepared, {:.3f}s prepared'
+              .format(count, timings[psycopg2.extensions.connection],
+                      timings[Connection]))
+
+    def test_insert_files(self):
+        """Upsert many files at once."""
+        existing = b'existing file'
+        new = b'new file'
+
+        from ..publish import _insert_file, _insert_files
+        with self.db_connect() as db_conn:
+            with db_conn.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM files")
+                initial_file_count = cursor.fetchone()[0]
+                existing_fileid, existing_sha1 = _insert_file(
+                    cursor, io.BytesIO(existing), 'text/plain')
+
+                results = _insert_files(cursor, [
+                    (io.BytesIO(new), 'text/plain',),
+                    (io.BytesIO(existing), 'text/plain',),
+                    (io.BytesIO(new), 'text/plain',),
+                    ])
+
+                cursor.execute("SELECT sha1, fileid, file, media_type "
+                               "FROM files WHERE sha1 = %s",
+                               (results[0][1],))
+                sha1, fileid, file, media_type = cursor.fetchone()
+                cursor.execute("SELECT count(*) FROM files")
+                file_count = cursor.fetchone()[0]
+
+        self.assertEqual(file_count, initial_file_count + 2)
+        self.assertEqual(results[1], (existing_fileid, existing_sha1,))
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[0], (fileid, sha1,))
+        self.assertEqual(bytes(file), new)
+        self.assertEqual(media_type, 'text/plain')
+
+    def test_insert_files_concurrently(self):
+        """Upsert overlapping files from many concurrent transactions."""
+        payloads = [os.urandom(1024) for i in range(20)]
+        worker_count = 8
+        results = {}
+        errors = []
+        start = threading.Event()
+
+        from ..publish import _insert_files
+
+        def upsert(worker_id):
+            # Each worker upserts an overlapping (and differently
+            # ordered) selection of the payloads.
+            selection = payloads[worker_id % 4::2] + payloads[:5]
+            if worker_id % 2:
+                selection.reverse()
+            try:
+                start.wait()
+                with psycopg2.connect(self.db_conn_str) as db_conn:
+                    with db_conn.cursor() as cursor:
+                        files = [(io.BytesIO(p), 'application/octet-stream',)
+                                 for p in selection]
+                        results[worker_id] = dict(
+                            [(sha1, fileid,) for fileid, sha1
+                             in _insert_files(cursor, files)])
+            except Exception as exc:  # pragma: no cover
+                errors.append(exc)
+
+        workers = [threading.Thread(target=upsert, args=(i,))
+                   for i in range(worker_count)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        # Every worker resolved the same sha1 to the same fileid.
+        fileids = {}
+        for result in results.values():
+            for sha1, fileid in result.items():
+                self.assertEqual(fileids.setdefault(sha1, fileid), fileid)
+        # And no file was stored twice.
+        with self.db_connect() as db_conn:
+            with db_conn.cursor() as cursor:
+                cursor.execute("SELECT sha1, count(*) FROM files "
+                               "WHERE sha1 = ANY (%s) GROUP BY sha1",
+                               (list(fileids.keys()),))
+                counts = dict(cursor.fetchall())
+        self.assertEqual(len(counts), len(payloads))
+        self.assertEqual(set(counts.values()), set([1]))
+
 
 class RepublishTestCase(unittest.TestCase):
     """Verify republication of binders that contain share documents
@@ -627,6 +868,144 @@ SELECT 1 FROM trees WHERE documentid = (
 """, (book_one.id,))
         self.assertEqual((1,), cursor.fetchone())
 
+    def make_publication(self, cursor):
+        cursor.execute("""\
+INSERT INTO publications
+  ("publisher", "publication_message", "epub", "state")
+VALUES ('tester', 'test pub', %s, 'Publishing')
+RETURNING id""", (psycopg2.Binary(b''),))
+        return cursor.fetchone()[0]
+
+    @db_connect
+    def test_republish_in_parallel(self, cursor):
+        book_one = use_cases.setup_COMPLEX_BOOK_ONE_in_archive(self, cursor)
+        cursor.execute("""\
+            UPDATE modules SET stateid = 1 WHERE stateid = 5""")
+        publication_id = self.make_publication(cursor)
+
+        # * Make a new publication of page one
+        page_one = book_one[0][0]
+        page_one.metadata['version'] = '2'
+        from ..publish import publish_model
+        publish_model(cursor, page_one, 'tester', 'test pub')
+
+        # * Invoke the republish logic.
+        celery_app = mock.MagicMock()
+        self.config.registry.celery_app = celery_app
+        from ..publish import republish_binders_in_parallel
+        with mock.patch('cnxpublishing.publish.celery.chord') as chord:
+            scheduled = republish_binders_in_parallel(
+                cursor, publication_id, [page_one])
+
+        self.assertEqual(scheduled, [book_one.ident_hash])
+        self.assertEqual(len(chord.call_args[0][0]), 1)
+
+        # * Run the tasks, as the worker would.
+        task_args = celery_app.tasks.__getitem__.return_value.s.call_args_list
+        from ..publish import finish_republishing, republish_binder_task
+        result = republish_binder_task(*task_args[0][0])
+        finish_republishing([result], *task_args[1][0])
+
+        self.assertEqual(result, '{}@1.2'.format(book_one.id))
+        cursor.execute("SELECT state FROM publications WHERE id = %s",
+                       (publication_id,))
+        self.assertEqual(cursor.fetchone()[0], 'Done/Success')
+
+    @db_connect
+    def test_republish_in_parallel_queueing_failure(self, cursor):
+        book_one = use_cases.setup_COMPLEX_BOOK_ONE_in_archive(self, cursor)
+        cursor.execute("""\
+            UPDATE modules SET stateid = 1 WHERE stateid = 5""")
+        publication_id = self.make_publication(cursor)
+
+        page_one = book_one[0][0]
+        page_one.metadata['version'] = '2'
+        from ..publish import publish_model
+        publish_model(cursor, page_one, 'tester', 'test pub')
+
+        # * Invoke the republish logic, without a broker to queue on.
+        self.config.registry.celery_app = mock.MagicMock()
+        from ..publish import republish_binders_in_parallel
+        with mock.patch('cnxpublishing.publish.celery.chord') as chord:
+            chord.side_effect = IOError('broker is down')
+            with self.assertRaises(IOError):
+                republish_binders_in_parallel(
+                    cursor, publication_id, [page_one])
+
+        # The failure is recorded, rather than leaving the publication
+        # in the 'Publishing' state.
+        cursor.connection.rollback()
+        cursor.execute("SELECT state, state_messages FROM publications "
+                       "WHERE id = %s", (publication_id,))
+        state, messages = cursor.fetchone()
+        self.assertEqual(state, 'Failed/Error')
+        self.assertEqual([(m['code'], m['ident_hash'],) for m in messages],
+                         [(23, book_one.ident_hash,)])
+
+    @db_connect
+    def test_finish_republishing_with_failures(self, cursor):
+        publication_id = self.make_publication(cursor)
+        cursor.connection.commit()
+        ident_hash = 'c3bb4bfb-3b53-41a9-bb03-583cf9ce3408@1.1'
+
+        from ..publish import finish_republishing
+        finish_republishing([None], publication_id, [ident_hash])
+
+        cursor.execute("SELECT state, state_messages FROM publications "
+                       "WHERE id = %s", (publication_id,))
+        state, messages = cursor.fetchone()
+        self.assertEqual(state, 'Failed/Error')
+        self.assertEqual(messages[0]['code'], 23)
+        self.assertEqual(messages[0]['ident_hash'], ident_hash)
+
+    @db_connect
+    def test_rebuild_collection_tree(self, cursor):
+        book_one = use_cases.setup_COMPLEX_BOOK_ONE_in_archive(self, cursor)
+        page_one = book_one[0][0]
+        previous_ident_hash = page_one.ident_hash
+        page_one.metadata['version'] = '2'
+        from ..publish import publish_model, rebuild_collection_tree
+        ident_hash = publish_model(cursor, page_one, 'tester', 'test pub')
+
+        root_nodeid = rebuild_collection_tree(
+            cursor, book_one.ident_hash, {previous_ident_hash: ident_hash})
+
+        cursor.execute("""\
+WITH RECURSIVE t(nodeid, documentid) AS (
+  SELECT nodeid, documentid FROM trees WHERE nodeid = %s
+UNION ALL
+  SELECT c.nodeid, c.documentid FROM trees AS c JOIN t
+    ON (c.parent_id = t.nodeid))
+SELECT ident_hash(m.uuid, m.major_version, m.minor_version)
+FROM t LEFT JOIN modules AS m ON (t.documentid = m.module_ident)""",
+                       (root_nodeid,))
+        ident_hashes = [r[0] for r in cursor.fetchall()]
+        # The whole tree has been copied; root, two subcollections
+        # and four documents.
+        self.assertEqual(len(ident_hashes), 7)
+        self.assertIn(book_one.ident_hash, ident_hashes)
+        self.assertIn(ident_hash, ident_hashes)
+        self.assertNotIn(previous_ident_hash, ident_hashes)
+
+    @db_connect
+    def test_get_previous_publications(self, cursor):
+        book_one = use_cases.setup_COMPLEX_BOOK_ONE_in_archive(self, cursor)
+        page_one, page_two = book_one[0][0], book_one[0][1]
+        previous_ident_hash = page_one.ident_hash
+
+        # * Make a new publication of page one
+        page_one.metadata['version'] = '2'
+        from ..publish import get_previous_publications, publish_model
+        ident_hash = publish_model(cursor, page_one, 'tester', 'test pub')
+
+        previous = get_previous_publications(
+            cursor, [ident_hash, page_two.ident_hash,
+                     '{}@9'.format(page_one.id)])
+
+        # Only the revised page has a prior existence.
+        self.assertEqual(list(previous.keys()), [ident_hash])
+        self.assertEqual(previous[ident_hash][0], previous_ident_hash)
+
 
 class PublishCompositeDocumentTestCase(BaseDatabaseIntegrationTestCase):
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2017, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import unittest
+
+
+class FauxCursor(object):
+    """Stands in for a psycopg2 cursor, recording what it executes."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params,))
+
+
+class FauxConnection(object):
+    """Stands in for a connection that does not prepare statements."""
+
+
+class FauxPreparingConnection(object):
+    """Stands in for a ``cnxpublishing.pool.Connection``."""
+
+    def __init__(self):
+        self.prepared_statements = set()
+
+
+class StatementTestCase(unittest.TestCase):
+
+    def make_one(self, name, sql):
+        from ..statements import Statement
+        return Statement(name, sql)
+
+    def test_parameters(self):
+        statement = self.make_one('spam', """\
+SELECT %(a)s, %(b)s::text[], 5 %% 2
+WHERE x = ANY (%(b)s::text[]) AND y = %(a)s""")
+
+        self.assertEqual(statement.parameters, ['a', 'b'])
+        self.assertEqual(statement.prepare_sql, """\
+PREPARE spam AS SELECT $1, $2::text[], 5 % 2
+WHERE x = ANY ($2::text[]) AND y = $1""")
+        # The arguments are cast like their parameters.
+        self.assertEqual(statement.execute_sql,
+                         "EXECUTE spam (%(a)s, %(b)s::text[])")
+
+    def test_without_parameters(self):
+        statement = self.make_one('spam', "SELECT 1")
+
+        self.assertEqual(statement.prepare_sql, "PREPARE spam AS SELECT 1")
+        self.assertEqual(statement.execute_sql, "EXECUTE spam")
+
+    def test_execute(self):
+        statement = self.make_one('spam', "SELECT %(a)s")
+        cursor = FauxCursor(FauxPreparingConnection())
+
+        statement.execute(cursor, {'a': 1})
+        statement.execute(cursor, {'a': 2})
+
+        # Prepared once, on first use.
+        self.assertEqual(cursor.executed, [
+            ("PREPARE spam AS SELECT $1", None,),
+            ("EXECUTE spam (%(a)s)", {'a': 1},),
+            ("EXECUTE spam (%(a)s)", {'a': 2},),
+            ])
+        self.assertEqual(cursor.connection.prepared_statements,
+                         set(['spam']))
+
+    def test_execute_without_preparation(self):
+        statement = self.make_one('spam', "SELECT %(a)s")
+        cursor = FauxCursor(FauxConnection())
+
+        statement.execute(cursor, {'a': 1})
+
+        self.assertEqual(cursor.executed, [("SELECT %(a)s", {'a': 1},)])
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from .. import statements
+        self.addCleanup(statements._registry.pop, 'testing_spam', None)
+
+    def test_register(self):
+        from ..statements import get_statement, register_statement
+        statement = register_statement('testing_spam', "SELECT 1")
+
+        self.assertIs(get_statement('testing_spam'), statement)
+        # Registering the same statement again is harmless.
+        self.assertIs(register_statement('testing_spam', "SELECT 1"),
+                      statement)
+
+    def test_register_conflict(self):
+        from ..statements import register_statement
+        register_statement('testing_spam', "SELECT 1")
+
+        with self.assertRaises(ValueError):
+            register_statement('testing_spam', "SELECT 2")
@@ -71,6 +71,55 @@ def test_startup_event(db_cursor, complex_book_one,
     assert ident_mapping[book_one.ident_hash] == payload['module_ident']
 
 
+@pytest.mark.usefixtures('scoped_pyramid_app')
+def test_publication_acceptance_start_up(db_cursor,
+                                         channel_processing_start_up_event):
+    cursor = db_cursor
+    cursor.execute("""\
+INSERT INTO publications ("publisher", "publication_message", "state")
+VALUES ('ream', 'waiting', 'Waiting for acceptance'),
+       ('ream', 'processing', 'Processing')
+RETURNING id""")
+    waiting_id, processing_id = [row[0] for row in cursor.fetchall()]
+    # Start listening for publication_acceptance notifications.
+    cursor.connection.commit()
+    cursor.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor.execute('LISTEN publication_acceptance')
+    cursor.connection.commit()
+
+    from cnxpublishing.subscribers import publication_acceptance_start_up
+    publication_acceptance_start_up(channel_processing_start_up_event)
+    # Slowish machines require some time to catch up
+    time.sleep(0.5)
+
+    # Commit and poll to get the notifications
+    cursor.connection.commit()
+    cursor.connection.poll()
+    notifies = cursor.connection.notifies[:]
+    del cursor.connection.notifies[:]
+
+    # Only the publication waiting for acceptance is caught up on.
+    payloads = [json.loads(n.payload) for n in notifies
+                if n.channel == 'publication_acceptance']
+    assert payloads == [{'publication_id': waiting_id}]
+
+
+def test_publication_acceptance_processing(mocker):
+    poke = mocker.patch('cnxpublishing.subscribers.poke_publication_state')
+    poke.return_value = ('Done/Success', [],)
+
+    from psycopg2.extensions import Notify
+    notif = Notify(pid=555, channel='publication_acceptance',
+                   payload='{"publication_id": 3}')
+    from cnxpublishing.events import PublicationAcceptanceEvent
+    event = PublicationAcceptanceEvent(notif)
+
+    from cnxpublishing.subscribers import publication_acceptance_processing
+    publication_acceptance_processing(event)
+
+    poke.assert_called_once_with(3)
+
+
 class TestPostPublicationProcessing(object):
 
     @pytest.fixture(autouse=True)
@@ -1254,6 +1254,77 @@ WHERE portal_type = 'Collection'""")
         self.assertEqual(len(epub_content), len(epub_in_db))
         self.assertEqual(epub_content, epub_in_db)
 
+    def test_new_to_publication_async(self):
+        """\
+        Publish a new document in the background, verify the epub is
+        spooled and the publication pipeline is started
+        """
+        publisher = u'ream'
+        use_case = deepcopy(use_cases.BOOK)
+        epub_filepath = self.make_epub(
+            use_case, publisher, u'publishing this book')
+        api_key_headers = self.gen_api_key_headers('some-trust')
+
+        settings = self._app.registry.settings
+        progress = {'stage': 'queued', 'models': None,
+                    'models_processed': 0, 'elapsed': 0.0}
+        with mock.patch.dict(settings, {'publishing.async': 'true'}), \
+                mock.patch('cnxpublishing.views.publishing'
+                           '.start_publication') as start_publication, \
+                mock.patch('cnxpublishing.views.publishing.get_progress',
+                           return_value=progress):
+            resp = self.app_post_publication(epub_filepath,
+                                             headers=api_key_headers)
+        publication_id = resp.json['publication']
+
+        self.assertEqual(resp.json['state'], 'Processing')
+        self.assertEqual(resp.json['progress'], progress)
+        self.assertEqual(start_publication.call_args[0][1], publication_id)
+        with self.db_connect() as db_conn:
+            with db_conn.cursor() as cursor:
+                cursor.execute('SELECT length(epub) FROM publications'
+                               '  WHERE id = %s', (publication_id,))
+                self.assertTrue(cursor.fetchone()[0] > 0)
+                # The pending documents are left to the pipeline.
+                cursor.execute('SELECT count(*) FROM pending_documents'
+                               '  WHERE publication_id = %s',
+                               (publication_id,))
+                self.assertEqual(cursor.fetchone()[0], 0)
+        # The mapping is left to the pipeline as well.
+        self.assertNotIn('mapping', resp.json)
+
+    def test_get_publication_async_mapping(self):
+        """The mapping of a publication published in the background
+        is reported once the publication has been processed.
+        """
+        publisher = u'ream'
+        epub_filepath = self.make_epub(
+            deepcopy(use_cases.BOOK), publisher, u'publishing this book')
+        api_key_headers = self.gen_api_key_headers('some-trust')
+
+        settings = self._app.registry.settings
+        mapping = {use_cases.BOOK.id: '{}@1.1'.format(uuid.uuid4())}
+        with mock.patch.dict(settings, {'publishing.async': 'true'}), \
+                mock.patch('cnxpublishing.views.publishing'
+                           '.start_publication'), \
+                mock.patch('cnxpublishing.views.publishing.get_progress',
+                           return_value=None), \
+                mock.patch('cnxpublishing.views.publishing.get_mapping') \
+                as get_mapping:
+            resp = self.app_post_publication(epub_filepath,
+                                             headers=api_key_headers)
+            publication_id = resp.json['publication']
+            path = '/publications/{}'.format(publication_id)
+
+            # Not yet processed.
+            get_mapping.return_value = None
+            resp = self.app.get(path, headers=api_key_headers)
+            self.assertNotIn('mapping', resp.json)
+
+            get_mapping.return_value = mapping
+            resp = self.app.get(path, headers=api_key_headers)
+            self.assertEqual(resp.json['mapping'], mapping)
+
     def test_new_to_publication_license_not_accepted(self):
         """Publish documents only after all users have accepted the license"""
         publisher = u'ream'
@@ -284,6 +284,77 @@ INSERT INTO document_controls (uuid) VALUES (DEFAULT) RETURNING uuid""")
         resp = self.app.get(path, headers=api_key_header)
         self.assertEqual(resp.json, expected)
 
+    @db_connect
+    def test_acls_request(self, cursor):
+        """Submit access control entries for many pieces of content
+
+        1. Submit the acl request (as *untrusted* app user).
+
+        2. Submit the acl request (as *trusted* app user).
+
+        3. Verify the entries.
+
+        4. Submit a deletion request.
+
+        5. Verify the entries.
+
+        """
+        # One existing piece of content and one that does not yet exist.
+        cursor.execute("""\
+INSERT INTO document_controls (uuid) VALUES (DEFAULT) RETURNING uuid""")
+        uuids = [str(cursor.fetchone()[0]), str(uuid.uuid4())]
+        cursor.connection.commit()
+
+        base_headers = [('content-type', 'application/json',)]
+        data = {
+            'uuids': uuids,
+            'permissions': [
+                {'uid': 'ream', 'permission': 'publish'},
+                {'uid': 'rings', 'permission': 'publish'},
+                ],
+            }
+
+        # 1.
+        headers = self.gen_api_key_headers('no-trust')
+        headers.extend(base_headers)
+        with self.assertRaises(AppError) as caught_exception:
+            self.app.post_json('/permissions', data, headers=headers)
+        exception = caught_exception.exception
+        self.assertTrue(exception.args[0].find("403 Forbidden") >= 0)
+
+        # 2.
+        headers = self.gen_api_key_headers('some-trust')
+        headers.extend(base_headers)
+        resp = self.app.post_json('/permissions', data, headers=headers)
+        self.assertEqual(resp.status_int, 202)
+        self.assertEqual(resp.json, {'added': 4})
+        # Entries that already exist are not added again.
+        resp = self.app.post_json('/permissions', data, headers=headers)
+        self.assertEqual(resp.json, {'added': 0})
+
+        # 3.
+        for uuid_ in uuids:
+            path = "/contents/{}/permissions".format(uuid_)
+            resp = self.app.get(path, headers=headers)
+            self.assertEqual(resp.json, [
+                {'uuid': uuid_, 'uid': 'ream', 'permission': 'publish'},
+                {'uuid': uuid_, 'uid': 'rings', 'permission': 'publish'},
+                ])
+
+        # 4.
+        data['permissions'] = [{'uid': 'rings', 'permission': 'publish'}]
+        resp = self.app.delete_json('/permissions', data, headers=headers)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.json, {'removed': 2})
+
+        # 5.
+        for uuid_ in uuids:
+            path = "/contents/{}/permissions".format(uuid_)
+            resp = self.app.get(path, headers=headers)
+            self.assertEqual(resp.json, [
+                {'uuid': uuid_, 'uid': 'ream', 'permission': 'publish'},
+                ])
+
     def test_create_identifier_on_licensors_request(self):
         """Submit a set of users to initial license acceptance.
         This tests whether a trusted publisher has the permission
@@ -12,6 +12,7 @@ def declare_api_routes(config):
     add_route('license-request', '/contents/{uuid}/licensors')
     add_route('roles-request', '/contents/{uuid}/roles')
     add_route('acl-request', '/contents/{uuid}/permissions')
+    add_route('acls-request', '/permissions')
 
     # Publishing API
     add_route('publications', '/publications')
@@ -45,6 +46,7 @@ def declare_browsable_routes(config):
     add_route('admin-moderation', '/a/moderation/')
     add_route('admin-api-keys', '/a/api-keys/')
     add_route('admin-post-publications', '/a/post-publications/')
+    add_route('admin-db-pool', '/a/db-pool/')
     add_route('admin-add-site-messages', '/a/site-messages/',
               request_method='GET')
     add_route('admin-add-site-messages-POST', '/a/site-messages/',
@@ -9,12 +9,10 @@ from __future__ import absolute_import
 
 from datetime import datetime, timedelta
 
-import psycopg2
 from celery.result import AsyncResult
 from pyramid import httpexceptions
 from pyramid.view import view_config
 
-from .. import config
 from .moderation import get_moderation
 from .api_keys import get_api_keys
 
@@ -37,6 +35,9 @@ def admin_index(request):  # pragma: no cover
             {'name': 'Message Banners',
              'uri': request.route_url('admin-add-site-messages'),
              },
+            {'name': 'Database Connection Pool',
+             'uri': request.route_url('admin-db-pool'),
+             },
             ],
         }
 
@@ -68,57 +69,58 @@ def admin_api_keys(request):  # pragma: no cover
              renderer='cnxpublishing.views:templates/post-publications.html',
              permission='administer')
 def admin_post_publications(request):
-    settings = request.registry.settings
-    db_conn_str = settings[config.CONNECTION_STRING]
-
     states = []
-    with psycopg2.connect(db_conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    cursor.execute("""\
 SELECT ident_hash(m.uuid, m.major_version, m.minor_version),
        m.name, bpsa.created, bpsa.result_id::text
 FROM document_baking_result_associations AS bpsa
      INNER JOIN modules AS m USING (module_ident)
 ORDER BY bpsa.created DESC LIMIT 100""")
-            for row in cursor.fetchall():
-                message = ''
-                result_id = row[-1]
-                result = AsyncResult(id=result_id)
-                if result.failed():  # pragma: no cover
-                    message = result.traceback
-                states.append({
-                    'ident_hash': row[0],
-                    'title': row[1],
-                    'created': row[2],
-                    'state': result.state,
-                    'state_message': message,
-                })
+    for row in cursor.fetchall():
+        message = ''
+        result_id = row[-1]
+        result = AsyncResult(id=result_id)
+        if result.failed():  # pragma: no cover
+            message = result.traceback
+        states.append({
+            'ident_hash': row[0],
+            'title': row[1],
+            'created': row[2],
+            'state': result.state,
+            'state_message': message,
+        })
 
     return {'states': states}
 
 
+@view_config(route_name='admin-db-pool', request_method='GET',
+             renderer='cnxpublishing.views:templates/db-pool.html',
+             permission='administer')
+def admin_db_pool(request):
+    pool = getattr(request.registry, 'db_pool', None)
+    stats = pool is not None and pool.stats or None
+    return {'stats': stats}
+
+
 @view_config(route_name='admin-add-site-messages', request_method='GET',
              renderer='cnxpublishing.views:templates/site-messages.html',
              permission='administer')
 def admin_add_site_message(request):
-    settings = request.registry.settings
-    db_conn_str = settings[config.CONNECTION_STRING]
-
     banners = []
-    with psycopg2.connect(db_conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    cursor.execute("""\
                 SELECT id, service_state_id, starts, ends, priority, message
                 FROM service_state_messages ORDER BY starts DESC;""")
-            for row in cursor.fetchall():
-                banners.append({
-                    'id': row[0],
-                    'service_state_id': row[1],
-                    'starts': str(row[2]),
-                    'ends': str(row[3]),
-                    'priority': row[4],
-                    'message': row[5],
-                })
+    for row in cursor.fetchall():
+        banners.append({
+            'id': row[0],
+            'service_state_id': row[1],
+            'starts': str(row[2]),
+            'ends': str(row[3]),
+            'priority': row[4],
+            'message': row[5],
+        })
     today = datetime.today()
     tomorrow = today + timedelta(days=1)
     return {'start_date': today.strftime("%Y-%m-%d"),
@@ -159,13 +161,10 @@ def parse_message_args(request):
              permission='administer')
 def admin_add_site_message_POST(request):
 
-    settings = request.registry.settings
-    db_conn_str = settings[config.CONNECTION_STRING]
-
     # # If it was a post request to delete
     # if 'delete' in request.POST.keys():
     #     message_id = request.POST.get('delete', -1)
-    #     with psycopg2.connect(db_conn_str) as db_conn:
+    #     with db_connect() as db_conn:
     #         with db_conn.cursor() as cursor:
     #             cursor.execute("""\
     #                 DELETE FROM service_state_messages WHERE id=%s;
@@ -177,9 +176,8 @@ def admin_add_site_message_POST(request):
 
     # otherwise it was an post request to add an message banner
     args = parse_message_args(request)
-    with psycopg2.connect(db_conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    cursor.execute("""\
                 INSERT INTO service_state_messages
                     (service_state_id, starts, ends, priority, message)
                 VALUES (%(type)s, %(starts)s, %(ends)s,
@@ -195,13 +193,9 @@ def admin_add_site_message_POST(request):
              renderer='templates/site-messages.html',
              permission='administer')
 def admin_delete_site_message(request):
-    settings = request.registry.settings
-    db_conn_str = settings[config.CONNECTION_STRING]
-
     message_id = request.body.split("=")[1]
-    with psycopg2.connect(db_conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    cursor.execute("""\
                 DELETE FROM service_state_messages WHERE id=%s;
                 """, vars=(message_id, ))
     return_args = admin_add_site_message(request)
@@ -217,31 +211,27 @@ def admin_edit_site_message(request):
     message_id = request.matchdict['id']
     args = {'id': message_id}
 
-    settings = request.registry.settings
-    db_conn_str = settings[config.CONNECTION_STRING]
-
-    with psycopg2.connect(db_conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    cursor.execute("""\
                 SELECT id, service_state_id, starts, ends, priority, message
                 FROM service_state_messages WHERE id=%s;
                 """, vars=(message_id, ))
-            results = cursor.fetchall()
-            if len(results) != 1:
-                raise httpexceptions.HTTPBadRequest(
-                    '{} is not a valid id'.format(message_id))
-
-            TYPE_MAP = {1: 'maintenance', 2: 'notice', None: 'maintenance'}
-            PRIORITY_MAP = {1: 'danger', 2: 'warning', 3: 'success',
-                            None: 'danger'}
-            args[TYPE_MAP[results[0][1]]] = 'selected'
-            args[PRIORITY_MAP[results[0][4]]] = 'selected'
-            args['message'] = results[0][5]
-
-            args['start_date'] = results[0][2].strftime("%Y-%m-%d")
-            args['start_time'] = results[0][2].strftime("%H:%M")
-            args['end_date'] = results[0][3].strftime("%Y-%m-%d")
-            args['end_time'] = results[0][3].strftime("%H:%M")
+    results = cursor.fetchall()
+    if len(results) != 1:
+        raise httpexceptions.HTTPBadRequest(
+            '{} is not a valid id'.format(message_id))
+
+    TYPE_MAP = {1: 'maintenance', 2: 'notice', None: 'maintenance'}
+    PRIORITY_MAP = {1: 'danger', 2: 'warning', 3: 'success',
+                    None: 'danger'}
+    args[TYPE_MAP[results[0][1]]] = 'selected'
+    args[PRIORITY_MAP[results[0][4]]] = 'selected'
+    args['message'] = results[0][5]
+
+    args['start_date'] = results[0][2].strftime("%Y-%m-%d")
+    args['start_time'] = results[0][2].strftime("%H:%M")
+    args['end_date'] = results[0][3].strftime("%Y-%m-%d")
+    args['end_time'] = results[0][3].strftime("%H:%M")
     return args
 
 
@@ -253,12 +243,8 @@ def admin_edit_site_message_POST(request):
     args = parse_message_args(request)
     args['id'] = message_id
 
-    settings = request.registry.settings
-    db_conn_str = settings[config.CONNECTION_STRING]
-
-    with psycopg2.connect(db_conn_str) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    cursor.execute("""\
                 UPDATE service_state_messages
                 SET service_state_id=%(type)s,
                     starts=%(starts)s,
@@ -6,22 +6,23 @@
 # See LICENCE.txt for details.
 # ###
 import cnxepub
-import psycopg2
 from cnxarchive.scripts import export_epub
 from cnxarchive.utils.ident_hash import IdentHashError
 from pyramid import httpexceptions
 from pyramid.settings import asbool
 from pyramid.view import view_config
 
-from .. import config
 from ..bake import remove_baked
 from ..db import (
     accept_publication_license,
     accept_publication_role,
     add_publication,
     check_publication_state,
+    lookup_module_ident,
     poke_publication_state,
+    spool_publication,
     )
+from ..pipeline import get_mapping, get_progress, start_publication
 from ..utils import split_ident_hash
 
 
@@ -39,15 +40,27 @@ def publish(request):
     except:
         raise httpexceptions.HTTPBadRequest('Format not recognized.')
 
-    settings = request.registry.settings
+    cursor = request.db_cursor
+    epub_upload.seek(0)
+    if asbool(request.registry.settings.get('publishing.async')):
+        # Spool the EPUB and leave the rest to the publication pipeline.
+        publication_id = spool_publication(
+            cursor, epub, epub_upload, is_pre_publication)
+        start_publication(cursor, publication_id)
+        state, messages = check_publication_state(publication_id)
+        response_data = {
+            'publication': publication_id,
+            'state': state,
+            'messages': messages,
+            'progress': get_progress(publication_id),
+            }
+        return response_data
+
     # Make a publication entry in the database for status checking
     # the publication. This also creates publication entries for all
     # of the content in the EPUB.
-    with psycopg2.connect(settings[config.CONNECTION_STRING]) as db_conn:
-        with db_conn.cursor() as cursor:
-            epub_upload.seek(0)
-            publication_id, publications = add_publication(
-                cursor, epub, epub_upload, is_pre_publication)
+    publication_id, publications = add_publication(
+        cursor, epub, epub_upload, is_pre_publication)
 
     # Poke at the publication & lookup its state.
     state, messages = poke_publication_state(publication_id)
@@ -72,9 +85,23 @@ def get_publication(request):
         'state': state,
         'messages': messages,
         }
+    if asbool(request.registry.settings.get('publishing.async')):
+        response_data['progress'] = get_progress(publication_id)
+        # The mapping is known once the publication has been processed.
+        mapping = get_mapping(publication_id)
+        if mapping is not None:
+            response_data['mapping'] = mapping
     return response_data
 
 
+def _is_acceptance_notified(request):
+    """Is the channel processor moving the publications along as their
+    acceptances change? (see ``notify_publication_acceptance``)
+    """
+    return asbool(request.registry.settings.get(
+        'publishing.acceptance_notifications'))
+
+
 @view_config(route_name='publication-license-acceptance',
              request_method='GET',
              accept='application/json', renderer='json')
@@ -84,15 +111,13 @@ def get_accept_license(request):
     """
     publication_id = request.matchdict['id']
     user_id = request.matchdict['uid']
-    settings = request.registry.settings
 
     # FIXME Is this an active publication?
     # TODO Verify the accepting user is the one making the request.
 
     # For each pending document, accept the license.
-    with psycopg2.connect(settings[config.CONNECTION_STRING]) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""
+    cursor = request.db_cursor
+    cursor.execute("""
 SELECT row_to_json(combined_rows) FROM (
 SELECT
   pd.uuid AS id,
@@ -104,8 +129,8 @@ FROM
   NATURAL JOIN license_acceptances AS la
 WHERE pd.publication_id = %s AND user_id = %s
 ) as combined_rows;""",
-                           (publication_id, user_id))
-            user_documents = [r[0] for r in cursor.fetchall()]
+                   (publication_id, user_id))
+    user_documents = [r[0] for r in cursor.fetchall()]
 
     return {'publication_id': publication_id,
             'user_id': user_id,
@@ -121,7 +146,6 @@ def post_accept_license(request):
     """
     publication_id = request.matchdict['id']
     uid = request.matchdict['uid']
-    settings = request.registry.settings
 
     # TODO Verify the accepting user is the one making the request.
     #      They could be authenticated but not be the license acceptor.
@@ -142,17 +166,18 @@ def post_accept_license(request):
         raise httpexceptions.BadRequest("Posted data is invalid.")
 
     # For each pending document, accept/deny the license.
-    with psycopg2.connect(settings[config.CONNECTION_STRING]) as db_conn:
-        with db_conn.cursor() as cursor:
-            accept_publication_license(cursor, publication_id, uid,
-                                       accepted, True)
-            accept_publication_license(cursor, publication_id, uid,
-                                       denied, False)
+    cursor = request.db_cursor
+    notify = _is_acceptance_notified(request)
+    accept_publication_license(cursor, publication_id, uid,
+                               accepted, True, notify=notify)
+    accept_publication_license(cursor, publication_id, uid,
+                               denied, False, notify=notify)
 
     location = request.route_url('publication-license-acceptance',
                                  id=publication_id, uid=uid)
-    # Poke publication to change state.
-    state = poke_publication_state(publication_id)
+    if not notify:
+        # Poke publication to change state.
+        state = poke_publication_state(publication_id)
     return httpexceptions.HTTPFound(location=location)
 
 
@@ -164,15 +189,13 @@ def get_accept_role(request):
     """
     publication_id = request.matchdict['id']
     user_id = request.matchdict['uid']
-    settings = request.registry.settings
 
     # TODO Verify the accepting user is the one making the request.
     # FIXME Is this an active publication?
 
     # For each pending document, accept/deny the role.
-    with psycopg2.connect(settings[config.CONNECTION_STRING]) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""
+    cursor = request.db_cursor
+    cursor.execute("""
 SELECT row_to_json(combined_rows) FROM (
 SELECT
   pd.uuid AS id,
@@ -187,8 +210,8 @@ WHERE
   AND
   user_id = %s
 ) as combined_rows;""",
-                           (publication_id, user_id))
-            user_documents = [r[0] for r in cursor.fetchall()]
+                   (publication_id, user_id))
+    user_documents = [r[0] for r in cursor.fetchall()]
 
     return {'publication_id': publication_id,
             'user_id': user_id,
@@ -204,7 +227,6 @@ def post_accept_role(request):
     """
     publication_id = request.matchdict['id']
     uid = request.matchdict['uid']
-    settings = request.registry.settings
 
     # TODO Verify the accepting user is the one making the request.
     #      They could be authenticated but not be the license acceptor.
@@ -225,17 +247,18 @@ def post_accept_role(request):
         raise httpexceptions.BadRequest("Posted data is invalid.")
 
     # For each pending document, accept/deny the license.
-    with psycopg2.connect(settings[config.CONNECTION_STRING]) as db_conn:
-        with db_conn.cursor() as cursor:
-            accept_publication_role(cursor, publication_id, uid,
-                                    accepted, True)
-            accept_publication_role(cursor, publication_id, uid,
-                                    denied, False)
+    cursor = request.db_cursor
+    notify = _is_acceptance_notified(request)
+    accept_publication_role(cursor, publication_id, uid,
+                            accepted, True, notify=notify)
+    accept_publication_role(cursor, publication_id, uid,
+                            denied, False, notify=notify)
 
     location = request.route_url('publication-license-acceptance',
                                  id=publication_id, uid=uid)
-    # Poke publication to change state.
-    state = poke_publication_state(publication_id)
+    if not notify:
+        # Poke publication to change state.
+        state = poke_publication_state(publication_id)
     return httpexceptions.HTTPFound(location=location)
 
 
@@ -245,7 +268,6 @@ def post_accept_role(request):
              renderer='json', permission='publish')
 def bake_content(request):
     """Invoke the baking process - trigger post-publication"""
-    settings = request.registry.settings
     ident_hash = request.matchdict['ident_hash']
     try:
         id, version = split_ident_hash(ident_hash)
@@ -255,22 +277,22 @@ def bake_content(request):
     if not version:
         raise httpexceptions.HTTPBadRequest('must specify the version')
 
-    with psycopg2.connect(settings[config.CONNECTION_STRING]) as db_conn:
-        with db_conn.cursor() as cursor:
-            cursor.execute("""\
+    cursor = request.db_cursor
+    module_ident = lookup_module_ident(cursor, ident_hash)
+    cursor.execute("""\
 SELECT bool(portal_type = 'Collection')
 FROM modules
-WHERE ident_hash(uuid, major_version, minor_version) = %s
-""", (ident_hash,))
-            try:
-                is_binder = cursor.fetchone()[0]
-            except TypeError:
-                raise httpexceptions.HTTPNotFound()
-            if not is_binder:
-                raise httpexceptions.HTTPBadRequest(
-                    '{} is not a book'.format(ident_hash))
-
-            cursor.execute("""\
+WHERE module_ident = %s
+""", (module_ident,))
+    try:
+        is_binder = cursor.fetchone()[0]
+    except TypeError:
+        raise httpexceptions.HTTPNotFound()
+    if not is_binder:
+        raise httpexceptions.HTTPBadRequest(
+            '{} is not a book'.format(ident_hash))
+
+    cursor.execute("""\
 UPDATE modules SET stateid = 5
-WHERE ident_hash(uuid, major_version, minor_version) = %s
-""", (ident_hash,))
+WHERE module_ident = %s
+""", (module_ident,))